@@ -0,0 +1,222 @@
+"""Fingerprinted, precompressed static assets and responsive background images.
+
+`flask build-assets` copies every file under static/ into static/dist/ with a
+content hash in its name, writes .gz (and .br when Brotli is installed) next
+to text assets, and renders WebP/AVIF copies of the images at a few widths
+when Pillow can encode them. static/dist/manifest.json maps the original
+paths to the built files. Templates ask for assets through asset_url() and
+hero_image(), which fall back to plain /static URLs when nothing is built.
+"""
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import shutil
+from flask import abort, request, send_file, url_for
+from werkzeug.security import safe_join
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover - optional dependency
+    brotli = None
+
+try:
+    from PIL import Image
+except ImportError:  # pragma: no cover - optional dependency
+    Image = None
+else:
+    try:
+        import pillow_avif  # noqa: F401  pylint: disable=unused-import
+    except ImportError:
+        pass
+
+MANIFEST = "manifest.json"
+COMPRESSIBLE = {".css", ".js", ".svg", ".json", ".txt", ".html"}
+IMAGES = {".jpg", ".jpeg", ".png"}
+WIDTHS = (640, 1280, 1920)
+# Best format first, as the browser takes the first <source> it supports.
+IMAGE_FORMATS = (("AVIF", "image/avif", ".avif", {"quality": 50}),
+                 ("WEBP", "image/webp", ".webp", {"quality": 78, "method": 6}))
+IMMUTABLE = "public, max-age=31536000, immutable"
+
+
+def file_hash(path, length=10):
+    """Short hex digest of a file's content"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as handle:
+        for block in iter(lambda: handle.read(1 << 16), b""):
+            digest.update(block)
+    return digest.hexdigest()[:length]
+
+
+def hashed_name(path, digest, suffix=""):
+    """static path -> the same path with the hash (and a variant suffix) in it"""
+    stem, ext = os.path.splitext(path)
+    return f"{stem}.{digest}{suffix}{ext}"
+
+
+def _write_atomic(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as handle:
+        handle.write(data)
+    os.replace(tmp, path)
+
+
+def _precompress(path):
+    """Write .gz and .br beside a built file, keeping only the ones that help"""
+    with open(path, "rb") as handle:
+        data = handle.read()
+    variants = [(".gz", gzip.compress(data, compresslevel=9, mtime=0))]
+    if brotli is not None:
+        variants.append((".br", brotli.compress(data, quality=11)))
+    for suffix, packed in variants:
+        if len(packed) < len(data):
+            _write_atomic(path + suffix, packed)
+
+
+def image_encoders():
+    """(format, mimetype, extension, save options) Pillow can write here"""
+    if Image is None:
+        return []
+    Image.init()
+    return [encoder for encoder in IMAGE_FORMATS if encoder[0] in Image.SAVE]
+
+
+def _image_variants(source, name, digest, out_dir, widths, encoders):
+    """Resized copies of one image, as {mimetype: [(built path, width), ...]}"""
+    variants = {}
+    with Image.open(source) as original:
+        original = original.convert("RGB")
+        sizes = [width for width in widths if width < original.width]
+        sizes.append(original.width)
+        for width in sizes:
+            height = round(original.height * width / original.width)
+            resized = original.resize((width, height), Image.LANCZOS)
+            for image_format, mimetype, ext, options in encoders:
+                built = f"{os.path.splitext(name)[0]}.{digest}.w{width}{ext}"
+                target = os.path.join(out_dir, built)
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                resized.save(target, image_format, **options)
+                variants.setdefault(mimetype, []).append((built, width))
+    return variants
+
+
+def build(static_dir, out_dir, widths=WIDTHS, log=None):
+    """Build every asset under static_dir into out_dir and write the manifest"""
+    encoders = image_encoders()
+    manifest = {"files": {}, "images": {}}
+    out_dir = os.path.abspath(out_dir)
+    for root, dirs, files in os.walk(os.path.abspath(static_dir)):
+        # Never build the build output again.
+        dirs[:] = [name for name in dirs if os.path.join(root, name) != out_dir]
+        for filename in sorted(files):
+            source = os.path.join(root, filename)
+            name = os.path.relpath(source, os.path.abspath(static_dir)).replace(os.sep, "/")
+            ext = os.path.splitext(filename)[1].lower()
+            digest = file_hash(source)
+            built = hashed_name(name, digest)
+            target = os.path.join(out_dir, built)
+            if not os.path.exists(target):
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                shutil.copyfile(source, target)
+                if ext in COMPRESSIBLE:
+                    _precompress(target)
+            manifest["files"][name] = built
+            if ext in IMAGES and encoders:
+                manifest["images"][name] = _image_variants(
+                    source, name, digest, out_dir, widths, encoders)
+            if log is not None:
+                log(name, built)
+    _write_atomic(os.path.join(out_dir, MANIFEST),
+                  json.dumps(manifest, indent=1, sort_keys=True).encode())
+    return manifest
+
+
+class Assets:
+    """Resolves static paths to their built copies and serves those copies.
+
+    Built files live under /assets/ with year-long immutable caching, since
+    their names change whenever their content does. Precompressed .br/.gz
+    copies are sent to clients that accept them.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.dist_dir = None
+        self.manifest = {"files": {}, "images": {}}
+        self._hashes = {}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Read ASSETS_DIR, load the manifest and register the /assets route"""
+        app.config.setdefault("ASSETS_DIR", os.path.join(app.static_folder, "dist"))
+        self.app = app
+        self.dist_dir = app.config["ASSETS_DIR"]
+        self.load()
+        app.add_url_rule("/assets/<path:filename>", "asset", self.send_asset)
+        app.add_template_global(self.asset_url)
+        app.add_template_global(self.hero_image)
+        app.extensions["assets"] = self
+
+    def load(self):
+        """(Re)read the manifest, keeping the plain static files if there is none"""
+        try:
+            with open(os.path.join(self.dist_dir, MANIFEST), encoding="utf-8") as handle:
+                self.manifest = json.load(handle)
+        except FileNotFoundError:
+            self.manifest = {"files": {}, "images": {}}
+
+    @staticmethod
+    def static_path(path):
+        """'/static/a/b.jpg' or 'static/a/b.jpg' -> 'a/b.jpg', None for other URLs"""
+        path = path.lstrip("/")
+        if path.startswith("static/"):
+            return path[len("static/"):]
+        return None
+
+    def asset_url(self, path):
+        """URL of a static file that can be cached forever"""
+        path = self.static_path(path) or path
+        built = self.manifest["files"].get(path)
+        if built is not None:
+            return url_for("asset", filename=built)
+        # Not built: fingerprint with a query string so a changed file is refetched.
+        if path not in self._hashes:
+            source = safe_join(self.app.static_folder, path)
+            self._hashes[path] = (file_hash(source)
+                                  if source and os.path.isfile(source) else None)
+        return url_for("static", filename=path, v=self._hashes[path])
+
+    def hero_image(self, url):
+        """src plus (mimetype, srcset) pairs for a page background"""
+        path = self.static_path(url or "")
+        if path is None:
+            return {"src": url, "sources": []}
+        sources = [(mimetype, ", ".join(f"{url_for('asset', filename=built)} {width}w"
+                                        for built, width in variants))
+                   for mimetype, variants in self.manifest["images"].get(path, {}).items()]
+        # Keep AVIF ahead of WebP whatever order the manifest has.
+        sources.sort(key=lambda source: source[0] != "image/avif")
+        return {"src": self.asset_url(path), "sources": sources}
+
+    def send_asset(self, filename):
+        """Serve a built file, precompressed when the client allows it"""
+        path = safe_join(self.dist_dir, filename)
+        if path is None or not os.path.isfile(path):
+            abort(404)
+        mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+        encoding = None
+        for name, suffix in (("br", ".br"), ("gzip", ".gz")):
+            if request.accept_encodings[name] and os.path.isfile(path + suffix):
+                path, encoding = path + suffix, name
+                break
+        response = send_file(path, mimetype=mimetype, conditional=True,
+                             max_age=31536000)
+        if encoding is not None:
+            response.headers["Content-Encoding"] = encoding
+        response.vary.add("Accept-Encoding")
+        response.headers["Cache-Control"] = IMMUTABLE
+        return response
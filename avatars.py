@@ -0,0 +1,89 @@
+"""Gravatar links built from the hash stored on each user.
+
+The MD5 of the normalised email is computed once, when the email is set,
+instead of on every comment render. With AVATAR_LOCAL the images are
+served from our own origin out of the image proxy's content-addressed
+cache, so identical avatars are stored once and pages make no third-party
+requests. Static copies made by `flask prerender` link Gravatar directly,
+as there is no app behind them to serve /avatar/<hash>.
+"""
+import hashlib
+import re
+from urllib.parse import urlencode
+from flask import abort, has_request_context, request, send_file, url_for
+from sqlalchemy import bindparam, select, update
+from image_proxy import FetchError
+from prerender import RENDERING
+
+HASH_PATTERN = re.compile(r"[0-9a-f]{32}")
+
+
+def avatar_hash(email):
+    """Gravatar hash of an email address"""
+    return hashlib.md5(email.strip().lower().encode(), usedforsecurity=False).hexdigest()
+
+
+def backfill(conn, users, chunk_size=1000):
+    """Fill avatar_hash for users that have none, returns how many were set"""
+    total = 0
+    while True:
+        rows = conn.execute(select(users.c.id, users.c.email)
+                            .where(users.c.avatar_hash.is_(None))
+                            .order_by(users.c.id).limit(chunk_size)).all()
+        if not rows:
+            return total
+        conn.execute(update(users).where(users.c.id == bindparam("uid"))
+                     .values(avatar_hash=bindparam("digest")),
+                     [{"uid": row.id, "digest": avatar_hash(row.email)} for row in rows])
+        total += len(rows)
+
+
+class Avatars:
+    """The `avatar` template filter and the /avatar/<hash> route"""
+
+    def __init__(self, app=None, image_proxy=None):
+        self.app = None
+        self.image_proxy = image_proxy
+        if app is not None:
+            self.init_app(app, image_proxy)
+
+    def init_app(self, app, image_proxy=None):
+        """Read the AVATAR_* settings and register the filter and route"""
+        app.config.setdefault("AVATAR_BASE_URL", "https://www.gravatar.com/avatar/")
+        app.config.setdefault("AVATAR_SIZE", 50)
+        app.config.setdefault("AVATAR_DEFAULT", "retro")
+        app.config.setdefault("AVATAR_RATING", "g")
+        app.config.setdefault("AVATAR_LOCAL", False)
+        app.config.setdefault("AVATAR_MAX_AGE", 86400)
+        self.app = app
+        if image_proxy is not None:
+            self.image_proxy = image_proxy
+        app.add_template_filter(self.url, "avatar")
+        app.add_url_rule("/avatar/<digest>", "avatar", self.send)
+        app.extensions["avatars"] = self
+
+    def remote_url(self, digest):
+        """Gravatar URL for a hash"""
+        config = self.app.config
+        query = urlencode({"s": config["AVATAR_SIZE"], "d": config["AVATAR_DEFAULT"],
+                           "r": config["AVATAR_RATING"]})
+        return f"{config['AVATAR_BASE_URL']}{digest}?{query}"
+
+    def url(self, digest):
+        """Where pages should load the avatar for a hash from"""
+        if self.app.config["AVATAR_LOCAL"] and self.image_proxy is not None \
+                and not (has_request_context() and request.environ.get(RENDERING)):
+            return url_for("avatar", digest=digest)
+        return self.remote_url(digest)
+
+    def send(self, digest):
+        """Avatar from the local cache, fetched from Gravatar the first time"""
+        if not HASH_PATTERN.fullmatch(digest) or self.image_proxy is None:
+            abort(404)
+        try:
+            path, content_type = self.image_proxy.original(self.remote_url(digest))
+        except FetchError:
+            abort(404)
+        # People change their Gravatar, so these are not cached forever.
+        return send_file(path, mimetype=content_type, conditional=True,
+                         max_age=self.app.config["AVATAR_MAX_AGE"])
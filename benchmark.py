@@ -0,0 +1,439 @@
+"""Load and benchmark suite for the blog's hot routes.
+
+Seeds an isolated database (a temporary SQLite file by default, or any
+empty database given with --db) and drives the app either in-process with
+Flask's test client or through a real gunicorn server. For each route it
+reports p50/p95/p99 latency, throughput, SQL statements per request and
+peak RSS, and can save the numbers as a JSON baseline and compare a run
+against an earlier one. In-process runs with --trace-memory also report the
+Python memory each request allocates at its peak.
+
+    python benchmark.py --posts 2000 --comments 20 --save bench.json
+    python benchmark.py --mode gunicorn --workers 4 --compare bench.json
+
+The environment is set up before the app is created, because create_app()
+reads its configuration from it.
+"""
+import argparse
+import datetime
+import functools
+import json
+import os
+import platform
+import random
+import re
+import resource
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+ROUTES = ("index", "posts", "get_post", "comment", "login")
+PASSWORD = "benchmark-password"
+CSRF_PATTERN = re.compile(r'name="csrf_token" type="hidden" value="([^"]+)"')
+
+
+def parse_args(argv=None):
+    """Command line options"""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--db", help="Database URL to seed and use (must be empty). "
+                                     "Defaults to a new temporary SQLite file.")
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--posts", type=int, default=1000)
+    parser.add_argument("--comments", type=int, default=10, help="Comments per post.")
+    parser.add_argument("--likes", type=int, default=2, help="Likes per comment.")
+    parser.add_argument("--requests", type=int, default=200, help="Requests per route.")
+    parser.add_argument("--routes", default=",".join(ROUTES),
+                        help=f"Comma-separated subset of {', '.join(ROUTES)}.")
+    parser.add_argument("--mode", choices=("inprocess", "gunicorn"), default="inprocess")
+    parser.add_argument("--workers", type=int, default=2, help="gunicorn workers.")
+    parser.add_argument("--concurrency", type=int, default=4,
+                        help="Client threads in gunicorn mode.")
+    parser.add_argument("--page-cache", default="null",
+                        help="PAGE_CACHE backend to run with; null measures the real work.")
+    parser.add_argument("--bcrypt-rounds", type=int, default=12)
+    parser.add_argument("--trace-memory", action="store_true",
+                        help="Also measure the memory each request allocates "
+                             "(in-process mode only; slows every request down).")
+    parser.add_argument("--seed", type=int, default=1, help="Random seed for the URL mix.")
+    parser.add_argument("--save", help="Write the results to this JSON file.")
+    parser.add_argument("--compare", help="Baseline JSON file to diff the results against.")
+    parser.add_argument("--threshold", type=float, default=0.15,
+                        help="Relative p95/queries increase that counts as a regression.")
+    return parser.parse_args(argv)
+
+
+def configure_environment(args):
+    """Point server.py at the benchmark database before it is imported"""
+    if not args.db:
+        directory = tempfile.mkdtemp(prefix="blog-bench-")
+        args.db = f"sqlite:///{os.path.join(directory, 'bench.db')}"
+    os.environ["DB_URI"] = args.db
+    os.environ.setdefault("FLASK_KEY", "benchmark")
+    os.environ["PAGE_CACHE"] = args.page_cache
+    os.environ["BCRYPT_ROUNDS"] = str(args.bcrypt_rounds)
+    os.environ["QUERY_COUNT_HEADER"] = "1"
+    # Every login comes from the same address here.
+    os.environ["LOGIN_IP_LIMIT"] = str(10 ** 9)
+
+
+@functools.cache
+def load_app():
+    """The app under test, with its schema set up"""
+    import server  # pylint: disable=import-outside-toplevel
+    app = server.create_app()
+    with app.app_context():
+        server.init_db()
+    return app
+
+
+# Seeding ---------------------------------------------------------------------
+
+def seed(args):
+    """Bulk-load users, posts, comments and likes, returns the post ids"""
+    import server  # pylint: disable=import-outside-toplevel
+    import search  # pylint: disable=import-outside-toplevel
+    from avatars import avatar_hash  # pylint: disable=import-outside-toplevel
+    from migrations import recount  # pylint: disable=import-outside-toplevel
+    from sanitize import sanitize_post, sanitize_comment  # pylint: disable=import-outside-toplevel
+
+    rng = random.Random(args.seed)
+    tables = server.db.metadata.tables
+    now = datetime.datetime.now()
+    started = time.perf_counter()
+    with load_app().app_context(), server.db.engine.begin() as conn:
+        if conn.execute(tables["blog_post"].select().limit(1)).first() is not None:
+            sys.exit(f"{args.db} already has posts, give an empty database")
+        password = server.bcrypt.generate_password_hash(PASSWORD, args.bcrypt_rounds).decode()
+        conn.execute(tables["users"].insert(), [
+            {"id": user, "email": f"user{user}@example.com", "password": password,
+             "token": os.urandom(16).hex(), "username": f"user{user}",
+             "first_name": "Bench", "last_name": f"User{user}",
+             "birth_date": datetime.date(1990, 1, 1), "date_created": now,
+             "avatar_hash": avatar_hash(f"user{user}@example.com")}
+            for user in range(1, args.users + 1)])
+        paragraph = ("<p>Lorem ipsum dolor sit amet, <strong>consectetur</strong> adipiscing "
+                     "elit, sed do eiusmod tempor incididunt ut labore et dolore.</p>")
+        post = sanitize_post(paragraph * 40)
+        comment = sanitize_comment("A comment with <em>some</em> words in it.")
+        for first in range(1, args.posts + 1, 1000):
+            ids = range(first, min(first + 1000, args.posts + 1))
+            conn.execute(tables["blog_post"].insert(), [
+                {"id": post_id, "uploader_id": rng.randint(1, args.users),
+                 "article_author": "Bench", "title": f"Benchmark post {post_id}",
+                 "subtitle": "Seeded for benchmark.py", "img_url": None,
+                 "date": now - datetime.timedelta(minutes=args.posts - post_id), **post}
+                for post_id in ids])
+            comments = [{"post_id": post_id, "author_id": rng.randint(1, args.users),
+                         "date_created": now, **comment}
+                        for post_id in ids for _ in range(args.comments)]
+            if comments:
+                conn.execute(tables["comments"].insert(), comments)
+        if args.likes:
+            comment_ids = conn.execute(tables["comments"].select()
+                                       .with_only_columns(tables["comments"].c.id)).scalars().all()
+            likes = [{"comment_id": comment_id, "user_id": user}
+                     for comment_id in comment_ids
+                     for user in rng.sample(range(1, args.users + 1),
+                                            min(args.likes, args.users))]
+            for start in range(0, len(likes), 10000):
+                conn.execute(tables["likes"].insert(), likes[start:start + 10000])
+        # Core inserts skip the mapper events that keep the counters.
+        recount(conn)
+        search.rebuild(conn)
+    print(f"Seeded {args.users} users, {args.posts} posts, "
+          f"{args.posts * args.comments} comments in {time.perf_counter() - started:.1f}s")
+    return list(range(1, args.posts + 1))
+
+
+# Scenarios -------------------------------------------------------------------
+
+def request_plan(args, post_ids):
+    """(route, method, path) for every request, in a reproducible shuffled order"""
+    rng = random.Random(args.seed)
+    last_page = max(0, (len(post_ids) - 1) // 10)
+    make = {
+        "index": lambda: ("GET", "/"),
+        "posts": lambda: ("GET", f"/posts/{rng.randint(1, max(1, last_page))}"),
+        "get_post": lambda: ("GET", f"/post/{rng.choice(post_ids)}"),
+        "comment": lambda: ("POST", f"/post/{rng.choice(post_ids)}"),
+        "login": lambda: ("POST", "/login"),
+    }
+    routes = [route.strip() for route in args.routes.split(",") if route.strip()]
+    unknown = set(routes) - set(make)
+    if unknown:
+        sys.exit(f"Unknown routes: {', '.join(sorted(unknown))}")
+    return {route: [make[route]() for _ in range(args.requests)] for route in routes}
+
+
+def form_data(route, csrf_token, rng, users):
+    """Body of the POST requests"""
+    if route == "login":
+        user = rng.randint(1, users)
+        return {"email": f"user{user}@example.com", "password": PASSWORD,
+                "csrf_token": csrf_token}
+    return {"text": "Benchmark comment", "csrf_token": csrf_token}
+
+
+def peak_rss_kb(pids=None):
+    """Peak resident set size in KiB of this process, or of the given pids"""
+    if pids is None:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    peak = 0
+    for pid in pids:
+        try:
+            with open(f"/proc/{pid}/status", encoding="ascii") as status:
+                for line in status:
+                    if line.startswith("VmHWM:"):
+                        peak = max(peak, int(line.split()[1]))
+        except OSError:
+            continue
+    return peak or None
+
+
+def summarise(latencies, queries, errors, elapsed, rss, allocated=()):
+    """Statistics of one route"""
+    if not latencies:
+        return {"count": 0, "errors": errors}
+    cuts = statistics.quantiles(latencies, n=100, method="inclusive") \
+        if len(latencies) > 1 else [latencies[0]] * 99
+    return {"count": len(latencies), "errors": errors,
+            "p50_ms": round(cuts[49] * 1000, 2), "p95_ms": round(cuts[94] * 1000, 2),
+            "p99_ms": round(cuts[98] * 1000, 2),
+            "mean_ms": round(statistics.fmean(latencies) * 1000, 2),
+            "throughput_rps": round(len(latencies) / elapsed, 1) if elapsed else None,
+            "queries_per_request": round(statistics.fmean(queries), 2) if queries else None,
+            "peak_rss_kb": rss,
+            "alloc_kb": round(statistics.fmean(allocated) / 1024, 1) if allocated else None}
+
+
+def run_inprocess(args, plan):
+    """Drive the app through the test client in this process"""
+    import server  # pylint: disable=import-outside-toplevel
+    from query_budget import QueryCounter  # pylint: disable=import-outside-toplevel
+
+    rng = random.Random(args.seed)
+    anonymous = load_app().test_client()
+    member = load_app().test_client()
+    token = CSRF_PATTERN.search(member.get("/login").get_data(as_text=True)).group(1)
+    member.post("/login", data={"email": "user1@example.com", "password": PASSWORD,
+                                "csrf_token": token})
+    if args.trace_memory:
+        tracemalloc.start()
+    results = {}
+    for route, requests_ in plan.items():
+        client = member if route == "comment" else anonymous
+        if route == "login":
+            token = CSRF_PATTERN.search(client.get("/login").get_data(as_text=True)).group(1)
+        latencies, queries, allocated, errors = [], [], [], 0
+        started = time.perf_counter()
+        for method, path in requests_:
+            data = form_data(route, token, rng, args.users) if method == "POST" else None
+            if args.trace_memory:
+                tracemalloc.reset_peak()
+                baseline = tracemalloc.get_traced_memory()[0]
+            with QueryCounter() as counter:
+                begin = time.perf_counter()
+                response = client.open(path, method=method, data=data)
+                latencies.append(time.perf_counter() - begin)
+            if args.trace_memory:
+                allocated.append(tracemalloc.get_traced_memory()[1] - baseline)
+            queries.append(counter.count)
+            if response.status_code >= 400:
+                errors += 1
+            if route == "login":
+                # Log straight back out so the next attempt really checks a password.
+                client.get("/logout")
+        results[route] = summarise(latencies, queries, errors,
+                                   time.perf_counter() - started, peak_rss_kb(), allocated)
+    if args.trace_memory:
+        tracemalloc.stop()
+    # The like buffer and page cache live until exit; do not count them twice.
+    server.like_buffer.flush()
+    return results
+
+
+def free_port():
+    """A TCP port nothing listens on right now"""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def worker_pids(master):
+    """Process ids of a gunicorn master's workers"""
+    pids = []
+    for task in os.listdir(f"/proc/{master}/task"):
+        try:
+            with open(f"/proc/{master}/task/{task}/children", encoding="ascii") as children:
+                pids.extend(int(pid) for pid in children.read().split())
+        except OSError:
+            continue
+    return pids
+
+
+def start_gunicorn(args):
+    """Launch gunicorn on a free port and wait until it answers"""
+    port = free_port()
+    process = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "--preload", "server:create_app()", "--workers", str(args.workers),
+         "--bind", f"127.0.0.1:{port}", "--log-level", "warning"],
+        cwd=os.path.dirname(os.path.abspath(__file__)), env=os.environ.copy())
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            sys.exit("gunicorn exited during startup")
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.5):
+                return process, f"http://127.0.0.1:{port}"
+        except OSError:
+            time.sleep(0.2)
+    process.terminate()
+    sys.exit("gunicorn did not start within 30s")
+
+
+def run_gunicorn(args, plan):
+    """Drive a real gunicorn server from a pool of client threads"""
+    import requests  # pylint: disable=import-outside-toplevel
+
+    process, base = start_gunicorn(args)
+    local = threading.local()
+
+    def session(signed_in):
+        key = "member" if signed_in else "anonymous"
+        if not hasattr(local, key):
+            client = requests.Session()
+            token = CSRF_PATTERN.search(client.get(f"{base}/login").text).group(1)
+            if signed_in:
+                # The session keeps its CSRF secret across the login.
+                client.post(f"{base}/login", data={"email": "user1@example.com",
+                                                   "password": PASSWORD, "csrf_token": token},
+                            allow_redirects=False)
+            setattr(local, key, (client, token))
+        return getattr(local, key)
+
+    def one(route, method, path, rng):
+        client, token = session(route == "comment")
+        data = form_data(route, token, rng, args.users) if method == "POST" else None
+        begin = time.perf_counter()
+        response = client.request(method, f"{base}{path}", data=data, allow_redirects=False)
+        elapsed = time.perf_counter() - begin
+        if route == "login" and response.status_code == 302:
+            client.get(f"{base}/logout", allow_redirects=False)
+        count = response.headers.get("X-Query-Count")
+        return elapsed, int(count) if count else None, response.status_code >= 400
+
+    results = {}
+    try:
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            for route, requests_ in plan.items():
+                rng = random.Random(args.seed)
+                started = time.perf_counter()
+                outcomes = list(pool.map(lambda item: one(route, *item, rng), requests_))
+                elapsed = time.perf_counter() - started
+                results[route] = summarise(
+                    [outcome[0] for outcome in outcomes],
+                    [outcome[1] for outcome in outcomes if outcome[1] is not None],
+                    sum(outcome[2] for outcome in outcomes), elapsed,
+                    peak_rss_kb(worker_pids(process.pid)))
+    finally:
+        process.send_signal(signal.SIGTERM)
+        process.wait(timeout=30)
+    return results
+
+
+# Reporting -------------------------------------------------------------------
+
+def print_table(results):
+    """Human-readable summary"""
+    columns = ("count", "errors", "p50_ms", "p95_ms", "p99_ms", "throughput_rps",
+               "queries_per_request", "peak_rss_kb", "alloc_kb")
+    print(f"{'route':<10}" + "".join(f"{column:>21}" for column in columns))
+    for route, numbers in results.items():
+        print(f"{route:<10}" + "".join(
+            f"{'-' if numbers.get(column) is None else numbers[column]!s:>21}"
+            for column in columns))
+
+
+def compare(results, meta, baseline, threshold):
+    """Print the change against a baseline, returns the regressed routes"""
+    regressions = []
+    print(f"\nAgainst {baseline['meta'].get('git', '?')} "
+          f"from {baseline['meta'].get('date', '?')}:")
+    for key in ("mode", "database", "workers", "concurrency", "page_cache", "volumes",
+                "trace_memory"):
+        if baseline["meta"].get(key) != meta[key]:
+            print(f"  note: {key} differs ({baseline['meta'].get(key)} -> {meta[key]}), "
+                  "the numbers are not like for like")
+    for route, numbers in results.items():
+        before = baseline["routes"].get(route)
+        if not before:
+            continue
+        changes = []
+        for metric in ("p50_ms", "p95_ms", "throughput_rps", "queries_per_request",
+                       "peak_rss_kb", "alloc_kb"):
+            old, new = before.get(metric), numbers.get(metric)
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            changes.append(f"{metric} {old} -> {new} ({change:+.0%})")
+            worse = -change if metric == "throughput_rps" else change
+            if metric in ("p95_ms", "queries_per_request") and worse > threshold:
+                regressions.append(f"{route} {metric}")
+        print(f"  {route}: " + "; ".join(changes))
+    return regressions
+
+
+def git_revision():
+    """Short commit id of the tree being measured"""
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    """Seed, run, report, and save or compare"""
+    args = parse_args(argv)
+    configure_environment(args)
+    post_ids = seed(args)
+    plan = request_plan(args, post_ids)
+    runner = run_gunicorn if args.mode == "gunicorn" else run_inprocess
+    results = runner(args, plan)
+    print_table(results)
+    report = {"meta": {"date": datetime.datetime.now().isoformat(timespec="seconds"),
+                       "git": git_revision(), "python": platform.python_version(),
+                       "database": args.db.split(":", 1)[0], "mode": args.mode,
+                       "workers": args.workers if args.mode == "gunicorn" else 1,
+                       "concurrency": args.concurrency if args.mode == "gunicorn" else 1,
+                       "page_cache": args.page_cache, "bcrypt_rounds": args.bcrypt_rounds,
+                       "trace_memory": args.trace_memory,
+                       "volumes": {"users": args.users, "posts": args.posts,
+                                   "comments_per_post": args.comments,
+                                   "likes_per_comment": args.likes},
+                       "requests_per_route": args.requests},
+              "routes": results}
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as file:
+            json.dump(report, file, indent=2)
+        print(f"\nSaved to {args.save}")
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as file:
+            regressions = compare(results, report["meta"], json.load(file),
+                                  args.threshold)
+        if regressions:
+            print("\nRegressed: " + ", ".join(regressions))
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,370 @@
+"""Rendered-page cache with in-process, filesystem and SQLite backends"""
+import hashlib
+import os
+import pickle
+import secrets
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from flask import current_app, g, make_response, request, session
+from flask_login import current_user
+
+# Prune shared backends once every this many writes instead of on each one.
+PRUNE_EVERY = 64
+
+# WSGI environ key that makes cached() neither read nor fill the cache, for
+# requests made from inside the app. Clients cannot set environ keys.
+SKIP_CACHE = "blog.page_cache.skip"
+
+
+class NullCache:
+    """Backend that stores nothing, for turning the cache off"""
+
+    shared = False
+
+    def get(self, key):
+        return None
+
+    def set(self, key, value, ttl=None):
+        pass
+
+    def delete(self, key):
+        pass
+
+    def clear(self):
+        pass
+
+    def __len__(self):
+        return 0
+
+
+class MemoryCache:
+    """Thread-safe LRU cache with per-entry expiry, local to one worker.
+
+    A ttl of 0 keeps the entry until it is evicted for space.
+    """
+
+    shared = False
+
+    def __init__(self, max_entries=512, ttl=300):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            expires, value = item
+            if expires is not None and expires < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        expires = time.monotonic() + ttl if ttl else None
+        with self._lock:
+            self._data[key] = (expires, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class FileSystemCache:
+    """Cache shared by every worker on the host, one pickle file per entry"""
+
+    shared = True
+
+    def __init__(self, directory, max_entries=2048, ttl=300):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._writes = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(key.encode()).hexdigest())
+
+    def _entries(self):
+        return [entry for entry in os.scandir(self.directory)
+                if entry.is_file() and not entry.name.endswith(".tmp")]
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, "rb") as file:
+                expires, value = pickle.load(file)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+        if expires is not None and expires < time.time():
+            self.delete(key)
+            return None
+        return value
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        expires = time.time() + ttl if ttl else None
+        # Write to a temporary file and rename it, so readers in other
+        # workers never see a half-written entry.
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "wb") as file:
+            pickle.dump((expires, value), file, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self._path(key))
+        self._writes += 1
+        if self._writes % PRUNE_EVERY == 0:
+            self._prune()
+
+    def _prune(self):
+        entries = self._entries()
+        excess = len(entries) - self.max_entries
+        if excess <= 0:
+            return
+        entries.sort(key=lambda entry: entry.stat().st_mtime)
+        for entry in entries[:excess]:
+            try:
+                os.remove(entry.path)
+            except OSError:
+                pass
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def clear(self):
+        for entry in self._entries():
+            try:
+                os.remove(entry.path)
+            except OSError:
+                pass
+
+    def __len__(self):
+        return len(self._entries())
+
+
+class SQLiteCache:
+    """Cache shared by every worker on the host, stored in one SQLite file"""
+
+    shared = True
+
+    def __init__(self, path, max_entries=4096, ttl=300):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._writes = 0
+        self._local = threading.local()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def _connection(self):
+        # One connection per thread, reopened after a fork.
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS cache ("
+                         "key TEXT PRIMARY KEY, value BLOB NOT NULL, "
+                         "expires REAL, created REAL NOT NULL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS ix_cache_created "
+                         "ON cache (created)")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def get(self, key):
+        row = self._connection().execute(
+            "SELECT value, expires FROM cache WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        if row[1] is not None and row[1] < time.time():
+            self.delete(key)
+            return None
+        return pickle.loads(row[0])
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        now = time.time()
+        expires = now + ttl if ttl else None
+        conn = self._connection()
+        conn.execute("INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?)",
+                     (key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL), expires, now))
+        self._writes += 1
+        if self._writes % PRUNE_EVERY == 0:
+            conn.execute("DELETE FROM cache WHERE expires < ?", (now,))
+            conn.execute("DELETE FROM cache WHERE key IN (SELECT key FROM cache "
+                         "ORDER BY created LIMIT max(0, (SELECT count(*) FROM cache) - ?))",
+                         (self.max_entries,))
+
+    def delete(self, key):
+        self._connection().execute("DELETE FROM cache WHERE key = ?", (key,))
+
+    def clear(self):
+        self._connection().execute("DELETE FROM cache")
+
+    def __len__(self):
+        return self._connection().execute("SELECT count(*) FROM cache").fetchone()[0]
+
+
+def make_backend(config, instance_path):
+    """Build the backend named by PAGE_CACHE_BACKEND"""
+    name = config["PAGE_CACHE_BACKEND"]
+    ttl = config["PAGE_CACHE_TTL"]
+    max_entries = config["PAGE_CACHE_MAX_ENTRIES"]
+    if name == "memory":
+        return MemoryCache(max_entries, ttl)
+    if name == "filesystem":
+        directory = config.get("PAGE_CACHE_DIR") or os.path.join(
+            instance_path, "page-cache")
+        return FileSystemCache(directory, max_entries, ttl)
+    if name == "sqlite":
+        path = config.get("PAGE_CACHE_DIR") or instance_path
+        return SQLiteCache(os.path.join(path, "page-cache.sqlite3"), max_entries, ttl)
+    if name == "null":
+        return NullCache()
+    raise ValueError(f"Unknown PAGE_CACHE_BACKEND {name!r}")
+
+
+def request_variant():
+    """Cache variant for the current visitor.
+
+    Anonymous visitors all share one copy. Signed-in users get their own,
+    tied to the session's CSRF secret because the pages embed a CSRF token.
+    """
+    if current_user.is_authenticated:
+        return f"user:{current_user.get_id()}:{session.get('csrf_token', '')}"
+    return "anon"
+
+
+class PageCache:
+    """Caches rendered GET responses, invalidated by tag.
+
+    Every cache key includes the current version of each of its tags, and
+    invalidating a tag just gives it a new version. Entries under the old
+    version are never read again and age out by TTL or LRU. The tag versions
+    live in the backend, so an invalidation reaches every worker, and the CLI
+    and job processes, only when the backend is shared: "sqlite" (the
+    default) or "filesystem". "memory" is for a single process, and there
+    views cached until invalidated expire after PAGE_CACHE_TTL instead.
+    """
+
+    def __init__(self, app=None):
+        self.backend = NullCache()
+        # Views cached with ttl=0, which only invalidation can refresh.
+        self.kept_until_invalidated = []
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Configure the backend from the app config"""
+        app.config.setdefault("PAGE_CACHE_BACKEND", "sqlite")
+        app.config.setdefault("PAGE_CACHE_TTL", 300)
+        app.config.setdefault("PAGE_CACHE_MAX_ENTRIES", 512)
+        app.config.setdefault("PAGE_CACHE_DIR", None)
+        backend = make_backend(app.config, app.instance_path)
+        if isinstance(backend, MemoryCache) and self.kept_until_invalidated:
+            # Another process's invalidation never reaches this memory, so
+            # cached() bounds these entries by PAGE_CACHE_TTL instead.
+            app.logger.warning(
+                "PAGE_CACHE_BACKEND=memory keeps %s for PAGE_CACHE_TTL (%ss) rather than "
+                "until invalidated", ", ".join(self.kept_until_invalidated),
+                app.config["PAGE_CACHE_TTL"])
+        self.backend = backend
+        app.extensions["page_cache"] = self
+
+    def tag_version(self, tag):
+        """Current version of a tag, changed by every invalidate() of it"""
+        key = f"tag:{tag}"
+        version = self.backend.get(key)
+        if version is None:
+            version = secrets.token_hex(8)
+            self.backend.set(key, version, ttl=0)
+        return version
+
+    def invalidate(self, *tags):
+        """Drop every page cached under any of these tags"""
+        for tag in tags:
+            self.backend.set(f"tag:{tag}", secrets.token_hex(8), ttl=0)
+
+    def invalidate_all(self):
+        """Drop every cached page"""
+        self.invalidate("*")
+
+    def _record(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def stats(self):
+        """Hit and miss counters for this worker"""
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses,
+                "hit_ratio": self.hits / total if total else 0.0}
+
+    def cached(self, *tags, ttl=None):
+        """Decorator caching a view's GET responses.
+
+        Tags are formatted with the view arguments, so "post:{number}" is
+        invalidated per post. Under conditional.validated() the ETag is part
+        of the key too, so a page whose validator changed is never answered
+        from an older entry, whatever the tags say. ttl overrides
+        PAGE_CACHE_TTL; 0 keeps the response until one of its tags is
+        invalidated, or for PAGE_CACHE_TTL when the backend is not shared.
+        """
+        def decorator(view):
+            if ttl == 0:
+                self.kept_until_invalidated.append(view.__name__)
+            @wraps(view)
+            def wrapper(*args, **kwargs):
+                if request.method not in ("GET", "HEAD") or request.environ.get(SKIP_CACHE):
+                    return view(*args, **kwargs)
+                names = ["*"] + [tag.format(**kwargs) for tag in tags]
+                # The host is left out, so a page warmed off-request serves
+                # every host; views that hold absolute URLs put it in their ETag.
+                parts = [request.full_path, request_variant(), g.get("etag") or ""]
+                parts += [self.tag_version(name) for name in names]
+                key = "page:" + hashlib.sha1("|".join(parts).encode()).hexdigest()
+                entry = self.backend.get(key)
+                if entry is not None:
+                    self._record(hit=True)
+                    body, status, headers = entry
+                    response = current_app.response_class(
+                        body, status=status, headers=headers)
+                    response.headers["X-Cache"] = "HIT"
+                    return response
+                self._record(hit=False)
+                response = make_response(view(*args, **kwargs))
+                if response.status_code == 200 and not response.direct_passthrough:
+                    headers = [("Content-Type", response.headers["Content-Type"])]
+                    keep = None if ttl == 0 and not self.backend.shared else ttl
+                    self.backend.set(key, (response.get_data(), 200, headers), ttl=keep)
+                response.headers["X-Cache"] = "MISS"
+                return response
+            return wrapper
+        return decorator
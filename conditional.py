@@ -0,0 +1,82 @@
+"""ETag and Last-Modified handling, so repeat requests can get a cheap 304"""
+import datetime
+import functools
+import hashlib
+from flask import g, make_response, request, session
+from cache import SKIP_CACHE
+
+
+def make_etag(*parts):
+    """ETag value from whatever decides a response's content"""
+    return hashlib.sha1(repr(parts).encode()).hexdigest()
+
+
+def as_utc(moment):
+    """Aware UTC datetime, reading naive values as server local time"""
+    if moment is None:
+        return None
+    return moment.astimezone(datetime.timezone.utc).replace(microsecond=0)
+
+
+def is_fresh(etag=None, last_modified=None):
+    """Whether the client already holds this version of the response"""
+    if etag is not None and request.if_none_match:
+        return request.if_none_match.contains(etag) or request.if_none_match.star_tag
+    since = request.if_modified_since
+    if last_modified is not None and since is not None:
+        return as_utc(last_modified) <= since
+    return False
+
+
+def set_validators(response, etag=None, last_modified=None, cache_control=None):
+    """Put the validators and caching policy on a response"""
+    if etag is not None:
+        response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = as_utc(last_modified)
+    if cache_control is not None:
+        response.headers["Cache-Control"] = cache_control
+    return response
+
+
+def conditional(build, etag=None, last_modified=None, cache_control="no-cache"):
+    """304 when the client is up to date, otherwise the response build() makes.
+
+    build is only called on a miss, so the validators should come from
+    something cheaper than the full response.
+    """
+    if is_fresh(etag, last_modified):
+        response = make_response("", 304)
+    else:
+        response = make_response(build())
+        if response.status_code != 200:
+            # Redirects and errors are not versions of the page.
+            return response
+    return set_validators(response, etag, last_modified, cache_control)
+
+
+def validated(validator, cache_control=None):
+    """Decorator that answers GET/HEAD with 304 while the page is unchanged.
+
+    validator gets the view's arguments and returns (etag, last_modified)
+    from a cheap query; cache_control is a header value or a callable
+    returning one. The ETag is left in g.etag, where PageCache.cached()
+    puts it in the cache key so a cached body always matches its ETag.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            if request.method not in ("GET", "HEAD"):
+                return view(*args, **kwargs)
+            # Pending flash messages make the page differ from any cached
+            # copy, so it is neither validated nor read from or put in the cache.
+            if "_flashes" in session:
+                request.environ[SKIP_CACHE] = True
+                return view(*args, **kwargs)
+            etag, last_modified = validator(*args, **kwargs)
+            g.etag = etag
+            policy = cache_control() if callable(cache_control) else cache_control
+            return conditional(lambda: view(*args, **kwargs), etag,
+                               last_modified, policy)
+        return wrapper
+    return decorator
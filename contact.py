@@ -0,0 +1,57 @@
+"""Delivery of contact-form messages, run as a background job.
+
+CONTACT_SINK names where messages go: "log" writes them to the app log,
+"maildir:<directory>" stores each one as a mail file for a local mail
+client or forwarder to pick up, and a callable is called with the message.
+"""
+import logging
+import mailbox
+from email.message import EmailMessage
+from email.utils import formatdate, make_msgid
+
+logger = logging.getLogger(__name__)
+
+
+def make_message(name, email, phone_number, message, recipient):
+    """Email for one contact-form submission"""
+    mail = EmailMessage()
+    mail["Subject"] = f"Contact form: {name}"
+    mail["From"] = email
+    mail["Reply-To"] = email
+    mail["To"] = recipient
+    mail["Date"] = formatdate(localtime=True)
+    mail["Message-ID"] = make_msgid()
+    mail.set_content(f"Name: {name}\nEmail: {email}\nPhone number: {phone_number or '-'}\n\n"
+                     f"{message}\n")
+    return mail
+
+
+class LogSink:
+    """Writes each message to the log, for development"""
+
+    def __call__(self, mail):
+        logger.info("Contact message from %s:\n%s", mail["From"], mail.get_content())
+
+
+class MaildirSink:
+    """Adds each message to a Maildir, creating it on first use"""
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def __call__(self, mail):
+        # Maildir writes to tmp/ and renames into new/, so a reader never
+        # sees half a message.
+        mailbox.Maildir(self.directory, create=True).add(mail)
+
+
+def make_sink(config):
+    """Sink named by CONTACT_SINK: "log", "maildir:<directory>" or a callable"""
+    sink = config["CONTACT_SINK"]
+    if callable(sink):
+        return sink
+    if sink.startswith("maildir:"):
+        return MaildirSink(sink[len("maildir:"):])
+    if sink == "log":
+        return LogSink()
+    raise ValueError(f"Unknown CONTACT_SINK {sink!r}")
@@ -0,0 +1,120 @@
+"""Connection settings for running on SQLite or Postgres under several workers.
+
+SQLite connections are switched to WAL with the pragmas below as they are
+opened, so a commit no longer blocks readers and writers wait for each
+other instead of failing with "database is locked". Pool sizes come from
+DB_POOL_SIZE/DB_MAX_OVERFLOW. Connections are never shared across a
+gunicorn fork.
+"""
+import os
+import sqlite3
+import threading
+import time
+from sqlalchemy import event, text
+from sqlalchemy.engine import Engine, make_url
+
+# Applied to every new SQLite connection, in this order.
+SQLITE_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "busy_timeout": 5000,
+    "cache_size": -64000,
+    "mmap_size": 256 * 1024 * 1024,
+    "temp_store": "MEMORY",
+}
+
+
+@event.listens_for(Engine, "connect")
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    for name, value in SQLITE_PRAGMAS.items():
+        cursor.execute(f"PRAGMA {name}={value}")
+    cursor.close()
+
+
+def engine_options(uri, pool_size=5, max_overflow=10):
+    """SQLALCHEMY_ENGINE_OPTIONS suited to the database behind uri"""
+    url = make_url(uri)
+    if url.get_backend_name() == "sqlite":
+        if url.database in (None, "", ":memory:"):
+            return {}
+        return {"pool_size": pool_size, "max_overflow": max_overflow,
+                "pool_timeout": 10,
+                # The busy timeout is set by the pragma; sqlite3 waits as long.
+                "connect_args": {"timeout": SQLITE_PRAGMAS["busy_timeout"] / 1000,
+                                 "check_same_thread": False}}
+    return {"pool_size": pool_size, "max_overflow": max_overflow,
+            "pool_timeout": 10, "pool_recycle": 1800, "pool_pre_ping": True}
+
+
+def dispose_after_fork(engine):
+    """Drop connections inherited from the parent in every forked worker.
+
+    Also disposes now, so work done at import time (create_all, migrations)
+    leaves no open connection behind for gunicorn --preload to copy.
+    """
+    engine.dispose()
+    os.register_at_fork(after_in_child=lambda: engine.dispose(close=False))
+
+
+def check_concurrency(engine, readers=4, writers=2, seconds=2.0, hold=0.5):
+    """Run SQLite readers while writers hold the database's write lock.
+
+    Each writer keeps an exclusive transaction open for `hold` seconds, the
+    way a large commit does. In rollback-journal mode that stalls every
+    reader; in WAL mode reads carry on from the last committed snapshot.
+    Returns how many reads ran, how many waited longer than hold/2, the
+    slowest read, and how many writes ran or failed as locked.
+    """
+    if engine.dialect.name != "sqlite":
+        raise ValueError("The concurrency check is for SQLite databases")
+    with engine.begin() as conn:
+        conn.execute(text("CREATE TABLE IF NOT EXISTS concurrency_check "
+                          "(id INTEGER PRIMARY KEY, worker INTEGER, created REAL)"))
+    stop = time.monotonic() + seconds
+    lock = threading.Lock()
+    result = {"reads": 0, "blocked_reads": 0, "slowest_read_ms": 0.0,
+              "writes": 0, "locked": 0}
+
+    def read():
+        while time.monotonic() < stop:
+            started = time.perf_counter()
+            with engine.connect() as conn:
+                conn.execute(text("SELECT count(*) FROM concurrency_check")).scalar()
+            took = time.perf_counter() - started
+            with lock:
+                result["reads"] += 1
+                result["blocked_reads"] += took > hold / 2
+                result["slowest_read_ms"] = max(result["slowest_read_ms"], took * 1000)
+
+    def write(worker):
+        while time.monotonic() < stop:
+            connection = engine.raw_connection()
+            try:
+                cursor = connection.cursor()
+                cursor.execute("BEGIN EXCLUSIVE")
+                cursor.execute("INSERT INTO concurrency_check (worker, created) VALUES (?, ?)",
+                               (worker, time.time()))
+                time.sleep(hold)
+                connection.commit()
+                with lock:
+                    result["writes"] += 1
+            except sqlite3.OperationalError:
+                connection.rollback()
+                with lock:
+                    result["locked"] += 1
+            finally:
+                connection.close()
+
+    threads = [threading.Thread(target=read) for _ in range(readers)]
+    threads += [threading.Thread(target=write, args=(worker,)) for worker in range(writers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    with engine.begin() as conn:
+        conn.execute(text("DROP TABLE concurrency_check"))
+    result["slowest_read_ms"] = round(result["slowest_read_ms"], 1)
+    return result
@@ -0,0 +1,75 @@
+"""Atom feed and XML sitemaps for feed readers and crawlers.
+
+The documents are built from a few columns of the newest posts, never the
+bodies. server.py caches the bytes under tags that are invalidated when a
+post is added, edited or deleted, and answers repeat polls with a 304.
+"""
+from xml.sax.saxutils import escape, quoteattr
+from conditional import as_utc
+
+FEED_SIZE = 20
+# Protocol limit on URLs in one sitemap file. Posts are split into files by
+# id range, leaving room in the first one for the fixed pages.
+SITEMAP_LIMIT = 50000
+POSTS_PER_SITEMAP = SITEMAP_LIMIT - 10
+
+ATOM_TYPE = "application/atom+xml"
+XML_TYPE = "application/xml"
+
+
+def timestamp(moment):
+    """W3C datetime in UTC"""
+    return as_utc(moment).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def atom_feed(title, feed_url, home_url, entries):
+    """Atom document for entries of (url, title, summary, author, published, updated)"""
+    updated = max((entry[5] or entry[4] for entry in entries), default=None)
+    lines = ['<?xml version="1.0" encoding="utf-8"?>',
+             '<feed xmlns="http://www.w3.org/2005/Atom">',
+             f"<title>{escape(title)}</title>",
+             f"<id>{escape(feed_url)}</id>",
+             f'<link rel="self" type="{ATOM_TYPE}" href={quoteattr(feed_url)}/>',
+             f"<link href={quoteattr(home_url)}/>"]
+    if updated is not None:
+        lines.append(f"<updated>{timestamp(updated)}</updated>")
+    for url, entry_title, summary, author, published, edited in entries:
+        lines += ["<entry>",
+                  f"<title>{escape(entry_title)}</title>",
+                  f"<id>{escape(url)}</id>",
+                  f"<link href={quoteattr(url)}/>",
+                  f"<published>{timestamp(published)}</published>",
+                  f"<updated>{timestamp(edited or published)}</updated>",
+                  f"<author><name>{escape(author or '')}</name></author>"]
+        if summary:
+            lines.append(f"<summary>{escape(summary)}</summary>")
+        lines.append("</entry>")
+    lines.append("</feed>")
+    return "\n".join(lines).encode("utf-8")
+
+
+def sitemap(urls):
+    """Sitemap for (url, last modified or None) pairs"""
+    lines = ['<?xml version="1.0" encoding="utf-8"?>',
+             '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">']
+    for url, modified in urls:
+        lastmod = f"<lastmod>{timestamp(modified)}</lastmod>" if modified else ""
+        lines.append(f"<url><loc>{escape(url)}</loc>{lastmod}</url>")
+    lines.append("</urlset>")
+    return "\n".join(lines).encode("utf-8")
+
+
+def sitemap_index(sitemaps):
+    """Sitemap index for (sitemap url, last modified or None) pairs"""
+    lines = ['<?xml version="1.0" encoding="utf-8"?>',
+             '<sitemapindex xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">']
+    for url, modified in sitemaps:
+        lastmod = f"<lastmod>{timestamp(modified)}</lastmod>" if modified else ""
+        lines.append(f"<sitemap><loc>{escape(url)}</loc>{lastmod}</sitemap>")
+    lines.append("</sitemapindex>")
+    return "\n".join(lines).encode("utf-8")
+
+
+def sitemap_part(post_id):
+    """Number of the sitemap file a post is listed in, from 1"""
+    return (post_id - 1) // POSTS_PER_SITEMAP + 1
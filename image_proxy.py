@@ -0,0 +1,349 @@
+"""Local copies of the remote images posts use as backgrounds.
+
+A post's img_url can point anywhere, often at a multi-megabyte original on
+somebody else's host. ImageProxy fetches each URL once, keeps the bytes in a
+content-addressed disk cache shared by the workers, and serves resized,
+recompressed variants (when Pillow is installed) from our own origin with
+long-lived cache headers.
+"""
+import hashlib
+import io
+import ipaddress
+import logging
+import mimetypes
+import os
+import socket
+import tempfile
+import threading
+from urllib.parse import urljoin, urlsplit
+import requests
+from requests.adapters import HTTPAdapter
+from flask import send_file
+from cache import PRUNE_EVERY, MemoryCache
+from assets import IMMUTABLE, WIDTHS, Image
+
+logger = logging.getLogger(__name__)
+
+
+class FetchError(Exception):
+    """The remote image could not be fetched"""
+
+
+class PinnedAdapter(HTTPAdapter):
+    """Transport for a URL whose host was replaced by an IP address.
+
+    TLS still sends and verifies the original hostname, so the request
+    reaches the address that was checked and nothing else.
+    """
+
+    def __init__(self, hostname, **kwargs):
+        self.hostname = hostname
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs["server_hostname"] = self.hostname
+        kwargs["assert_hostname"] = self.hostname
+        super().init_poolmanager(*args, **kwargs)
+
+
+class HTTPFetcher:
+    """Fetches images over HTTP(S), refusing private addresses and huge bodies.
+
+    The request goes to the address that passed the check, with the
+    original Host header, so a second DNS answer cannot point it elsewhere.
+    """
+
+    def __init__(self, timeout=5, max_bytes=10 * 1024 * 1024, max_redirects=3,
+                 allow_private=False):
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+        self.max_redirects = max_redirects
+        self.allow_private = allow_private
+
+    def _check_host(self, url):
+        """Address to connect to for url, or None to let requests resolve it"""
+        parts = urlsplit(url)
+        if parts.scheme not in ("http", "https") or not parts.hostname:
+            raise FetchError(f"Not an http(s) URL: {url}")
+        if self.allow_private:
+            return None
+        try:
+            infos = socket.getaddrinfo(parts.hostname, parts.port or 443,
+                                       type=socket.SOCK_STREAM)
+        except socket.gaierror as error:
+            raise FetchError(f"Cannot resolve {parts.hostname}") from error
+        addresses = [ipaddress.ip_address(info[4][0].split("%")[0]) for info in infos]
+        if not addresses or not all(address.is_global for address in addresses):
+            raise FetchError(f"{parts.hostname} resolves to a private address")
+        return addresses[0]
+
+    def _get(self, session, url, address):
+        headers = {"Accept": "image/*"}
+        if address is not None:
+            parts = urlsplit(url)
+            host = f"[{address}]" if address.version == 6 else str(address)
+            if parts.port:
+                host += f":{parts.port}"
+            headers["Host"] = parts.netloc.rpartition("@")[2]
+            session.mount(f"{parts.scheme}://{host}", PinnedAdapter(parts.hostname))
+            url = parts._replace(netloc=host).geturl()
+        return session.get(url, timeout=self.timeout, stream=True,
+                           allow_redirects=False, headers=headers)
+
+    def __call__(self, url):
+        """Return (body, content type) of the image at url"""
+        for _ in range(self.max_redirects + 1):
+            address = self._check_host(url)
+            try:
+                with requests.Session() as session, \
+                        self._get(session, url, address) as response:
+                    if response.is_redirect:
+                        url = urljoin(url, response.headers["Location"])
+                        continue
+                    response.raise_for_status()
+                    content_type = response.headers.get("Content-Type", "").split(";")[0]
+                    if not content_type.startswith("image/"):
+                        raise FetchError(f"{url} is {content_type or 'untyped'}, not an image")
+                    chunks, size = [], 0
+                    for chunk in response.iter_content(1 << 16):
+                        size += len(chunk)
+                        if size > self.max_bytes:
+                            raise FetchError(f"{url} is larger than {self.max_bytes} bytes")
+                        chunks.append(chunk)
+                    return b"".join(chunks), content_type
+            except requests.RequestException as error:
+                raise FetchError(str(error)) from error
+        raise FetchError(f"Too many redirects for {url}")
+
+
+class LocalFetcher:
+    """Stand-in fetcher that reads the file named like the URL's last path part"""
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def __call__(self, url):
+        name = os.path.basename(urlsplit(url).path)
+        path = os.path.join(self.directory, name)
+        if not name or not os.path.isfile(path):
+            raise FetchError(f"No local file for {url}")
+        with open(path, "rb") as file:
+            return file.read(), mimetypes.guess_type(name)[0] or "image/jpeg"
+
+
+def make_fetcher(config):
+    """Fetcher named by IMAGE_FETCHER: "http", "local:<directory>" or a callable"""
+    fetcher = config["IMAGE_FETCHER"]
+    if callable(fetcher):
+        return fetcher
+    if fetcher.startswith("local:"):
+        return LocalFetcher(fetcher[len("local:"):])
+    if fetcher == "http":
+        return HTTPFetcher(timeout=config["IMAGE_FETCH_TIMEOUT"],
+                           max_bytes=config["IMAGE_MAX_BYTES"])
+    raise ValueError(f"Unknown IMAGE_FETCHER {fetcher!r}")
+
+
+def url_key(url):
+    """Stable name for a remote URL"""
+    return hashlib.sha1(url.encode()).hexdigest()
+
+
+class ImageProxy:
+    """Fetch-once disk cache of remote images with resized variants.
+
+    Layout under IMAGE_CACHE_DIR: urls/<sha1 of url> holds the digest and
+    type of what the URL returned, objects/<sha256> the original bytes and
+    variants/<sha256>.w<width>.<ext> the resized copies. Reads refresh a
+    file's mtime, and every PRUNE_EVERY writes the least recently used
+    files are removed until the cache is under IMAGE_CACHE_MAX_BYTES.
+    """
+
+    FORMATS = {"image/webp": ("WEBP", "webp", {"quality": 78, "method": 4}),
+               "image/jpeg": ("JPEG", "jpg", {"quality": 82, "optimize": True,
+                                              "progressive": True})}
+
+    def __init__(self, app=None, fetcher=None, max_keys=4096):
+        self.fetcher = fetcher
+        self.directory = None
+        self.max_bytes = 256 * 1024 * 1024
+        self.failure_ttl = 300
+        self._writes = 0
+        # Bounded, so a stream of distinct URLs cannot grow them forever.
+        # Losing a lock to eviction at worst fetches a URL twice.
+        self._failures = MemoryCache(max_keys, self.failure_ttl)
+        self._locks = MemoryCache(max_keys, ttl=0)
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Read the IMAGE_* settings and create the cache directories"""
+        app.config.setdefault("IMAGE_FETCHER", "http")
+        app.config.setdefault("IMAGE_FETCH_TIMEOUT", 5)
+        app.config.setdefault("IMAGE_MAX_BYTES", 10 * 1024 * 1024)
+        app.config.setdefault("IMAGE_CACHE_DIR", os.path.join(app.instance_path, "images"))
+        app.config.setdefault("IMAGE_CACHE_MAX_BYTES", 256 * 1024 * 1024)
+        if self.fetcher is None:
+            self.fetcher = make_fetcher(app.config)
+        self.directory = app.config["IMAGE_CACHE_DIR"]
+        self.max_bytes = app.config["IMAGE_CACHE_MAX_BYTES"]
+        for part in ("urls", "objects", "variants"):
+            os.makedirs(os.path.join(self.directory, part), exist_ok=True)
+        app.extensions["image_proxy"] = self
+
+    @property
+    def can_resize(self):
+        """Whether Pillow is there to make smaller variants"""
+        return Image is not None
+
+    # Disk layout -------------------------------------------------------------
+
+    def _write(self, path, data):
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        with os.fdopen(fd, "wb") as file:
+            file.write(data)
+        os.replace(tmp_path, path)
+        self._writes += 1
+        if self._writes % PRUNE_EVERY == 0:
+            self.prune()
+
+    @staticmethod
+    def _touch(path):
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+    def prune(self):
+        """Drop least recently used objects and variants past the size limit"""
+        files = []
+        for part in ("objects", "variants"):
+            for root, _, names in os.walk(os.path.join(self.directory, part)):
+                for name in names:
+                    try:
+                        stat = os.stat(os.path.join(root, name))
+                    except OSError:
+                        continue
+                    files.append((stat.st_mtime, stat.st_size, os.path.join(root, name)))
+        total = sum(size for _, size, _ in files)
+        files.sort()
+        for _, size, path in files:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+        return total
+
+    def _key_lock(self, key):
+        with self._lock:
+            lock = self._locks.get(key)
+            if lock is None:
+                lock = threading.Lock()
+                self._locks.set(key, lock)
+            return lock
+
+    # Originals and variants ------------------------------------------------
+
+    def original(self, url):
+        """Path and content type of the cached original, fetching it if needed"""
+        key = url_key(url)
+        index = os.path.join(self.directory, "urls", key)
+        with self._key_lock(key):
+            try:
+                with open(index, encoding="ascii") as file:
+                    digest, content_type = file.read().split()
+                path = os.path.join(self.directory, "objects", digest[:2], digest)
+                if os.path.isfile(path):
+                    self._touch(path)
+                    return path, content_type
+            except (OSError, ValueError):
+                pass
+            if self._failures.get(key) is not None:
+                raise FetchError(f"{url} failed recently")
+            try:
+                body, content_type = self.fetcher(url)
+            except FetchError:
+                self._failures.set(key, True, ttl=self.failure_ttl)
+                raise
+            digest = hashlib.sha256(body).hexdigest()
+            path = os.path.join(self.directory, "objects", digest[:2], digest)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            if not os.path.isfile(path):
+                self._write(path, body)
+            self._write(index, f"{digest} {content_type}".encode("ascii"))
+            return path, content_type
+
+    @staticmethod
+    def snap_width(width):
+        """Round a requested width up to one we keep variants for"""
+        if not width:
+            return WIDTHS[-1]
+        return next((size for size in WIDTHS if size >= width), WIDTHS[-1])
+
+    def variant(self, url, width=None, mimetype="image/jpeg"):
+        """Path and type of the image at url, resized to width and recompressed"""
+        path, content_type = self.original(url)
+        if not self.can_resize or content_type in ("image/svg+xml", "image/gif"):
+            return path, content_type
+        image_format, ext, options = self.FORMATS.get(mimetype, self.FORMATS["image/jpeg"])
+        width = self.snap_width(width)
+        digest = os.path.basename(path)
+        target = os.path.join(self.directory, "variants", f"{digest}.w{width}.{ext}")
+        if os.path.isfile(target):
+            self._touch(target)
+            return target, mimetype
+        with self._key_lock(target):
+            if not os.path.isfile(target):
+                try:
+                    with Image.open(path) as image:
+                        image = image.convert("RGB")
+                        if image.width > width:
+                            image = image.resize(
+                                (width, round(image.height * width / image.width)),
+                                Image.LANCZOS)
+                        buffer = io.BytesIO()
+                        image.save(buffer, image_format, **options)
+                except (OSError, ValueError) as error:
+                    # Not something Pillow can read, serve it untouched.
+                    logger.warning("Cannot resize %s: %s", url, error)
+                    return path, content_type
+                self._write(target, buffer.getvalue())
+        return target, mimetype
+
+    def send(self, url, width=None, accept=None):
+        """Response with the best variant the client accepts"""
+        mimetype = "image/jpeg"
+        if accept is not None and accept["image/webp"] and "WEBP" in self._save_formats():
+            mimetype = "image/webp"
+        path, content_type = self.variant(url, width, mimetype)
+        response = send_file(path, mimetype=content_type, conditional=True,
+                             max_age=31536000)
+        response.headers["Cache-Control"] = IMMUTABLE
+        response.vary.add("Accept")
+        return response
+
+    @staticmethod
+    def _save_formats():
+        if Image is None:
+            return ()
+        Image.init()
+        return Image.SAVE
+
+    # Warming -----------------------------------------------------------------
+
+    def prefetch(self, url):
+        """Fetch and resize an image now, logging rather than raising failures"""
+        try:
+            self.original(url)
+            if self.can_resize:
+                for width in WIDTHS:
+                    for mimetype in self.FORMATS:
+                        self.variant(url, width, mimetype)
+        except FetchError as error:
+            logger.warning("Cannot fetch %s: %s", url, error)
+        except Exception:  # pylint: disable=broad-except
+            logger.exception("Warming %s failed", url)
@@ -0,0 +1,233 @@
+"""Durable background jobs, stored in a SQLite file and run by worker threads.
+
+Views enqueue a job by name with a JSON payload and return at once. Every
+gunicorn worker runs JOB_WORKERS threads that claim due jobs from the shared
+file, or `flask run-jobs` runs them in a process of its own. A job that
+raises is retried with exponential backoff and, after JOB_MAX_ATTEMPTS,
+kept as dead until `flask retry-jobs`. A claimed job whose worker died is
+taken up again once its lease runs out, so handlers must tolerate running
+twice.
+"""
+import json
+import os
+import random
+import sqlite3
+import threading
+import time
+import traceback
+from flask import request
+
+# WSGI environ key marking requests the app sends itself through a test
+# client, from a CLI command or a job, which must not start workers.
+INTERNAL_REQUEST = "blog.internal_request"
+
+# run_at is when a queued job is due, or when a running job's lease ends.
+# Dead jobs have no run_at, so they are never claimed.
+SCHEMA = ("CREATE TABLE IF NOT EXISTS jobs ("
+          "id INTEGER PRIMARY KEY, name TEXT NOT NULL, payload TEXT NOT NULL, "
+          "status TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, "
+          "run_at REAL, last_error TEXT, created REAL NOT NULL)")
+
+
+class JobQueue:
+    """Flask extension for enqueueing jobs and running them in the background"""
+
+    def __init__(self, app=None):
+        self.app = None
+        self.path = None
+        self.handlers = {}
+        self.workers = 1
+        self.max_attempts = 5
+        self.backoff = 2.0
+        self.max_backoff = 3600.0
+        self.lease = 300.0
+        self.poll_interval = 1.0
+        self._local = threading.local()
+        self._wakeup = threading.Event()
+        self._workers_pid = None
+        self._start_lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Read the JOB_* settings and start the worker threads with the first request"""
+        app.config.setdefault("JOB_QUEUE_PATH", os.path.join(app.instance_path, "jobs.sqlite3"))
+        app.config.setdefault("JOB_WORKERS", 1)
+        app.config.setdefault("JOB_MAX_ATTEMPTS", 5)
+        app.config.setdefault("JOB_BACKOFF", 2.0)
+        app.config.setdefault("JOB_MAX_BACKOFF", 3600.0)
+        app.config.setdefault("JOB_LEASE", 300.0)
+        app.config.setdefault("JOB_POLL_INTERVAL", 1.0)
+        self.app = app
+        self.path = app.config["JOB_QUEUE_PATH"]
+        self.workers = app.config["JOB_WORKERS"]
+        self.max_attempts = app.config["JOB_MAX_ATTEMPTS"]
+        self.backoff = app.config["JOB_BACKOFF"]
+        self.max_backoff = app.config["JOB_MAX_BACKOFF"]
+        self.lease = app.config["JOB_LEASE"]
+        self.poll_interval = app.config["JOB_POLL_INTERVAL"]
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        app.before_request(self._start_for_request)
+        app.extensions["job_queue"] = self
+
+    def handler(self, name):
+        """Decorator registering a function as the handler of jobs called name"""
+        def decorator(function):
+            self.handlers[name] = function
+            return function
+        return decorator
+
+    # Storage ---------------------------------------------------------------------
+
+    def _connection(self):
+        # One connection per thread, reopened after a fork.
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(SCHEMA)
+            conn.execute("CREATE INDEX IF NOT EXISTS ix_jobs_run_at ON jobs (run_at)")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def enqueue(self, name, payload=None, delay=0):
+        """Store a job for a worker to run after delay seconds, returns its id.
+
+        The handler is called with the payload dict as keyword arguments.
+        """
+        if name not in self.handlers:
+            raise ValueError(f"No handler for job {name!r}")
+        now = time.time()
+        cursor = self._connection().execute(
+            "INSERT INTO jobs (name, payload, status, run_at, created) "
+            "VALUES (?, ?, 'queued', ?, ?)", (name, json.dumps(payload or {}), now + delay, now))
+        # Only wakes this process's workers; a CLI command has none and
+        # leaves the job to the web workers or `flask run-jobs`.
+        self._wakeup.set()
+        return cursor.lastrowid
+
+    def claim(self):
+        """Take the next due job as (id, name, payload, attempts), or None"""
+        conn = self._connection()
+        now = time.time()
+        # BEGIN IMMEDIATE takes the write lock first, so two workers never
+        # pick the same row.
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT id, name, payload, attempts FROM jobs "
+                               "WHERE run_at <= ? ORDER BY run_at LIMIT 1", (now,)).fetchone()
+            if row is not None:
+                conn.execute("UPDATE jobs SET status = 'running', attempts = attempts + 1, "
+                             "run_at = ? WHERE id = ?", (now + self.lease, row[0]))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        if row is None:
+            return None
+        return row[0], row[1], json.loads(row[2]), row[3] + 1
+
+    def _retry_delay(self, attempts):
+        delay = min(self.backoff * 2 ** (attempts - 1), self.max_backoff)
+        # Jitter keeps jobs that failed together from retrying together.
+        return delay * random.uniform(1.0, 1.5)
+
+    def _failed(self, job_id, attempts, error):
+        if attempts >= self.max_attempts:
+            self._connection().execute(
+                "UPDATE jobs SET status = 'dead', run_at = NULL, last_error = ? WHERE id = ?",
+                (error, job_id))
+            return "dead"
+        self._connection().execute(
+            "UPDATE jobs SET status = 'queued', run_at = ?, last_error = ? WHERE id = ?",
+            (time.time() + self._retry_delay(attempts), error, job_id))
+        return "retry"
+
+    # Running -----------------------------------------------------------------------
+
+    def run_next(self):
+        """Claim and run one due job, returns whether there was one"""
+        job = self.claim()
+        if job is None:
+            return False
+        job_id, name, payload, attempts = job
+        started = time.perf_counter()
+        handler = self.handlers.get(name)
+        if handler is None:
+            outcome = self._failed(job_id, self.max_attempts, f"No handler for job {name!r}")
+        else:
+            try:
+                with self.app.app_context():
+                    handler(**payload)
+            except Exception:  # pylint: disable=broad-except
+                outcome = self._failed(job_id, attempts, traceback.format_exc())
+                self.app.logger.warning("Job %s %s failed (attempt %d, %s)",
+                                        job_id, name, attempts, outcome, exc_info=True)
+            else:
+                self._connection().execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+                outcome = "done"
+        metrics = self.app.extensions.get("metrics")
+        if metrics is not None:
+            metrics.observe_job(name, outcome, time.perf_counter() - started)
+        return True
+
+    def run_pending(self):
+        """Run jobs until none is due, returns how many ran"""
+        count = 0
+        while self.run_next():
+            count += 1
+        return count
+
+    def work(self, stop=None):
+        """Run jobs as they fall due until stop is set"""
+        while stop is None or not stop.is_set():
+            try:
+                if self.run_next():
+                    continue
+            except Exception:  # pylint: disable=broad-except
+                self.app.logger.exception("Claiming a job failed")
+            self._wakeup.wait(self.poll_interval)
+            self._wakeup.clear()
+
+    def _start_for_request(self):
+        if not request.environ.get(INTERNAL_REQUEST):
+            self._start_workers()
+
+    def _start_workers(self):
+        # Started by the first request so each forked worker gets its own
+        # threads, and CLI commands that build the app or enqueue start none.
+        if not self.workers or self._workers_pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._workers_pid == os.getpid():
+                return
+            self._workers_pid = os.getpid()
+            for number in range(self.workers):
+                threading.Thread(target=self.work, name=f"job-worker-{number}",
+                                 daemon=True).start()
+
+    # Inspection ----------------------------------------------------------------------
+
+    def stats(self):
+        """Job counts by status"""
+        rows = self._connection().execute(
+            "SELECT status, count(*) FROM jobs GROUP BY status").fetchall()
+        return {"queued": 0, "running": 0, "dead": 0, **dict(rows)}
+
+    def dead(self, limit=20):
+        """(id, name, attempts, last error) of the most recent dead jobs"""
+        return self._connection().execute(
+            "SELECT id, name, attempts, last_error FROM jobs WHERE status = 'dead' "
+            "ORDER BY id DESC LIMIT ?", (limit,)).fetchall()
+
+    def retry_dead(self):
+        """Queue every dead job again with fresh attempts, returns how many"""
+        cursor = self._connection().execute(
+            "UPDATE jobs SET status = 'queued', attempts = 0, run_at = ? "
+            "WHERE status = 'dead'", (time.time(),))
+        self._wakeup.set()
+        return cursor.rowcount
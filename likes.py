@@ -0,0 +1,128 @@
+"""Buffered comment likes, flushed to the database as bulk upserts"""
+import atexit
+import os
+import threading
+import time
+from sqlalchemy import bindparam, delete, func, insert, select, update
+from sqlalchemy.dialects import postgresql, sqlite
+from signals import likes_flushed
+
+
+def insert_ignoring_duplicates(conn, table):
+    """INSERT that skips rows already covered by the (comment_id, user_id) index"""
+    name = conn.dialect.name
+    if name == "postgresql":
+        return postgresql.insert(table).on_conflict_do_nothing(
+            index_elements=["comment_id", "user_id"])
+    if name == "sqlite":
+        return sqlite.insert(table).on_conflict_do_nothing(
+            index_elements=["comment_id", "user_id"])
+    # MySQL/MariaDB spelling.
+    return insert(table).prefix_with("IGNORE")
+
+
+class LikeBuffer:
+    """Collects like/unlike clicks in memory and writes them in batches.
+
+    Only the latest wish per (comment, user) is kept, so repeated or
+    concurrent clicks collapse into one row change, and the unique index
+    makes the flush idempotent across workers. A flush happens when
+    LIKE_BUFFER_SIZE clicks are waiting, or every LIKE_FLUSH_INTERVAL
+    seconds from a background thread, and once more at exit.
+    """
+
+    def __init__(self, app=None, db=None):
+        self.app = None
+        self.db = db
+        self.max_size = 200
+        self.interval = 2.0
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._thread_pid = None
+        if app is not None:
+            self.init_app(app, db)
+
+    def init_app(self, app, db):
+        """Read LIKE_BUFFER_SIZE and LIKE_FLUSH_INTERVAL"""
+        app.config.setdefault("LIKE_BUFFER_SIZE", 200)
+        app.config.setdefault("LIKE_FLUSH_INTERVAL", 2.0)
+        self.app = app
+        self.db = db
+        self.max_size = app.config["LIKE_BUFFER_SIZE"]
+        self.interval = app.config["LIKE_FLUSH_INTERVAL"]
+        app.extensions["like_buffer"] = self
+        atexit.register(self.flush)
+
+    def _start_flusher(self):
+        # Started lazily so each forked worker gets its own thread.
+        if self._thread_pid == os.getpid():
+            return
+        self._thread_pid = os.getpid()
+        thread = threading.Thread(target=self._run, name="like-flusher", daemon=True)
+        thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception:  # pylint: disable=broad-except
+                self.app.logger.exception("Flushing comment likes failed")
+
+    def set(self, comment_id, user_id, liked):
+        """Record that the user wants the comment liked (True) or not (False)"""
+        with self._lock:
+            self._pending[(comment_id, user_id)] = liked
+            full = len(self._pending) >= self.max_size
+        self._start_flusher()
+        if full:
+            self.flush()
+
+    def pending_for(self, user_id):
+        """Unflushed wishes of one user, as {comment_id: liked}"""
+        with self._lock:
+            return {comment_id: liked
+                    for (comment_id, owner), liked in self._pending.items()
+                    if owner == user_id}
+
+    def flush(self):
+        """Write every waiting click in one transaction, returns the comment ids touched"""
+        with self._flush_lock:
+            with self._lock:
+                batch, self._pending = self._pending, {}
+            if not batch:
+                return set()
+            try:
+                post_ids = self._write(batch)
+            except Exception:
+                # Put the clicks back unless newer ones arrived meanwhile.
+                with self._lock:
+                    for key, liked in batch.items():
+                        self._pending.setdefault(key, liked)
+                raise
+        likes_flushed.send(self.app, post_ids=post_ids)
+        return {comment_id for comment_id, _ in batch}
+
+    def _write(self, batch):
+        with self.app.app_context():
+            tables = self.db.metadata.tables
+            likes, comments = tables["likes"], tables["comments"]
+            added = [{"comment_id": comment_id, "user_id": user_id}
+                     for (comment_id, user_id), liked in batch.items() if liked]
+            removed = [{"c": comment_id, "u": user_id}
+                       for (comment_id, user_id), liked in batch.items() if not liked]
+            touched = sorted({comment_id for comment_id, _ in batch})
+            with self.db.engine.begin() as conn:
+                if added:
+                    conn.execute(insert_ignoring_duplicates(conn, likes), added)
+                if removed:
+                    conn.execute(delete(likes).where(likes.c.comment_id == bindparam("c"),
+                                                     likes.c.user_id == bindparam("u")),
+                                 removed)
+                count = (select(func.count()).where(likes.c.comment_id == comments.c.id)
+                         .scalar_subquery())
+                conn.execute(update(comments).where(comments.c.id.in_(touched))
+                             .values(like_count=count))
+                return set(conn.scalars(select(comments.c.post_id).distinct()
+                                        .where(comments.c.id.in_(touched))))
@@ -0,0 +1,311 @@
+"""Request, SQL, template and bcrypt timings in Prometheus text format.
+
+Each worker keeps its own histograms and counters in memory, and writes a
+snapshot to METRICS_DIR every METRICS_FLUSH_INTERVAL seconds. /metrics
+merges the snapshots of every worker on the host, so whichever worker a
+scrape lands on reports the same totals. Snapshots of workers that have
+exited are folded into archive.json, so the totals never go backwards when
+a worker restarts or its PID is reused. Requests slower than
+METRICS_SLOW_REQUEST_MS are logged as one JSON line with their slowest
+statements.
+"""
+import fcntl
+import hmac
+import json
+import os
+import tempfile
+import threading
+import time
+from flask import current_app, g, has_request_context, request, template_rendered, \
+    before_render_template
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (1, 2, 3, 5, 8, 13, 21, 34, 55, 89)
+
+HELP = {
+    "http_requests_total": ("counter", "Requests answered, by endpoint and status"),
+    "http_request_duration_seconds": ("histogram", "Time spent handling a request"),
+    "db_statements_per_request": ("histogram", "SQL statements run by one request"),
+    "db_time_seconds_total": ("counter", "Time spent in SQL statements"),
+    "template_render_seconds": ("histogram", "Time spent rendering a template"),
+    "bcrypt_seconds": ("histogram", "Time a bcrypt hash or check took, queueing included"),
+    "jobs_total": ("counter", "Background jobs run, by name and outcome"),
+    "job_duration_seconds": ("histogram", "Time a background job took to run"),
+}
+
+
+class Registry:
+    """Thread-safe histograms and counters keyed by name and label values"""
+
+    def __init__(self):
+        self.histograms = {}
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    def observe(self, name, labels, value, buckets=LATENCY_BUCKETS):
+        """Add one observation to a histogram"""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            entry = self.histograms.get(key)
+            if entry is None:
+                entry = self.histograms[key] = [list(buckets), [0] * len(buckets), 0.0, 0]
+            for index, bound in enumerate(entry[0]):
+                if value <= bound:
+                    entry[1][index] += 1
+                    break
+            entry[2] += value
+            entry[3] += 1
+
+    def inc(self, name, labels, amount=1):
+        """Add to a counter"""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def snapshot(self):
+        """JSON-friendly copy of everything recorded so far"""
+        with self._lock:
+            return {"histograms": [[name, list(map(list, labels)), list(bounds), list(counts),
+                                    total, count]
+                                   for (name, labels), (bounds, counts, total, count)
+                                   in self.histograms.items()],
+                    "counters": [[name, list(map(list, labels)), value]
+                                 for (name, labels), value in self.counters.items()]}
+
+    @staticmethod
+    def merge(snapshots):
+        """Sum snapshots of several workers into one"""
+        histograms, counters = {}, {}
+        for snapshot in snapshots:
+            for name, labels, bounds, counts, total, count in snapshot["histograms"]:
+                key = (name, tuple(map(tuple, labels)), tuple(bounds))
+                entry = histograms.setdefault(key, [[0] * len(bounds), 0.0, 0])
+                entry[0] = [a + b for a, b in zip(entry[0], counts)]
+                entry[1] += total
+                entry[2] += count
+            for name, labels, value in snapshot["counters"]:
+                key = (name, tuple(map(tuple, labels)))
+                counters[key] = counters.get(key, 0) + value
+        return histograms, counters
+
+    @staticmethod
+    def as_snapshot(histograms, counters):
+        """Snapshot holding what merge() returned"""
+        return {"histograms": [[name, list(map(list, labels)), list(bounds), counts, total, count]
+                               for (name, labels, bounds), (counts, total, count)
+                               in histograms.items()],
+                "counters": [[name, list(map(list, labels)), value]
+                             for (name, labels), value in counters.items()]}
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(pairs, extra=()):
+    text = ",".join(f'{key}="{_escape(value)}"' for key, value in (*pairs, *extra))
+    return f"{{{text}}}" if text else ""
+
+
+def render(histograms, counters):
+    """Prometheus text exposition of merged metrics"""
+    lines, described = [], set()
+
+    def describe(name):
+        if name not in described and name in HELP:
+            kind, text = HELP[name]
+            lines.append(f"# HELP {name} {text}")
+            lines.append(f"# TYPE {name} {kind}")
+            described.add(name)
+
+    for (name, labels), value in sorted(counters.items()):
+        describe(name)
+        lines.append(f"{name}{_labels(labels)} {value:g}")
+    for (name, labels, bounds), (counts, total, count) in sorted(histograms.items()):
+        describe(name)
+        cumulative = 0
+        for bound, bucket in zip(bounds, counts):
+            cumulative += bucket
+            lines.append(f"{name}_bucket{_labels(labels, [('le', f'{bound:g}')])} {cumulative}")
+        lines.append(f"{name}_bucket{_labels(labels, [('le', '+Inf')])} {count}")
+        lines.append(f"{name}_sum{_labels(labels)} {total:.6f}")
+        lines.append(f"{name}_count{_labels(labels)} {count}")
+    return "\n".join(lines) + "\n"
+
+
+class Metrics:
+    """Flask extension recording per-request timings.
+
+    Statement counts and DB time come from the request's QueryCounter
+    (set up by QueryBudget as g.query_counter).
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.registry = Registry()
+        self.directory = None
+        self._flushed = 0.0
+        self._pid = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Read the METRICS_* settings and hook into requests and templates"""
+        app.config.setdefault("METRICS_DIR", os.path.join(app.instance_path, "metrics"))
+        app.config.setdefault("METRICS_FLUSH_INTERVAL", 5)
+        app.config.setdefault("METRICS_SLOW_REQUEST_MS", 500)
+        app.config.setdefault("METRICS_SLOW_QUERIES", 5)
+        app.config.setdefault("METRICS_TOKEN", None)
+        self.app = app
+        self.directory = app.config["METRICS_DIR"]
+        os.makedirs(self.directory, exist_ok=True)
+        self.archive_dead()
+        app.before_request(self._start)
+        app.after_request(self._finish)
+        before_render_template.connect(self._template_started, app)
+        template_rendered.connect(self._template_finished, app)
+        app.extensions["metrics"] = self
+
+    # Request hooks -------------------------------------------------------------
+
+    @staticmethod
+    def _start():
+        g.metrics_started = time.perf_counter()
+        g.metrics_templates = []
+        g.metrics_bcrypt = 0.0
+
+    def _finish(self, response):
+        started = g.get("metrics_started")
+        if started is None:
+            return response
+        elapsed = time.perf_counter() - started
+        endpoint = request.endpoint or "unmatched"
+        self.registry.inc("http_requests_total",
+                          {"endpoint": endpoint, "status": response.status_code})
+        self.registry.observe("http_request_duration_seconds",
+                              {"endpoint": endpoint, "method": request.method}, elapsed)
+        counter = g.get("query_counter")
+        if counter is not None:
+            self.registry.observe("db_statements_per_request", {"endpoint": endpoint},
+                                  counter.count, COUNT_BUCKETS)
+            self.registry.inc("db_time_seconds_total", {"endpoint": endpoint},
+                              counter.total_time)
+        if elapsed * 1000 >= self.app.config["METRICS_SLOW_REQUEST_MS"]:
+            self._log_slow(endpoint, response, elapsed, counter)
+        if time.monotonic() - self._flushed >= self.app.config["METRICS_FLUSH_INTERVAL"]:
+            self.flush()
+        return response
+
+    def _log_slow(self, endpoint, response, elapsed, counter):
+        slowest = counter.slowest(self.app.config["METRICS_SLOW_QUERIES"]) if counter else []
+        self.app.logger.warning(json.dumps({
+            "event": "slow_request", "method": request.method, "path": request.path,
+            "endpoint": endpoint, "status": response.status_code,
+            "duration_ms": round(elapsed * 1000, 1),
+            "db_statements": counter.count if counter else None,
+            "db_ms": round(counter.total_time * 1000, 1) if counter else None,
+            "template_ms": round(sum(took for _, took in g.metrics_templates) * 1000, 1),
+            "bcrypt_ms": round(g.metrics_bcrypt * 1000, 1),
+            "slowest_queries": [{"ms": round(took * 1000, 1),
+                                 "statement": " ".join(statement.split())[:500]}
+                                for took, statement in slowest],
+        }))
+
+    def _template_started(self, sender, template, context, **extra):
+        if has_request_context() and "metrics_templates" in g:
+            g.setdefault("metrics_render_stack", []).append(time.perf_counter())
+
+    def _template_finished(self, sender, template, context, **extra):
+        stack = g.get("metrics_render_stack") if has_request_context() else None
+        if not stack:
+            return
+        took = time.perf_counter() - stack.pop()
+        g.metrics_templates.append((template.name, took))
+        self.registry.observe("template_render_seconds", {"template": template.name}, took)
+
+    def observe_bcrypt(self, operation, seconds):
+        """Called by PasswordHasher after every hash or check"""
+        self.registry.observe("bcrypt_seconds", {"operation": operation}, seconds)
+        if has_request_context() and "metrics_bcrypt" in g:
+            g.metrics_bcrypt += seconds
+
+    def observe_job(self, name, outcome, seconds):
+        """Called by JobQueue after every job it runs"""
+        self.registry.inc("jobs_total", {"job": name, "outcome": outcome})
+        self.registry.observe("job_duration_seconds", {"job": name}, seconds)
+        # `flask run-jobs` answers no requests, so it flushes from here.
+        if time.monotonic() - self._flushed >= self.app.config["METRICS_FLUSH_INTERVAL"]:
+            self.flush()
+
+    # Exposition ------------------------------------------------------------------
+
+    def _read(self, path):
+        try:
+            with open(path, encoding="utf-8") as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return None
+
+    def _write(self, path, snapshot):
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as file:
+            json.dump(snapshot, file)
+        os.replace(tmp_path, path)
+
+    def _archive(self, paths):
+        # One archiver at a time, or two could each add the same snapshot.
+        with open(os.path.join(self.directory, ".archive.lock"), "w", encoding="utf-8") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            archive = os.path.join(self.directory, "archive.json")
+            snapshots = [self._read(path) for path in paths]
+            if not any(snapshots):
+                return
+            previous = self._read(archive)
+            merged = Registry.merge(filter(None, [previous, *snapshots]))
+            self._write(archive, Registry.as_snapshot(*merged))
+            for path in paths:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def archive_dead(self):
+        """Fold the snapshots of exited processes into archive.json"""
+        dead = []
+        for entry in os.scandir(self.directory):
+            pid, ext = os.path.splitext(entry.name)
+            if ext != ".json" or not pid.isdigit() or int(pid) == os.getpid():
+                continue
+            try:
+                os.kill(int(pid), 0)
+            except ProcessLookupError:
+                dead.append(entry.path)
+            except PermissionError:
+                pass
+        if dead:
+            self._archive(dead)
+
+    def flush(self):
+        """Write this worker's snapshot for the others to read"""
+        self._flushed = time.monotonic()
+        path = os.path.join(self.directory, f"{os.getpid()}.json")
+        if self._pid != os.getpid():
+            # A file under our PID was left by an earlier process that had it.
+            if os.path.exists(path):
+                self._archive([path])
+            self._pid = os.getpid()
+        self._write(path, self.registry.snapshot())
+
+    def authorized(self):
+        """Whether the request carries METRICS_TOKEN as a bearer token"""
+        token = current_app.config["METRICS_TOKEN"]
+        header = request.headers.get("Authorization", "")
+        return bool(token) and hmac.compare_digest(header, f"Bearer {token}")
+
+    def exposition(self):
+        """Prometheus text for every worker on this host"""
+        self.flush()
+        self.archive_dead()
+        snapshots = [self._read(entry.path) for entry in os.scandir(self.directory)
+                     if entry.name.endswith(".json")]
+        return render(*Registry.merge(filter(None, snapshots)))
@@ -0,0 +1,102 @@
+"""Versioned in-place schema upgrades for existing databases.
+
+db.create_all() only creates missing tables, it never alters the ones an
+older release already made in posts.db or Postgres. Each step below brings
+a database up by one version, and the applied version is kept in the
+schema_version table. Steps must also be safe to run on a fresh database
+that create_all() already built with the new columns.
+"""
+from sqlalchemy import column, inspect, table, text
+import avatars
+import search
+
+
+def add_column(conn, table, name, ddl):
+    """ALTER TABLE ... ADD COLUMN, unless the column is already there"""
+    columns = {column["name"] for column in inspect(conn).get_columns(table)}
+    if name not in columns:
+        conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {name} {ddl}"))
+
+
+def add_sanitized_columns(conn):
+    """Excerpt, word count and sanitizer policy version stored at write time"""
+    add_column(conn, "blog_post", "excerpt", "TEXT")
+    add_column(conn, "blog_post", "word_count", "INTEGER NOT NULL DEFAULT 0")
+    add_column(conn, "blog_post", "sanitized_version", "INTEGER NOT NULL DEFAULT 0")
+    add_column(conn, "comments", "word_count", "INTEGER NOT NULL DEFAULT 0")
+    add_column(conn, "comments", "sanitized_version", "INTEGER NOT NULL DEFAULT 0")
+
+
+def add_search_index(conn):
+    """Full-text index over posts, filled from the existing rows"""
+    search.create_index(conn)
+    search.rebuild(conn)
+
+
+def recount(conn):
+    """Recompute the comment and like counters from the rows themselves"""
+    conn.execute(text("UPDATE blog_post SET comment_count = (SELECT count(*) "
+                      "FROM comments WHERE comments.post_id = blog_post.id)"))
+    conn.execute(text("UPDATE comments SET like_count = (SELECT count(*) "
+                      "FROM likes WHERE likes.comment_id = comments.id)"))
+
+
+def add_indexes_and_counters(conn):
+    """Secondary indexes, unique likes, and maintained comment/like counts"""
+    add_column(conn, "blog_post", "comment_count", "INTEGER NOT NULL DEFAULT 0")
+    add_column(conn, "comments", "like_count", "INTEGER NOT NULL DEFAULT 0")
+    for name, table, column in [("ix_blog_post_date", "blog_post", "date"),
+                                ("ix_blog_post_uploader_id", "blog_post", "uploader_id"),
+                                ("ix_comments_post_id", "comments", "post_id"),
+                                ("ix_comments_author_id", "comments", "author_id"),
+                                ("ix_likes_user_id", "likes", "user_id")]:
+        conn.execute(text(f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({column})"))
+    # Keep the first like of any duplicates so the unique index can be built.
+    conn.execute(text("DELETE FROM likes WHERE id NOT IN "
+                      "(SELECT min(id) FROM likes GROUP BY comment_id, user_id)"))
+    conn.execute(text("CREATE UNIQUE INDEX IF NOT EXISTS uq_likes_comment_user "
+                      "ON likes (comment_id, user_id)"))
+    recount(conn)
+
+
+def add_avatar_hash(conn):
+    """Gravatar hash stored per user instead of hashed on every render"""
+    add_column(conn, "users", "avatar_hash", "VARCHAR(32)")
+    avatars.backfill(conn, table("users", column("id"), column("email"),
+                                 column("avatar_hash")))
+
+
+def add_comment_thread_index(conn):
+    """Index the comment pages of a post are read from, newest first"""
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_comments_post_created "
+                      "ON comments (post_id, date_created, id)"))
+
+
+MIGRATIONS = [
+    add_sanitized_columns,
+    add_search_index,
+    add_indexes_and_counters,
+    add_avatar_hash,
+    add_comment_thread_index,
+]
+
+
+def current_version(conn):
+    """Schema version recorded in the database, 0 if none"""
+    conn.execute(text("CREATE TABLE IF NOT EXISTS schema_version "
+                      "(version INTEGER NOT NULL)"))
+    return conn.execute(text("SELECT max(version) FROM schema_version")).scalar() or 0
+
+
+def upgrade(engine):
+    """Apply every migration newer than the recorded version"""
+    with engine.begin() as conn:
+        version = current_version(conn)
+        for number, step in enumerate(MIGRATIONS, start=1):
+            if number <= version:
+                continue
+            step(conn)
+            conn.execute(text("INSERT INTO schema_version (version) VALUES (:v)"),
+                         {"v": number})
+            version = number
+    return version
@@ -0,0 +1,101 @@
+"""Database-level pagination for the blog listings"""
+import datetime
+import threading
+import time
+from sqlalchemy import select, tuple_
+
+PER_PAGE = 10
+
+
+class CachedCount:
+    """Row count kept in memory for a short time and reset on writes"""
+
+    def __init__(self, ttl=30):
+        self.ttl = ttl
+        self._value = None
+        self._expires = 0.0
+        self._lock = threading.Lock()
+
+    def get(self, load):
+        """Return the cached count, calling load() when it is missing or stale"""
+        now = time.monotonic()
+        with self._lock:
+            if self._value is not None and now < self._expires:
+                return self._value
+        value = load()
+        with self._lock:
+            self._value = value
+            self._expires = now + self.ttl
+        return value
+
+    def invalidate(self):
+        """Forget the cached count so the next read hits the database"""
+        with self._lock:
+            self._value = None
+
+
+def fetch_page(session, model, page=0, before=None, after=None,
+               per_page=PER_PAGE, options=(), criteria=(), query=None):
+    """Fetch one page of rows, newest first.
+
+    With a `before` or `after` id the page is found with an indexed seek on the
+    primary key, so deep pages cost the same as the first one. Without a cursor
+    it falls back to LIMIT/OFFSET on the page number. `criteria` narrows the
+    rows, e.g. to the comments of one post. `query`, a select() of just the
+    columns a page needs, is paged instead of whole model objects and its
+    rows are returned as they are.
+    """
+    stmt = select(model).options(*options) if query is None else query
+    stmt = stmt.where(*criteria)
+    if before is not None:
+        stmt = stmt.where(model.id < before).order_by(model.id.desc())
+    elif after is not None:
+        stmt = stmt.where(model.id > after).order_by(model.id.asc())
+    else:
+        stmt = stmt.order_by(model.id.desc()).offset(max(page, 0) * per_page)
+    result = session.execute(stmt.limit(per_page))
+    rows = list(result.scalars() if query is None else result)
+    if before is None and after is not None:
+        rows.reverse()
+    return rows
+
+
+def fetch_keyset(session, model, column, cursor=None, per_page=PER_PAGE,
+                 options=(), criteria=()):
+    """Fetch one page of rows ordered by column then id, newest first.
+
+    cursor is the (column value, id) of the last row already shown, and the
+    page after it is found with a seek on an index over the criteria columns,
+    column and id. Returns the rows and the cursor of the page after them,
+    None when this is the last one.
+    """
+    stmt = select(model).options(*options).where(*criteria)
+    if cursor is not None:
+        stmt = stmt.where(tuple_(column, model.id) < tuple_(*cursor))
+    # One row more than a page tells whether there is a next page.
+    rows = list(session.scalars(stmt.order_by(column.desc(), model.id.desc())
+                                .limit(per_page + 1)))
+    if len(rows) <= per_page:
+        return rows, None
+    rows = rows[:per_page]
+    return rows, (getattr(rows[-1], column.key), rows[-1].id)
+
+
+def encode_cursor(cursor):
+    """(datetime, id) cursor as a query string value"""
+    value, row_id = cursor
+    return f"{value.isoformat()}_{row_id}"
+
+
+def decode_cursor(text):
+    """(datetime, id) cursor from encode_cursor(), None if missing or malformed"""
+    try:
+        value, row_id = text.rsplit("_", 1)
+        return datetime.datetime.fromisoformat(value), int(row_id)
+    except (AttributeError, ValueError):
+        return None
+
+
+def last_page(total, per_page=PER_PAGE):
+    """Number of the last page, the home page being page 0"""
+    return max(0, (total - 1) // per_page)
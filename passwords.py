@@ -0,0 +1,146 @@
+"""Bounded bcrypt hashing and login attempt throttling"""
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+
+
+class HasherBusy(Exception):
+    """Raised when the bcrypt queue is full or a hash times out, answered with a 503"""
+
+
+class PasswordHasher:
+    """Runs bcrypt on a small fixed pool of threads.
+
+    bcrypt releases the GIL while hashing, so a pool sized to the CPU budget
+    caps how many hashes a worker runs at once. Callers over the queue limit
+    get HasherBusy straight away instead of piling up behind a login burst,
+    and so do callers whose hash is still waiting after BCRYPT_TIMEOUT.
+    """
+
+    def __init__(self, app=None, bcrypt=None):
+        self.app = None
+        self.bcrypt = bcrypt
+        self.rounds = 12
+        self.timeout = None
+        self.threads = 2
+        self._executor = None
+        self._executor_pid = None
+        self._slots = None
+        self._pool_lock = threading.Lock()
+        if app is not None:
+            self.init_app(app, bcrypt)
+
+    def init_app(self, app, bcrypt):
+        """Size the pool from BCRYPT_THREADS and BCRYPT_QUEUE_DEPTH"""
+        app.config.setdefault("BCRYPT_LOG_ROUNDS", 12)
+        app.config.setdefault("BCRYPT_THREADS", 2)
+        app.config.setdefault("BCRYPT_QUEUE_DEPTH", 8)
+        app.config.setdefault("BCRYPT_TIMEOUT", 10)
+        self.app = app
+        self.bcrypt = bcrypt
+        self.rounds = app.config["BCRYPT_LOG_ROUNDS"]
+        self.timeout = app.config["BCRYPT_TIMEOUT"]
+        self.threads = app.config["BCRYPT_THREADS"]
+        self._slots = threading.BoundedSemaphore(
+            self.threads + app.config["BCRYPT_QUEUE_DEPTH"])
+        app.extensions["password_hasher"] = self
+
+    def _pool(self):
+        # Created on first use so each forked worker gets its own threads.
+        if self._executor_pid != os.getpid():
+            with self._pool_lock:
+                if self._executor_pid != os.getpid():
+                    self._executor = ThreadPoolExecutor(max_workers=self.threads,
+                                                        thread_name_prefix="bcrypt")
+                    self._executor_pid = os.getpid()
+        return self._executor
+
+    def _run(self, operation, function, *args):
+        if not self._slots.acquire(blocking=False):
+            raise HasherBusy()
+        started = time.perf_counter()
+        try:
+            future = self._pool().submit(function, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        # The slot is held until the hash is done, not until the caller gives
+        # up waiting, so timed-out hashes still count against the queue.
+        future.add_done_callback(lambda _: self._slots.release())
+        try:
+            return future.result(self.timeout)
+        except FutureTimeout:
+            future.cancel()
+            raise HasherBusy() from None
+        finally:
+            metrics = self.app.extensions.get("metrics") if self.app else None
+            if metrics is not None:
+                metrics.observe_bcrypt(operation, time.perf_counter() - started)
+
+    def hash(self, password):
+        """bcrypt hash of the password at the target cost"""
+        return self._run("hash", self.bcrypt.generate_password_hash,
+                         password, self.rounds).decode("utf-8")
+
+    def check(self, pw_hash, password):
+        """Whether the password matches the stored hash"""
+        return self._run("check", self.bcrypt.check_password_hash, pw_hash, password)
+
+    def needs_rehash(self, pw_hash):
+        """Whether a stored hash was made with a different cost than the target"""
+        try:
+            return int(pw_hash.split("$")[2]) != self.rounds
+        except (IndexError, ValueError):
+            return True
+
+
+class AttemptThrottle:
+    """Sliding-window attempt counter per key (an IP or an email), per worker"""
+
+    def __init__(self, limit, window, max_keys=10000):
+        self.limit = limit
+        self.window = window
+        self.max_keys = max_keys
+        self._attempts = {}
+        self._lock = threading.Lock()
+
+    def _recent(self, key, now):
+        attempts = self._attempts.get(key)
+        if attempts is None:
+            return None
+        while attempts and attempts[0] <= now - self.window:
+            attempts.popleft()
+        return attempts
+
+    def allow(self, key):
+        """Whether another attempt for this key is allowed right now"""
+        with self._lock:
+            attempts = self._recent(key, time.monotonic())
+            return attempts is None or len(attempts) < self.limit
+
+    def hit(self, key):
+        """Record an attempt for this key"""
+        now = time.monotonic()
+        with self._lock:
+            attempts = self._recent(key, now)
+            if attempts is None:
+                if len(self._attempts) >= self.max_keys:
+                    self._forget_idle(now)
+                attempts = self._attempts[key] = deque()
+            attempts.append(now)
+
+    def reset(self, key):
+        """Forget the attempts for this key, e.g. after a successful login"""
+        with self._lock:
+            self._attempts.pop(key, None)
+
+    def _forget_idle(self, now):
+        for key in list(self._attempts):
+            if not self._recent(key, now):
+                del self._attempts[key]
+        # Still full of active keys: drop the oldest half rather than grow.
+        if len(self._attempts) >= self.max_keys:
+            for key in list(self._attempts)[:self.max_keys // 2]:
+                del self._attempts[key]
@@ -0,0 +1,121 @@
+"""Static copies of the public pages, for nginx or object storage to serve.
+
+`flask prerender` renders the listings, every post, the about page, the feed
+and the sitemaps through the app as an anonymous visitor would see them,
+and copies the static files and the fingerprinted assets beside them. Each
+page is written to a file named after its URL (/post/3 -> post/3/index.html),
+so a web server can map URLs straight onto the directory.
+
+Pages are rendered with RENDERING set in the WSGI environ, and then link
+nothing the copy lacks: post backgrounds and avatars point at their
+original remote URLs instead of the image proxy, and a post page carries
+all its comments instead of fetching later pages from the app.
+
+server.py describes every page with a fingerprint of what it shows, taken
+from a couple of bulk queries. The fingerprints of the last build are kept
+in the output directory, and a rebuild only renders the pages whose
+fingerprint changed and deletes the pages that no longer exist.
+"""
+import fcntl
+import json
+import os
+import shutil
+
+MANIFEST = ".prerender.json"
+
+# WSGI environ key set on the requests a build renders pages with.
+RENDERING = "blog.prerender"
+
+
+def output_path(out_dir, path):
+    """File holding the page at a URL path: "/" -> index.html, "/feed.xml" -> feed.xml"""
+    name = path.strip("/")
+    if not os.path.splitext(name)[1]:
+        name = os.path.join(name, "index.html")
+    return os.path.join(out_dir, name)
+
+
+def write_file(path, data):
+    """Replace a file atomically, so the web server never sends half a page"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as handle:
+        handle.write(data)
+    os.replace(tmp, path)
+
+
+def remove_file(out_dir, path):
+    """Delete a page's file and any directories it leaves empty"""
+    target = output_path(out_dir, path)
+    try:
+        os.remove(target)
+    except FileNotFoundError:
+        return
+    directory = os.path.dirname(target)
+    while directory != out_dir and not os.listdir(directory):
+        os.rmdir(directory)
+        directory = os.path.dirname(directory)
+
+
+def copy_tree(source, target, skip=()):
+    """Copy the files that are missing or differ in size or mtime, returns how many"""
+    copied = 0
+    for root, dirs, files in os.walk(source):
+        dirs[:] = [name for name in dirs
+                   if os.path.join(root, name) not in skip]
+        for name in files:
+            src = os.path.join(root, name)
+            dst = os.path.join(target, os.path.relpath(src, source))
+            try:
+                stat = os.stat(dst)
+            except FileNotFoundError:
+                stat = None
+            mine = os.stat(src)
+            if stat is not None and stat.st_size == mine.st_size \
+                    and int(stat.st_mtime) == int(mine.st_mtime):
+                continue
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            shutil.copy2(src, dst)
+            copied += 1
+    return copied
+
+
+def load_manifest(out_dir):
+    """{URL path: fingerprint} of the pages the last build wrote"""
+    try:
+        with open(os.path.join(out_dir, MANIFEST), encoding="utf-8") as handle:
+            return json.load(handle)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def build(out_dir, pages, render, full=False):
+    """Render the pages whose fingerprint changed since the last build.
+
+    pages maps URL paths to fingerprints; render(path) returns the page's
+    bytes, or None when it should not exist. Returns how many pages there
+    are and how many were rendered and removed.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    # One build at a time, whether from the CLI or a background job.
+    with open(os.path.join(out_dir, ".prerender.lock"), "w", encoding="utf-8") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        previous = load_manifest(out_dir)
+        built = {}
+        rendered = 0
+        for path, fingerprint in pages.items():
+            if not full and previous.get(path) == fingerprint \
+                    and os.path.exists(output_path(out_dir, path)):
+                built[path] = fingerprint
+                continue
+            body = render(path)
+            if body is None:
+                continue
+            write_file(output_path(out_dir, path), body)
+            built[path] = fingerprint
+            rendered += 1
+        removed = [path for path in previous if path not in built]
+        for path in removed:
+            remove_file(out_dir, path)
+        write_file(os.path.join(out_dir, MANIFEST), json.dumps(built).encode("utf-8"))
+    return {"pages": len(built), "rendered": rendered, "removed": len(removed)}
@@ -0,0 +1,125 @@
+"""Per-request SQL statement counting and query budgets"""
+import threading
+import time
+from flask import current_app, g, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+_local = threading.local()
+
+
+class QueryBudgetExceeded(RuntimeError):
+    """Raised in strict mode when a route runs more queries than allowed"""
+
+
+def _active_counters():
+    if not hasattr(_local, "counters"):
+        _local.counters = []
+    return _local.counters
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _count_statement(conn, cursor, statement, parameters, context, executemany):
+    for counter in _active_counters():
+        counter.statements.append(statement)
+    conn.info.setdefault("statement_started", []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _time_statement(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info.get("statement_started")
+    if not started:
+        return
+    elapsed = time.perf_counter() - started.pop()
+    for counter in _active_counters():
+        counter.timings.append((elapsed, statement))
+
+
+class QueryCounter:
+    """Context manager that records every statement run on this thread"""
+
+    def __init__(self):
+        self.statements = []
+        self.timings = []
+
+    @property
+    def count(self):
+        """Number of statements seen so far"""
+        return len(self.statements)
+
+    @property
+    def total_time(self):
+        """Seconds spent in the statements that finished"""
+        return sum(elapsed for elapsed, _ in self.timings)
+
+    def slowest(self, limit=5):
+        """(seconds, statement) of the slowest statements, slowest first"""
+        return sorted(self.timings, key=lambda timing: timing[0], reverse=True)[:limit]
+
+    def __enter__(self):
+        _active_counters().append(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        counters = _active_counters()
+        if self in counters:
+            counters.remove(self)
+
+
+class QueryBudget:
+    """Warns, or fails in strict mode, when an endpoint goes over its budget.
+
+    Budgets are read from the QUERY_BUDGETS config dict, keyed by endpoint,
+    with QUERY_BUDGET_DEFAULT for endpoints that are not listed. Strict mode
+    (QUERY_BUDGET_STRICT, on by default while testing) raises instead of
+    logging, so a regression to N+1 loading breaks the test that hit it.
+    QUERY_COUNT_HEADER adds an X-Query-Count header for load tests that
+    drive the app from another process.
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Register the request hooks on the app"""
+        app.config.setdefault("QUERY_BUDGETS", {})
+        app.config.setdefault("QUERY_BUDGET_DEFAULT", None)
+        app.config.setdefault("QUERY_BUDGET_STRICT", None)
+        app.config.setdefault("QUERY_COUNT_HEADER", False)
+        app.before_request(self._start)
+        app.after_request(self._check)
+        app.teardown_request(self._stop)
+        app.extensions["query_budget"] = self
+
+    @staticmethod
+    def _start():
+        g.query_counter = QueryCounter().__enter__()
+
+    @staticmethod
+    def _stop(exc=None):
+        counter = g.pop("query_counter", None)
+        if counter is not None:
+            counter.__exit__(None, None, None)
+
+    def _check(self, response):
+        counter = g.get("query_counter")
+        if counter is None:
+            return response
+        config = current_app.config
+        if config["QUERY_COUNT_HEADER"]:
+            response.headers["X-Query-Count"] = str(counter.count)
+        budget = config["QUERY_BUDGETS"].get(
+            request.endpoint, config["QUERY_BUDGET_DEFAULT"])
+        if budget is None or counter.count <= budget:
+            return response
+        message = (f"{request.method} {request.path} ({request.endpoint}) ran "
+                   f"{counter.count} queries, budget is {budget}")
+        strict = config["QUERY_BUDGET_STRICT"]
+        if strict is None:
+            strict = current_app.testing
+        if strict:
+            raise QueryBudgetExceeded(message)
+        current_app.logger.warning("%s:\n%s", message,
+                                   "\n".join(counter.statements))
+        return response
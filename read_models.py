@@ -0,0 +1,51 @@
+"""Immutable rows the listing and post pages are rendered from.
+
+The pages only read a few columns, so they are selected on their own and
+wrapped in named tuples instead of loading BlogPost objects: no identity
+map, attribute instrumentation or change tracking, and the listings never
+read a post body. Templates index them the same way as the models,
+post["title"] and post["uploader"].full_name.
+"""
+import datetime
+from typing import NamedTuple
+
+
+class Uploader(NamedTuple):
+    """The account that posted, as far as the pages show it"""
+    id: int
+    full_name: str
+
+
+class PostSummary(NamedTuple):
+    """A post in the listings"""
+    id: int
+    title: str
+    subtitle: str
+    date: datetime.datetime
+    uploader: Uploader
+
+
+class PostDetail(NamedTuple):
+    """A post on its own page"""
+    id: int
+    title: str
+    subtitle: str
+    article_author: str
+    date: datetime.datetime
+    edit_date: datetime.datetime
+    body: str
+    img_url: str
+    source_url: str
+    comment_count: int
+    uploader: Uploader
+
+
+def column_names(read_model):
+    """Post columns a read model holds; the uploader is added by from_row()"""
+    return [name for name in read_model._fields if name != "uploader"]
+
+
+def from_row(read_model, row):
+    """read_model from a row of its columns plus uploader_id, first_name and last_name"""
+    return read_model(*(getattr(row, name) for name in column_names(read_model)),
+                      Uploader(row.uploader_id, f"{row.first_name} {row.last_name}"))
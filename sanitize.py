@@ -0,0 +1,97 @@
+"""HTML sanitizing for posts and comments, done once at write time"""
+import html
+import threading
+from bleach.css_sanitizer import CSSSanitizer
+from bleach.sanitizer import Cleaner
+
+ALLOWED_TAGS = ['a', 'abbr', 'acronym', 'address', 'b', 'div', 'dl', 'dt',
+                'em', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'hr', 'i', 'img',
+                'li', 'ol', 'p', 'pre', 'q', 's', 'small', 'strike',
+                'span', 'sub', 'sup', 'table', 'tbody', 'td', 'tfoot', 'th',
+                'thead', 'tr', 'tt', 'u', 'ul', 'strong', 'wbr']
+
+ALLOWED_ATTRS = {
+    'a': ['href', 'target', 'title'],
+    'img': ['src', 'alt', 'width', 'height', 'style'],
+    '*': ['style']
+}
+
+ALLOWED_CSS = ['color', 'height', 'width']
+
+# Bump this whenever the allow-lists change, then run `flask resanitize`
+# to bring every stored post and comment up to the new policy.
+POLICY_VERSION = 1
+
+EXCERPT_LENGTH = 300
+
+_local = threading.local()
+
+
+def get_cleaners():
+    """This thread's (html, text) cleaners.
+
+    Building a Cleaner parses the allow-lists and sets up the html5lib
+    parser, so each thread builds its pair once and reuses it. They can't be
+    shared because the parser keeps state between calls.
+    """
+    cleaners = getattr(_local, "cleaners", None)
+    if cleaners is None:
+        html_cleaner = Cleaner(tags=ALLOWED_TAGS,
+                               attributes=ALLOWED_ATTRS,
+                               strip=True,
+                               css_sanitizer=CSSSanitizer(
+                                   allowed_css_properties=ALLOWED_CSS))
+        text_cleaner = Cleaner(tags=[], attributes={}, strip=True)
+        cleaners = _local.cleaners = (html_cleaner, text_cleaner)
+    return cleaners
+
+
+def strip_invalid_html(content):
+    """For cleaning user input"""
+    return get_cleaners()[0].clean(content)
+
+
+def plain_text(content):
+    """Text of an html fragment with every tag removed"""
+    return html.unescape(get_cleaners()[1].clean(content))
+
+
+def make_excerpt(words, length=EXCERPT_LENGTH):
+    """First words of the text, cut on a word boundary"""
+    excerpt = ""
+    for word in words:
+        if len(excerpt) + len(word) + 1 > length:
+            return excerpt + "…"
+        excerpt = f"{excerpt} {word}" if excerpt else word
+    return excerpt
+
+
+def sanitize_post(body):
+    """Column values for a post body: clean html, excerpt and word count"""
+    return sanitize_post_text(body)[0]
+
+
+def sanitize_post_text(body):
+    """sanitize_post() values, plus the plain text the search index wants"""
+    clean = strip_invalid_html(body)
+    content = plain_text(clean)
+    words = content.split()
+    return ({"body": clean, "excerpt": make_excerpt(words),
+             "word_count": len(words), "sanitized_version": POLICY_VERSION}, content)
+
+
+def sanitize_comment(text):
+    """Column values for a comment: clean html and word count"""
+    clean = strip_invalid_html(text)
+    return {"text": clean, "word_count": len(plain_text(clean).split()),
+            "sanitized_version": POLICY_VERSION}
+
+
+def sanitize_post_rows(rows):
+    """Re-sanitize (id, body) rows, for running in a worker process"""
+    return [{"id": row_id, **sanitize_post(body or "")} for row_id, body in rows]
+
+
+def sanitize_comment_rows(rows):
+    """Re-sanitize (id, text) rows, for running in a worker process"""
+    return [{"id": row_id, **sanitize_comment(text or "")} for row_id, text in rows]
@@ -0,0 +1,141 @@
+"""Full-text search over posts: FTS5 on SQLite, a GIN-indexed tsvector on Postgres.
+
+The index lives in its own post_search table, holding the plain text of each
+post, and is kept current from the post write paths. Functions take any
+object with an execute() method, a Connection or the Session.
+"""
+import re
+from collections import namedtuple
+from markupsafe import Markup, escape
+from sqlalchemy import text
+from sanitize import plain_text
+
+SearchHit = namedtuple("SearchHit", "id title subtitle snippet rank")
+
+# Highlight markers put in by the database, turned into <mark> after escaping.
+START, STOP = "\x02", "\x03"
+
+PG_HEADLINE = f"StartSel={START}, StopSel={STOP}, MaxWords=35, MinWords=15"
+PG_TITLE = f"StartSel={START}, StopSel={STOP}, HighlightAll=true"
+PG_DOCUMENT = ("setweight(to_tsvector('english', :title), 'A') || "
+               "setweight(to_tsvector('english', coalesce(:subtitle, '')), 'B') || "
+               "setweight(to_tsvector('english', :body), 'C')")
+
+
+def dialect(conn):
+    """Name of the database dialect behind a Connection or Session"""
+    bind = conn.get_bind() if hasattr(conn, "get_bind") else conn
+    return bind.dialect.name
+
+
+def highlight(value):
+    """Escape a database snippet and turn its markers into <mark> tags"""
+    escaped = str(escape(value or ""))
+    return Markup(escaped.replace(START, "<mark>").replace(STOP, "</mark>"))
+
+
+def match_expression(query):
+    """FTS5 MATCH string for user input: every word, the last one as a prefix"""
+    words = re.findall(r"\w+", query)
+    if not words:
+        return None
+    terms = [f'"{word}"' for word in words]
+    terms[-1] += "*"
+    return " ".join(terms)
+
+
+def create_index(conn):
+    """Create the search table for this database, if it is supported"""
+    name = dialect(conn)
+    if name == "sqlite":
+        conn.execute(text("CREATE VIRTUAL TABLE IF NOT EXISTS post_search USING "
+                          "fts5(title, subtitle, body, tokenize='porter unicode61')"))
+    elif name == "postgresql":
+        conn.execute(text("CREATE TABLE IF NOT EXISTS post_search ("
+                          "post_id INTEGER PRIMARY KEY "
+                          "REFERENCES blog_post (id) ON DELETE CASCADE, "
+                          "title TEXT NOT NULL, subtitle TEXT, body TEXT NOT NULL, "
+                          "document TSVECTOR NOT NULL)"))
+        conn.execute(text("CREATE INDEX IF NOT EXISTS ix_post_search_document "
+                          "ON post_search USING GIN (document)"))
+
+
+def index_post(conn, post_id, title, subtitle, body):
+    """Add or replace one post in the index"""
+    index_texts(conn, [(post_id, title, subtitle, plain_text(body))])
+
+
+def index_texts(conn, rows):
+    """Add or replace posts given as (id, title, subtitle, plain text body) rows"""
+    params = [{"id": post_id, "title": title, "subtitle": subtitle or "", "body": body}
+              for post_id, title, subtitle, body in rows]
+    if not params:
+        return
+    name = dialect(conn)
+    if name == "sqlite":
+        conn.execute(text("DELETE FROM post_search WHERE rowid = :id"), params)
+        conn.execute(text("INSERT INTO post_search (rowid, title, subtitle, body) "
+                          "VALUES (:id, :title, :subtitle, :body)"), params)
+    elif name == "postgresql":
+        conn.execute(text("INSERT INTO post_search (post_id, title, subtitle, body, document) "
+                          f"VALUES (:id, :title, :subtitle, :body, {PG_DOCUMENT}) "
+                          "ON CONFLICT (post_id) DO UPDATE SET title = excluded.title, "
+                          "subtitle = excluded.subtitle, body = excluded.body, "
+                          "document = excluded.document"), params)
+
+
+def remove_post(conn, post_id):
+    """Drop one post from the index"""
+    name = dialect(conn)
+    if name == "sqlite":
+        conn.execute(text("DELETE FROM post_search WHERE rowid = :id"), {"id": post_id})
+    elif name == "postgresql":
+        conn.execute(text("DELETE FROM post_search WHERE post_id = :id"), {"id": post_id})
+
+
+def rebuild(conn, chunk_size=500):
+    """Re-index every post from blog_post, returns how many were indexed"""
+    conn.execute(text("DELETE FROM post_search"))
+    last_id = 0
+    count = 0
+    while True:
+        rows = conn.execute(text("SELECT id, title, subtitle, body FROM blog_post "
+                                 "WHERE id > :last ORDER BY id LIMIT :size"),
+                            {"last": last_id, "size": chunk_size}).all()
+        if not rows:
+            return count
+        for row in rows:
+            index_post(conn, *row)
+        count += len(rows)
+        last_id = rows[-1][0]
+
+
+def search(conn, query, limit=10, offset=0):
+    """Best matching posts for the query, with highlighted title and snippet"""
+    name = dialect(conn)
+    if name == "sqlite":
+        expression = match_expression(query)
+        if expression is None:
+            return []
+        rows = conn.execute(text(
+            "SELECT rowid, highlight(post_search, 0, char(2), char(3)), subtitle, "
+            "snippet(post_search, 2, char(2), char(3), '…', 24), "
+            "bm25(post_search, 10.0, 5.0, 1.0) AS score FROM post_search "
+            "WHERE post_search MATCH :match ORDER BY score LIMIT :limit OFFSET :offset"),
+            {"match": expression, "limit": limit, "offset": offset}).all()
+    elif name == "postgresql":
+        if not query.strip():
+            return []
+        rows = conn.execute(text(
+            "SELECT s.post_id, ts_headline('english', s.title, q, :title_options), "
+            "s.subtitle, ts_headline('english', s.body, q, :options), "
+            "ts_rank_cd(s.document, q) AS score "
+            "FROM post_search s, websearch_to_tsquery('english', :query) q "
+            "WHERE s.document @@ q ORDER BY score DESC, s.post_id DESC "
+            "LIMIT :limit OFFSET :offset"),
+            {"query": query, "title_options": PG_TITLE, "options": PG_HEADLINE,
+             "limit": limit, "offset": offset}).all()
+    else:
+        return []
+    return [SearchHit(row[0], highlight(row[1]), row[2], highlight(row[3]), row[4])
+            for row in rows]
@@ -1,67 +1,95 @@
 """Blog Deployment"""
 import os
 import datetime
+import json
 import secrets
+import time
+from concurrent.futures import ProcessPoolExecutor
 from typing import List
 from functools import wraps
-from flask import Flask, redirect, render_template, url_for, flash, request, session, abort
+import click
+from flask import Flask, Blueprint, current_app, redirect, render_template, url_for, flash, request, session, abort, jsonify, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import String, Integer, Text, ForeignKey, DateTime, Date
-from sqlalchemy.orm import Mapped, mapped_column, relationship
+from sqlalchemy import String, Integer, Text, ForeignKey, DateTime, Date, Index, func, select, update, event
+from sqlalchemy.orm import Mapped, mapped_column, relationship, joinedload, load_only, undefer
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.hybrid import hybrid_property
 from flask_bootstrap import Bootstrap5
 from flask_ckeditor import CKEditor
-import bleach
-from bleach.css_sanitizer import CSSSanitizer
 from flask_bcrypt import Bcrypt
 from flask_login import UserMixin, LoginManager, fresh_login_required, login_required, login_fresh, login_user, logout_user, current_user
-from flask_gravatar import Gravatar
-from dotenv import dotenv_values
+from flask_wtf.csrf import validate_csrf
+from wtforms import ValidationError
+from werkzeug.middleware.proxy_fix import ProxyFix
 from forms import RegiterForm, CommentForm, AddPost, LoginForm, ChangePassword
-
-
-app = Flask(__name__)
-
-app.config["SECRET_KEY"] = os.environ.get("FLASK_KEY")
-app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get(
-    "DB_URI", "sqlite:///posts.db")
-
-# config = {
-#     **dotenv_values(".env.secrets")
-# }
-
-# app_key = config["secret_key"]
-
-# app.config["SECRET_KEY"] = app_key
-# app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///posts.db"
-
-db = SQLAlchemy(app)
-bt5 = Bootstrap5(app)
-bcrypt = Bcrypt(app)
-ckeditor = CKEditor(app)
+from pagination import (PER_PAGE, CachedCount, fetch_page, fetch_keyset, last_page,
+                        encode_cursor, decode_cursor)
+from query_budget import QueryBudget
+from metrics import Metrics
+from cache import PageCache, SKIP_CACHE, request_variant
+from signals import post_saved, post_deleted, comment_added, likes_flushed, user_deleted
+from sanitize import (POLICY_VERSION, sanitize_post, sanitize_comment,
+                      sanitize_post_rows, sanitize_comment_rows)
+from migrations import upgrade, recount
+from passwords import PasswordHasher, HasherBusy, AttemptThrottle
+from user_cache import UserCache
+import search
+from likes import LikeBuffer
+from conditional import make_etag, conditional, validated
+import assets
+from image_proxy import ImageProxy, FetchError, url_key
+import avatars
+import database
+import transfer
+import feeds
+import prerender
+from read_models import PostDetail, PostSummary, column_names, from_row
+from contact import make_message, make_sink
+from jobs import JobQueue, INTERNAL_REQUEST
+
+
+# Created unbound and attached to the app in create_app(), so importing this
+# module does no I/O and gunicorn --preload can build the app once for all workers.
+db = SQLAlchemy()
+bt5 = Bootstrap5()
+bcrypt = Bcrypt()
+passwords = PasswordHasher()
+# Hashing attempts allowed per client IP, and failed logins per email, in 5 minutes.
+ip_throttle = AttemptThrottle(limit=int(os.environ.get("LOGIN_IP_LIMIT", 30)), window=300)
+email_throttle = AttemptThrottle(limit=5, window=300)
+ckeditor = CKEditor()
 login_manager = LoginManager()
-login_manager.init_app(app)
-login_manager.login_view = "login"
-login_manager.refresh_view = "login"
-gravatar = Gravatar(app, size=50, rating='g',
-                    default='retro',
-                    force_default=False,
-                    force_lower=True,
-                    use_ssl=False,
-                    base_url=None)
+login_manager.login_view = "blog.login"
+login_manager.refresh_view = "blog.login"
+query_budget = QueryBudget()
+metrics = Metrics()
+page_cache = PageCache()
+user_cache = UserCache()
+like_buffer = LikeBuffer()
+static_assets = assets.Assets()
+image_proxy = ImageProxy()
+avatar_links = avatars.Avatars()
+job_queue = JobQueue()
+
+blog = Blueprint("blog", __name__, cli_group=None)
 
 
 @login_manager.user_loader
 def load_user(token):
     """User loader callback"""
-    return db.session.get(User, token)
+    return user_cache.get(token, lambda: db.session.get(User, token))
+
+
+def is_admin():
+    """Whether the signed-in user is the admin account"""
+    return current_user.is_authenticated and current_user.id == 1
 
 
 def admin_only(function):
     """Admin only function"""
     @wraps(function)
     def wrapper_function(*args, **kwargs):
-        if current_user.id != 1:
+        if not is_admin():
             return abort(403)
         return function(*args, **kwargs)
     return wrapper_function
@@ -107,10 +135,15 @@ class User(db.Model, UserMixin):
     first_name: Mapped[str] = mapped_column(String(250), nullable=False)
     last_name: Mapped[str] = mapped_column(String(250), nullable=False)
     birth_date: Mapped[datetime.date] = mapped_column(Date, nullable=False)
+    # Gravatar hash of the email, kept in step by the set event below.
+    avatar_hash: Mapped[str] = mapped_column(String(32), nullable=True)
     comments: Mapped[List["Comment"]] = relationship(
         back_populates="comment_author", cascade="all, delete-orphan")
     posts: Mapped[List["BlogPost"]] = relationship(
         back_populates="uploader", cascade="all, delete-orphan")
+    # Deleted through the ORM so the like counters on other users' comments follow.
+    likes: Mapped[List["Likes"]] = relationship(
+        back_populates="user", cascade="all, delete-orphan")
 
     @hybrid_property
     def full_name(self):
@@ -127,7 +160,7 @@ class BlogPost(db.Model):
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     # foreign key means getting data outside this table
     uploader_id: Mapped[int] = mapped_column(
-        ForeignKey("users.id", ondelete="CASCADE"))
+        ForeignKey("users.id", ondelete="CASCADE"), index=True)
     # back populate means you are getting the data from the parent table, this is child table.
     uploader: Mapped["User"] = relationship(
         back_populates="posts")
@@ -135,20 +168,29 @@ class BlogPost(db.Model):
     title: Mapped[str] = mapped_column(String(250), nullable=False)
     subtitle: Mapped[str] = mapped_column(String(250), nullable=True)
     date: Mapped[datetime.datetime] = mapped_column(
-        DateTime(timezone=True), nullable=False)
+        DateTime(timezone=True), nullable=False, index=True)
     edit_date: Mapped[datetime.datetime] = mapped_column(
         DateTime(timezone=True), nullable=True)
-    body: Mapped[str] = mapped_column(Text, nullable=False)
+    # Deferred, so a BlogPost loaded for anything but its page leaves the body behind.
+    body: Mapped[str] = mapped_column(Text, nullable=False, deferred=True)
+    # Derived from body by sanitize_post() when the post is written.
+    excerpt: Mapped[str] = mapped_column(Text, nullable=True)
+    word_count: Mapped[int] = mapped_column(Integer, default=0, nullable=False)
+    sanitized_version: Mapped[int] = mapped_column(
+        Integer, default=0, nullable=False)
     img_url: Mapped[str] = mapped_column(String, nullable=True)
     source_url: Mapped[str] = mapped_column(String, nullable=True)
+    # Kept up to date by the Comment insert/delete events below.
+    comment_count: Mapped[int] = mapped_column(Integer, default=0, nullable=False)
     comments: Mapped[List["Comment"]] = relationship(
         back_populates="parent_post", cascade="all, delete-orphan")
 
-    def to_dict(self):
-        """Turn values to dict"""
+    def to_dict(self, fields=None):
+        """Turn values to dict, only the named columns if fields is given"""
         dictionary = {}
         for column in self.__table__.columns:
-            dictionary[column.name] = getattr(self, column.name)
+            if fields is None or column.name in fields:
+                dictionary[column.name] = getattr(self, column.name)
         return dictionary
 
     # def strip_invalid_html(self, body):
@@ -161,92 +203,560 @@ class BlogPost(db.Model):
 class Comment(db.Model):
     """Comments Class"""
     __tablename__ = "comments"
+    # Comment pages are read newest first within one post.
+    __table_args__ = (
+        Index("ix_comments_post_created", "post_id", "date_created", "id"),
+    )
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     text: Mapped[str] = mapped_column(Text, nullable=True)
+    word_count: Mapped[int] = mapped_column(Integer, default=0, nullable=False)
+    sanitized_version: Mapped[int] = mapped_column(
+        Integer, default=0, nullable=False)
     date_created: Mapped[datetime.datetime] = mapped_column(
         DateTime(timezone=True), nullable=False)
     date_edited: Mapped[datetime.datetime] = mapped_column(
         DateTime(timezone=True), nullable=True)
     author_id: Mapped[int] = mapped_column(
-        ForeignKey("users.id", ondelete="CASCADE"))
+        ForeignKey("users.id", ondelete="CASCADE"), index=True)
     comment_author: Mapped["User"] = relationship(
         back_populates="comments")
     post_id: Mapped[int] = mapped_column(
-        ForeignKey("blog_post.id", ondelete="CASCADE"))
+        ForeignKey("blog_post.id", ondelete="CASCADE"), index=True)
     parent_post: Mapped["BlogPost"] = relationship(
         back_populates="comments")
     post_like: Mapped[List["Likes"]] = relationship(
         back_populates="parent_comment", cascade="all, delete-orphan")
+    # Kept up to date by the Likes insert/delete events below.
+    like_count: Mapped[int] = mapped_column(Integer, default=0, nullable=False)
 
 
 class Likes(db.Model):
     """Likes table"""
     __tablename__ = "likes"
+    # A user likes a comment at most once.
+    __table_args__ = (
+        Index("uq_likes_comment_user", "comment_id", "user_id", unique=True),
+    )
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     comment_id: Mapped[int] = mapped_column(
         ForeignKey("comments.id", ondelete="CASCADE"))
     user_id: Mapped[int] = mapped_column(
-        ForeignKey("users.id", ondelete="CASCADE"))
+        ForeignKey("users.id", ondelete="CASCADE"), index=True)
     parent_comment: Mapped["Comment"] = relationship(
         back_populates="post_like")
+    user: Mapped["User"] = relationship(
+        back_populates="likes")
 
 
-with app.app_context():
-    db.create_all()
+def bump_counter(connection, table, counter, row_id, step):
+    """Add step to a counter column, in the transaction that is flushing"""
+    connection.execute(update(table).where(table.c.id == row_id)
+                       .values({counter: table.c[counter] + step}))
+
+
+@event.listens_for(User.email, "set")
+def hash_new_email(target, value, oldvalue, initiator):
+    """Email set at signup or changed: store the avatar hash with it"""
+    if value:
+        target.avatar_hash = avatars.avatar_hash(value)
+
+
+@event.listens_for(Comment, "after_insert")
+def count_new_comment(mapper, connection, target):
+    """Comment added: one more on its post"""
+    bump_counter(connection, BlogPost.__table__, "comment_count", target.post_id, 1)
+
+
+@event.listens_for(Comment, "after_delete")
+def count_deleted_comment(mapper, connection, target):
+    """Comment removed: one less on its post"""
+    bump_counter(connection, BlogPost.__table__, "comment_count", target.post_id, -1)
+
+
+@event.listens_for(Likes, "after_insert")
+def count_new_like(mapper, connection, target):
+    """Like added: one more on its comment"""
+    bump_counter(connection, Comment.__table__, "like_count", target.comment_id, 1)
+
+
+@event.listens_for(Likes, "after_delete")
+def count_deleted_like(mapper, connection, target):
+    """Like removed: one less on its comment"""
+    bump_counter(connection, Comment.__table__, "like_count", target.comment_id, -1)
+
 
+# Loader options for each view, so the templates never trigger lazy loads.
+QUERY_PROFILES = {
+    "comments": (joinedload(Comment.comment_author),),
+}
 
-def get_data():
-    """Get all the BlogPost data from the database"""
-    all_blogpost_data = db.session.query(BlogPost).order_by(BlogPost.id).all()
 
-    # Display data in reverse, displays on 10 items.
-    latest_posts = all_blogpost_data[::-1][0:10]
-    return latest_posts, all_blogpost_data
+def read_model_query(read_model):
+    """select() of the columns behind a read model, joined to the uploader's name"""
+    return (select(*(getattr(BlogPost, name) for name in column_names(read_model)),
+                   BlogPost.uploader_id, User.first_name, User.last_name)
+            .join(BlogPost.uploader))
+
+
+def post_summaries(page=0, before=None, after=None):
+    """One listing page as PostSummary rows"""
+    rows = fetch_page(db.session, BlogPost, page, before=before, after=after,
+                      query=read_model_query(PostSummary))
+    return [from_row(PostSummary, row) for row in rows]
+
+
+def post_detail(number):
+    """The post for its page as a PostDetail, None if there is none.
+
+    Comments are loaded a page at a time by comment_page().
+    """
+    row = db.session.execute(read_model_query(PostDetail)
+                             .where(BlogPost.id == number)).first()
+    return None if row is None else from_row(PostDetail, row)
+
+
+post_count = CachedCount()
+COMMENTS_PER_PAGE = 20
+
+
+def count_posts():
+    """Total number of posts, cached until the next post is added or deleted"""
+    return post_count.get(
+        lambda: db.session.query(func.count(BlogPost.id)).scalar())
+
+
+def neighbor_columns(number):
+    """Subqueries for the ids of the older and newer posts next to this one"""
+    # Both sides are MAX/MIN seeks on the primary key.
+    older = select(func.max(BlogPost.id)).where(BlogPost.id < number)
+    newer = select(func.min(BlogPost.id)).where(BlogPost.id > number)
+    return older.scalar_subquery(), newer.scalar_subquery()
+
+
+def get_neighbors(number):
+    """Ids of the older and newer posts next to this one, None at either end"""
+    return db.session.execute(select(*neighbor_columns(number))).one()
+
+
+@post_saved.connect
+def refresh_after_save(sender, post_id, created, **extra):
+    """Drop cached pages that show a new or edited post"""
+    tags = ["listing", f"post:{post_id}"]
+    if created:
+        post_count.invalidate()
+        # The previous newest post now has a "newer" arrow to this one.
+        older_id = get_neighbors(post_id)[0]
+        if older_id is not None:
+            tags.append(f"post:{older_id}")
+    page_cache.invalidate(*tags)
+
+
+@post_deleted.connect
+def refresh_after_delete(sender, post_id, older_id, newer_id, **extra):
+    """Drop cached pages that show or point at a deleted post"""
+    post_count.invalidate()
+    page_cache.invalidate("listing", f"post:{post_id}",
+                          f"post:{older_id}", f"post:{newer_id}")
+
+
+@post_saved.connect
+def refresh_feeds_after_save(sender, post_id, created, **extra):
+    """Rebuild the feed and the sitemap files that list this post"""
+    page_cache.invalidate("feed", "sitemap", f"sitemap:{feeds.sitemap_part(post_id)}")
+
+
+@post_deleted.connect
+def refresh_feeds_after_delete(sender, post_id, **extra):
+    """Take a deleted post out of the feed and sitemap"""
+    page_cache.invalidate("feed", "sitemap", f"sitemap:{feeds.sitemap_part(post_id)}")
+
+
+@post_saved.connect
+def reindex_post(sender, post_id, created, **extra):
+    """Keep the full-text index in step with new and edited posts"""
+    post = db.session.execute(select(BlogPost.title, BlogPost.subtitle, BlogPost.body)
+                              .where(BlogPost.id == post_id)).one()
+    search.index_post(db.session, post_id, post.title, post.subtitle, post.body)
+    db.session.commit()
 
 
-def post_per_page(all_data):
-    """To get how many pages are needed to display in the pagination"""
-    total_posts_count = len(all_data)
-    divisible = total_posts_count % 10
-    if divisible == 0 and total_posts_count != 0:
-        number_of_pages = int(total_posts_count/10) - 1
+@post_saved.connect
+def warm_after_save(sender, post_id, created, **extra):
+    """Have a job rebuild what a new or edited post invalidated"""
+    job_queue.enqueue("warm-post", {"post_id": post_id})
+
+
+@post_deleted.connect
+def warm_after_delete(sender, post_id, **extra):
+    """Have a job rebuild the listing and feeds without a deleted post"""
+    job_queue.enqueue("warm-post", {"post_id": post_id})
+
+
+@post_deleted.connect
+def unindex_post(sender, post_id, **extra):
+    """Drop a deleted post from the full-text index"""
+    search.remove_post(db.session, post_id)
+    db.session.commit()
+
+
+@user_deleted.connect
+def unindex_user_posts(sender, user_id, post_ids, **extra):
+    """Drop the posts removed along with an account from the full-text index"""
+    for post_id in post_ids:
+        search.remove_post(db.session, post_id)
+    db.session.commit()
+
+
+@comment_added.connect
+def refresh_after_comment(sender, post_id, comment_id, **extra):
+    """Drop the cached page of the post that was commented on"""
+    page_cache.invalidate(f"post:{post_id}")
+
+
+@likes_flushed.connect
+def refresh_after_likes(sender, post_ids, **extra):
+    """Drop the cached pages whose like counts just changed"""
+    page_cache.invalidate(*(f"post:{post_id}" for post_id in post_ids))
+
+
+@user_deleted.connect
+def refresh_after_user_delete(sender, user_id, post_ids, **extra):
+    """A deleted account takes its posts and comments with it"""
+    user_cache.invalidate(user_id)
+    post_count.invalidate()
+    page_cache.invalidate_all()
+
+
+# Background jobs -------------------------------------------------------------
+
+# Pages every post write invalidates, rendered again for anonymous visitors.
+WARM_PATHS = ("/",)
+# The same for pages with absolute URLs, which are cached per host and so
+# are only warmed for SITE_URL.
+WARM_FEED_PATHS = ("/feed.xml", "/sitemap.xml")
+
+# What `flask resanitize --background` re-cleans, per kind of row.
+RESANITIZE_TABLES = {
+    "posts": (BlogPost, BlogPost.body, sanitize_post_rows),
+    "comments": (Comment, Comment.text, sanitize_comment_rows),
+}
+
+
+@job_queue.handler("deliver-contact")
+def deliver_contact(name, email, phone_number, message):
+    """Hand a contact-form message to CONTACT_SINK"""
+    config = current_app.config
+    sink = make_sink(config)
+    sink(make_message(name, email, phone_number, message, config["CONTACT_RECIPIENT"]))
+
+
+def internal_client():
+    """Test client for pages the app renders for itself, off any visitor's request"""
+    client = current_app.test_client()
+    client.environ_base[INTERNAL_REQUEST] = True
+    return client
+
+
+@job_queue.handler("warm-post")
+def warm_post(post_id):
+    """Fetch a post's image and fill the page cache after the post changed"""
+    post = db.session.execute(select(BlogPost.img_url).where(BlogPost.id == post_id)).first()
+    paths = list(WARM_PATHS)
+    # The post is gone when the job follows a delete.
+    if post is not None:
+        if post.img_url:
+            image_proxy.prefetch(post.img_url)
+        paths.append(f"/post/{post_id}")
+    site_url = current_app.config["SITE_URL"]
+    fetches = [(path, None) for path in paths]
+    if site_url:
+        fetches += [(path, site_url) for path in WARM_FEED_PATHS]
+    client = internal_client()
+    for path, base_url in fetches:
+        status = client.get(path, base_url=base_url).status_code
+        if status >= 500:
+            raise RuntimeError(f"Warming {path} failed with {status}")
+
+
+@job_queue.handler("prerender")
+def prerender_changes():
+    """Bring the static copy in PRERENDER_DIR up to date"""
+    report = prerender_site(current_app.config["PRERENDER_DIR"])
+    current_app.logger.info("Prerendered %(rendered)d of %(pages)d pages in %(ms).1fms", report)
+
+
+@job_queue.handler("resanitize")
+def resanitize_chunk(kind, after_id=0, chunk_size=500, everything=False):
+    """Re-clean one chunk of posts or comments, then queue the next chunk"""
+    model, column, clean_rows = RESANITIZE_TABLES[kind]
+    query = (select(model.id, column).where(model.id > after_id)
+             .order_by(model.id).limit(chunk_size))
+    if not everything:
+        query = query.where(model.sanitized_version < POLICY_VERSION)
+    rows = db.session.execute(query).all()
+    if rows:
+        db.session.execute(update(model), clean_rows([tuple(row) for row in rows]))
+        db.session.commit()
+        page_cache.invalidate_all()
+    if len(rows) == chunk_size:
+        job_queue.enqueue("resanitize", {"kind": kind, "after_id": rows[-1][0],
+                                         "chunk_size": chunk_size, "everything": everything})
+
+
+# Static export -------------------------------------------------------------
+
+def prerender_pages():
+    """{URL path: fingerprint} of every public page, from two bulk queries.
+
+    A fingerprint covers what the page shows, so a changed post also
+    changes its neighbours (for their arrows), the listing page it is on,
+    the feed and its sitemap.
+    """
+    config = current_app.config
+    base = (config["TEMPLATE_VERSION"], config["ASSET_VERSION"], config["SITE_URL"],
+            datetime.date.today().year)
+    posts = db.session.execute(
+        select(BlogPost.id, BlogPost.date, BlogPost.edit_date, BlogPost.comment_count)
+        .order_by(BlogPost.id.desc())).all()
+    comments = {row[0]: tuple(row[1:]) for row in db.session.execute(
+        select(Comment.post_id, func.max(Comment.date_created),
+               func.max(Comment.date_edited), func.sum(Comment.like_count))
+        .group_by(Comment.post_id))}
+    ids = [post.id for post in posts]
+    shown = {post.id: (post.date, post.edit_date) for post in posts}
+    pages = {"/aboutme": make_etag(*base)}
+    for page in range(last_page(len(ids)) + 1):
+        on_page = ids[page * PER_PAGE:(page + 1) * PER_PAGE]
+        # The listings also show today's date.
+        pages["/" if page == 0 else f"/posts/{page}"] = make_etag(
+            *base, datetime.date.today(), len(ids), [(i, shown[i]) for i in on_page])
+    for index, post in enumerate(posts):
+        newer_id = ids[index - 1] if index else None
+        older_id = ids[index + 1] if index + 1 < len(ids) else None
+        pages[f"/post/{post.id}"] = make_etag(*base, tuple(post), comments.get(post.id),
+                                              older_id, newer_id)
+    pages["/feed.xml"] = make_etag(*base, [(i, shown[i]) for i in ids[:feeds.FEED_SIZE]])
+    parts = {}
+    for post_id in reversed(ids):
+        parts.setdefault(feeds.sitemap_part(post_id), []).append((post_id, shown[post_id]))
+    if len(parts) <= 1:
+        pages["/sitemap.xml"] = make_etag(*base, parts.get(1))
     else:
-        number_of_pages = round(int(total_posts_count/10))
-    return number_of_pages
+        for number, members in parts.items():
+            pages[f"/sitemap-{number}.xml"] = make_etag(*base, members)
+        pages["/sitemap.xml"] = make_etag(*base, [pages[f"/sitemap-{number}.xml"]
+                                                  for number in parts])
+    return pages
+
+
+def prerender_site(out_dir, full=False):
+    """Render the changed public pages into out_dir and copy the static files"""
+    started = time.perf_counter()
+    client = internal_client()
+    base_url = current_app.config["SITE_URL"]
+
+    def render(path):
+        # Straight from the database, not from a page cache entry that may
+        # predate the change being published.
+        response = client.get(path, base_url=base_url,
+                              environ_base={SKIP_CACHE: True, prerender.RENDERING: True})
+        return response.get_data() if response.status_code == 200 else None
+    report = prerender.build(out_dir, prerender_pages(), render, full)
+    # Built assets are served from /assets/, so they are left out of /static/.
+    report["files"] = prerender.copy_tree(current_app.static_folder,
+                                          os.path.join(out_dir, "static"),
+                                          skip={static_assets.dist_dir})
+    if os.path.isdir(static_assets.dist_dir):
+        report["files"] += prerender.copy_tree(static_assets.dist_dir,
+                                               os.path.join(out_dir, "assets"))
+    report["ms"] = (time.perf_counter() - started) * 1000
+    return report
+
+
+@post_saved.connect
+@post_deleted.connect
+@comment_added.connect
+def queue_prerender(sender, **extra):
+    """Have a job update the static copy, when there is one"""
+    if current_app.config["PRERENDER_DIR"]:
+        job_queue.enqueue("prerender")
+
+
+def throttled(email=None):
+    """Whether this client, or this email, has used up its hashing attempts"""
+    if not ip_throttle.allow(request.remote_addr):
+        return True
+    return email is not None and not email_throttle.allow(email.lower())
+
+
+def like_states(post_id, comments):
+    """{comment_id: (like count, liked by the current user)} for a comment list.
+
+    Counts come from the maintained like_count column and the user's likes
+    from one query over the post, then the user's unflushed clicks in the
+    LikeBuffer are laid on top so a reload shows what they just did. The
+    post page's ETag covers the same clicks and is part of its page cache
+    key, so a cached copy never shows an older liked state.
+    """
+    counts = {comment.id: comment.like_count for comment in comments}
+    liked = set()
+    if current_user.is_authenticated and counts:
+        liked = set(db.session.scalars(
+            select(Likes.comment_id).join(Comment, Comment.id == Likes.comment_id)
+            .where(Comment.post_id == post_id, Likes.user_id == current_user.id)))
+        for comment_id, wanted in like_buffer.pending_for(current_user.id).items():
+            if comment_id in counts and wanted != (comment_id in liked):
+                counts[comment_id] += 1 if wanted else -1
+                if wanted:
+                    liked.add(comment_id)
+                else:
+                    liked.discard(comment_id)
+    return {comment_id: (count, comment_id in liked)
+            for comment_id, count in counts.items()}
+
+
+def comment_page(number, cursor=None, per_page=COMMENTS_PER_PAGE):
+    """A page of a post's comments, newest first, and the URL of the next page"""
+    comments, next_cursor = fetch_keyset(
+        db.session, Comment, Comment.date_created, cursor, per_page,
+        options=QUERY_PROFILES["comments"], criteria=(Comment.post_id == number,))
+    next_url = None
+    if next_cursor is not None:
+        next_url = url_for("blog.post_comments", number=number,
+                           after=encode_cursor(next_cursor))
+    return comments, next_url
+
+
+def add_comment(number, form):
+    """Save the comment in a validated form, returns its id or None"""
+    if not form.validate_on_submit():
+        return None
+    new_comment = Comment(
+        **sanitize_comment(form.text.data),
+        author_id=current_user.id,
+        post_id=number,
+        date_created=datetime.datetime.now()
+        # Create a route for editing the comment that is a copy of this route.
+    )
+    db.session.add(new_comment)
+    db.session.flush()
+    # Read before the commit expires the object and reading it costs a query.
+    comment_id = new_comment.id
+    db.session.commit()
+    comment_added.send(current_app._get_current_object(), post_id=number,
+                       comment_id=comment_id)
+    return comment_id
 
 
-def strip_invalid_html(content):
-    """For cleaning user input"""
-    css_sanitizer = CSSSanitizer(allowed_css_properties=[
-                                 'color', 'height', 'width'])
+def remember_url():
+    """Keep the page to come back to after login/logout, for signed-in users only.
 
-    allowed_tags = ['a', 'abbr', 'acronym', 'address', 'b', 'div', 'dl', 'dt',
-                    'em', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'hr', 'i', 'img',
-                    'li', 'ol', 'p', 'pre', 'q', 's', 'small', 'strike',
-                    'span', 'sub', 'sup', 'table', 'tbody', 'td', 'tfoot', 'th',
-                    'thead', 'tr', 'tt', 'u', 'ul', 'strong', 'wbr']
+    Writing the session for everyone would put a Set-Cookie on every
+    anonymous page and keep browsers and proxies from caching them.
+    """
+    if current_user.is_authenticated and session.get("url") != request.path:
+        session["url"] = request.path
+
+
+def page_cache_control():
+    """Anonymous pages may be kept by shared caches, signed-in ones may not"""
+    if current_user.is_authenticated:
+        return "private, no-cache"
+    return current_app.config["PUBLIC_CACHE_CONTROL"]
+
+
+def page_etag(*parts):
+    """ETag for an HTML page, which also varies by visitor, deploy and day"""
+    return make_etag(request_variant(), current_app.config["TEMPLATE_VERSION"],
+                     current_app.config["ASSET_VERSION"],
+                     datetime.date.today(), *parts)
+
+
+def listing_version(page=0):
+    """Validators for the listings, from the newest post date and edit date"""
+    newest, edited = db.session.execute(
+        select(func.max(BlogPost.date), func.max(BlogPost.edit_date))).one()
+    last_modified = max(filter(None, (newest, edited)), default=None)
+    return (page_etag("listing", page, request.query_string, newest, edited,
+                      count_posts()), last_modified)
+
+
+def post_page_version(number):
+    """Validators for a post page: the post, its comments and its neighbours"""
+    def of_comments(column):
+        return select(column).where(Comment.post_id == number).scalar_subquery()
+    row = db.session.execute(
+        select(BlogPost.date, BlogPost.edit_date, BlogPost.comment_count,
+               of_comments(func.max(Comment.date_created)),
+               of_comments(func.max(Comment.date_edited)),
+               of_comments(func.sum(Comment.like_count)),
+               *neighbor_columns(number))
+        .where(BlogPost.id == number)).first()
+    if row is None:
+        return None, None
+    pending = ()
+    if current_user.is_authenticated:
+        pending = sorted(like_buffer.pending_for(current_user.id).items())
+    last_modified = max(filter(None, (row[0], row[1], row[3], row[4])))
+    return page_etag("post", number, tuple(row), pending), last_modified
+
+
+def comment_page_version(number):
+    """Validators for a page of comments, which change along with the post page"""
+    etag, last_modified = post_page_version(number)
+    if etag is None:
+        return None, None
+    return make_etag(etag, "comments", request.query_string), last_modified
+
+
+def static_page_version():
+    """Validators for pages that only change with the templates"""
+    return page_etag(request.endpoint), None
+
+
+@blog.after_app_request
+def keep_session_pages_private(response):
+    """Never let a shared cache keep a response that sets the session cookie"""
+    if session.modified and response.cache_control.public:
+        response.headers["Cache-Control"] = "private, no-cache"
+    return response
 
-    allowed_attrs = {
-        'a': ['href', 'target', 'title'],
-        'img': ['src', 'alt', 'width', 'height', 'style'],
-        '*': ['style']
-    }
 
-    cleaned = bleach.clean(content,
-                           tags=allowed_tags,
-                           attributes=allowed_attrs,
-                           strip=True,
-                           css_sanitizer=css_sanitizer)
-    return cleaned
+def prerendering():
+    """Whether this request renders a page for the static copy"""
+    return bool(request.environ.get(prerender.RENDERING))
 
 
-@app.route("/")
+def post_background(post_id, img_url):
+    """Page background for a post, served through the image proxy"""
+    if not img_url:
+        return None
+    if prerendering():
+        # The static copy has no image proxy to serve the resized variants.
+        return {"src": img_url, "sources": []}
+    key = url_key(img_url)[:16]
+    hero = {"src": url_for("blog.post_image", number=post_id, key=key), "sources": []}
+    if image_proxy.can_resize:
+        hero["srcset"] = ", ".join(
+            f"{url_for('blog.post_image', number=post_id, key=key, w=width)} {width}w"
+            for width in assets.WIDTHS)
+    return hero
+
+
+def page_cursors(data):
+    """Ids of the first and last post on a page, used by the Prev/Next links"""
+    if not data:
+        return None, None
+    return data[0].id, data[-1].id
+
+
+@blog.route("/")
+@validated(listing_version, page_cache_control)
+@page_cache.cached("listing")
 def index():
     """Home page of the website"""
-    session["url"] = "/"
-    all_data = get_data()
-    posts_data = all_data[1]
-    data = all_data[0]
+    remember_url()
+    data = post_summaries()
     # For testing-------------------------------------------------
     # one_post = db.session.query(BlogPost).filter_by(id=2).first()
     # print(one_post.uploader_id, one_post.uploader.email)
@@ -255,25 +765,32 @@ def index():
     # print(posts)
     # -------------------------------------------------------------
     current_page = 0  # Pagination
-    pages = post_per_page(posts_data)  # Pagination
+    pages = last_page(count_posts())  # Pagination
+    prev_cursor, next_cursor = page_cursors(data)
     background_url = r"static/assets/img/home-bg.jpg"
     return render_template("index.html", posts=data,
                            page=pages, current_page=current_page,
+                           prev_cursor=prev_cursor, next_cursor=next_cursor,
                            copyRight=datetime.datetime.now().strftime("%Y"),
                            today=datetime.datetime.now().strftime("%B %d, %Y"),
                            bg=background_url)
 
 
-@app.route("/signup", methods=["POST", "GET"])
+@blog.route("/signup", methods=["POST", "GET"])
 def signup():
     """Signup page"""
     bg = r"/static/home-bg-copy.jpg"
     if current_user.is_authenticated:
-        return redirect(url_for("index"))
+        return redirect(url_for("blog.index"))
 
     form = RegiterForm()
     if request.method == "POST":
         if form.validate_on_submit():
+            if throttled():
+                flash("Too many attempts, try again in a few minutes.")
+                return render_template("signup.html", form=form, bg=bg,
+                                       copyRight=datetime.datetime.now().strftime("%Y")), 429
+            ip_throttle.hit(request.remote_addr)
             check = db.session.query(User).filter_by(
                 email=form.email.data).first()
             if check is None:
@@ -282,8 +799,7 @@ def signup():
                     last_name=form.last_name.data.strip().capitalize(),
                     birth_date=form.birth_date.data,
                     email=form.email.data.strip(),
-                    password=bcrypt.generate_password_hash(
-                        form.password.data.strip()).decode("utf-8"),
+                    password=passwords.hash(form.password.data.strip()),
                     # token=User.generate_token(),
                     # username=User.generate_username()
                 )
@@ -292,66 +808,83 @@ def signup():
                 login_user(user=new_user, remember=True)
                 # if current_user.is_authenticated:
                 #     print(current_user.name)
-                return redirect(url_for("index"))
+                return redirect(url_for("blog.index"))
             else:
                 flash("Email already exists")
-                return redirect(url_for("login"))
+                return redirect(url_for("blog.login"))
         flash("Incomplete Entry")
     return render_template("signup.html", form=form, bg=bg,
                            copyRight=datetime.datetime.now().strftime("%Y"))
 
 
-@app.route('/login', methods=["POST", "GET"])
+@blog.route('/login', methods=["POST", "GET"])
 def login():
     """Log in to account"""
     bg = r"/static/home-bg-copy.jpg"
     if login_fresh():
-        return redirect(url_for('index'))
+        return redirect(url_for('blog.index'))
     login_form = LoginForm()
     if request.method == "POST":
         if login_form.validate_on_submit():
+            email = login_form.email.data.strip().lower()
+            if throttled(email):
+                flash("Too many login attempts, try again in a few minutes.")
+                return render_template("login.html", form=login_form, bg=bg,
+                                       copyRight=datetime.datetime.now().strftime("%Y")), 429
+            ip_throttle.hit(request.remote_addr)
             user_check = db.session.query(User).filter_by(
                 email=login_form.email.data).first()
             if user_check:
-                if bcrypt.check_password_hash(user_check.password, login_form.password.data):
+                if passwords.check(user_check.password, login_form.password.data):
+                    email_throttle.reset(email)
+                    if passwords.needs_rehash(user_check.password):
+                        # Move the hash to the target cost while we have the password.
+                        user_check.password = passwords.hash(login_form.password.data)
+                        db.session.commit()
                     login_user(user=user_check, remember=True)
                     # Gets the input value of #next_url in the "login.html" for the code below.
                     next_url = request.form.get("next")
                     if not next_url:
-                        next_url = session["url"]
+                        next_url = session.get("url")
                     # Using the code above, the url is redirected to next or secret.
                     # This is implemented to directly redirect the user
                     # to desired endpoint that needs fresh login.
-                    return redirect(next_url or url_for("index"))
+                    return redirect(next_url or url_for("blog.index"))
+                email_throttle.hit(email)
                 flash("Invalid Username or Password")
             else:
                 flash("Email not found, create an account to log in.")
-                return redirect(url_for("signup"))
+                return redirect(url_for("blog.signup"))
     return render_template("login.html", form=login_form, bg=bg,
                            copyRight=datetime.datetime.now().strftime("%Y"))
 
 
-@app.route("/posts/<int:page>", methods=["POST", "GET"])
+@blog.route("/posts/<int:page>", methods=["POST", "GET"])
+@validated(listing_version, page_cache_control)
+@page_cache.cached("listing")
 def posts(page):
     """Posts Page"""
-    session["url"] = f"posts/{page}"
+    remember_url()
     bg_url = r"/static/home-bg-copy.jpg"
-    all_data = get_data()
-    total_posts = all_data[1]
-    if len(total_posts) > 10:
-        # For displaying the data in reverse, displays 10 items only.
-        data = total_posts[0:-10*page][::-1][:10]
+    total_posts = count_posts()
+    if total_posts > PER_PAGE:
+        # The Prev/Next links carry the id of the post at the page edge,
+        # so walking the pages seeks on the primary key instead of an OFFSET.
+        data = post_summaries(page, before=request.args.get("before", type=int),
+                              after=request.args.get("after", type=int))
 
-        pages = post_per_page(total_posts)  # Pagination
+        pages = last_page(total_posts)  # Pagination
+        prev_cursor, next_cursor = page_cursors(data)
 
         return render_template("index.html", posts=data,
                                copyRight=datetime.datetime.now().strftime("%Y"),
                                bg=bg_url, page=pages, current_page=page,
+                               prev_cursor=prev_cursor, next_cursor=next_cursor,
                                today=datetime.datetime.now().strftime("%B %d, %Y"))
-    return redirect(url_for("index"))
+    return redirect(url_for("blog.index"))
 
 
-@app.route("/new-post", methods=["POST", "GET"])
+@blog.route("/new-post", methods=["POST", "GET"])
 @fresh_login_required
 def new_post():
     """Add New Post Page"""
@@ -368,58 +901,108 @@ def new_post():
             article_author=new_post_form.blog_author.data,
             img_url=new_post_form.blog_img_url.data,  # update this to also upload an image
             source_url=new_post_form.source_link.data,
-            body=strip_invalid_html(new_post_form.blog_content.data)
+            **sanitize_post(new_post_form.blog_content.data)
         )
         db.session.add(new_blog_post)
         db.session.commit()
+        post_saved.send(current_app._get_current_object(), post_id=new_blog_post.id, created=True)
         # The commentted code below is for redirecting
         # to the current user's latest post, not yet working.
         # latest_post=db.session.query(BlogPost).filter_by(uploader_id=current_user.id).order_by(BlogPost.id).first()
         # print(latest_post.id)
-        return redirect(url_for("index"))
+        return redirect(url_for("blog.index"))
     return render_template("new_post.html", form=new_post_form,
                            message=message, bg=background_url,
                            copyRight=datetime.datetime.now().strftime("%Y"))
 
 
-@app.route("/post/<int:number>", methods=["GET", "POST"])
+@blog.route("/post/<int:number>", methods=["GET", "POST"])
+@validated(post_page_version, page_cache_control)
+@page_cache.cached("post:{number}")
 def get_post(number):
     """Get individual post"""
-    session["url"] = f"post/{number}"
-    data = db.session.get(BlogPost, number)
+    remember_url()
+    if request.method == "GET":
+        data = post_detail(number)
+    else:
+        # A comment POST only needs to know the post is there.
+        data = db.session.get(BlogPost, number)
     if data is not None:
-        comment_form = CommentForm()
+        # Building a CSRF token writes the session, so anonymous visitors,
+        # who cannot comment anyway, get a form without one.
+        comment_form = CommentForm(meta={"csrf": current_user.is_authenticated})
         if request.method == "POST":
+            # Without JavaScript the comment form posts here; with it, to post_comments.
             if current_user.is_authenticated:
-                if comment_form.validate_on_submit():
-                    new_comment = Comment(
-                        text=strip_invalid_html(comment_form.text.data),
-                        author_id=current_user.id,
-                        post_id=data.id,
-                        date_created=datetime.datetime.now()
-                        # Create a route for editing the comment that is a copy of this route.
-                    )
-                    db.session.add(new_comment)
-                    db.session.commit()
-                    return redirect(url_for("get_post", number=number))
-                return redirect(url_for("get_post", number=number))
+                add_comment(number, comment_form)
+                return redirect(url_for("blog.get_post", number=number))
             flash("Log in to post comment")
-            return redirect(url_for("login", next=f"post/{number}"))
-        next_post = [idx.id for idx in get_data()[1]]
-        background_url = data.img_url
+            return redirect(url_for("blog.login", next=f"post/{number}"))
+        older_id, newer_id = get_neighbors(number)
+        background_url = post_background(data.id, data.img_url)
+        # The static copy has nothing to fetch later pages of comments from.
+        per_page = max(data.comment_count, COMMENTS_PER_PAGE) if prerendering() \
+            else COMMENTS_PER_PAGE
+        comments, next_url = comment_page(number, per_page=per_page)
         return render_template("post.html", post=data, bg=background_url,
-                               next_item=next_post, form=comment_form,
+                               older_id=older_id, newer_id=newer_id, form=comment_form,
+                               comments=comments, next_url=next_url,
+                               likes=like_states(number, comments),
                                copyRight=datetime.datetime.now().strftime("%Y"))
-    return redirect(url_for("index"))
+    return redirect(url_for("blog.index"))
 
 
-@app.route("/edit-post/<int:number>", methods=["POST", "GET"])
+@blog.route("/post/<int:number>/comments", methods=["GET", "POST"])
+@validated(comment_page_version, page_cache_control)
+@page_cache.cached("post:{number}")
+def post_comments(number):
+    """The page of comments after ?after=<cursor> as an HTML fragment (GET),
+    or a new comment, answered with just that comment's fragment (POST)"""
+    if db.session.scalar(select(BlogPost.id).where(BlogPost.id == number)) is None:
+        abort(404)
+    if request.method == "POST":
+        if not current_user.is_authenticated:
+            abort(401)
+        comment_id = add_comment(number, CommentForm())
+        if comment_id is None:
+            abort(400)
+        new_comment = db.session.get(Comment, comment_id, populate_existing=True,
+                                     options=QUERY_PROFILES["comments"])
+        return render_template("comments.html", comments=[new_comment], next_url=None,
+                               likes={comment_id: (0, False)}), 201
+    after = request.args.get("after")
+    cursor = decode_cursor(after) if after else None
+    if after and cursor is None:
+        abort(400)
+    comments, next_url = comment_page(number, cursor)
+    return render_template("comments.html", comments=comments, next_url=next_url,
+                           likes=like_states(number, comments))
+
+
+@blog.route("/post/<int:number>/image/<key>")
+def post_image(number, key):
+    """A post's image from the local cache, resized with ?w=<width>"""
+    img_url = db.session.scalar(select(BlogPost.img_url).where(BlogPost.id == number))
+    if not img_url:
+        abort(404)
+    if url_key(img_url)[:16] != key:
+        # The post has a new image since this link was made.
+        return redirect(url_for("blog.post_image", number=number, key=url_key(img_url)[:16],
+                                **request.args))
+    try:
+        return image_proxy.send(img_url, request.args.get("w", type=int),
+                                request.accept_mimetypes)
+    except FetchError:
+        return redirect(img_url)
+
+
+@blog.route("/edit-post/<int:number>", methods=["POST", "GET"])
 @fresh_login_required
 def edit_post(number):
     """Edit a post"""
     message = "Edit Post"
-    data = db.session.get(BlogPost, number)
-    background_url = data.img_url
+    data = db.session.get(BlogPost, number, options=(undefer(BlogPost.body),))
+    background_url = post_background(data.id, data.img_url)
     edit_post_form = AddPost(
         blog_title=data.title,
         blog_subtitle=data.subtitle,
@@ -435,85 +1018,350 @@ def edit_post(number):
         data.subtitle = edit_post_form.blog_subtitle.data
         data.article_author = edit_post_form.blog_author.data
         data.img_url = edit_post_form.blog_img_url.data
-        data.body = strip_invalid_html(edit_post_form.blog_content.data)
+        for column, value in sanitize_post(edit_post_form.blog_content.data).items():
+            setattr(data, column, value)
         data.edit_date = datetime.datetime.now()
         data.source_url = edit_post_form.source_link.data
         db.session.commit()
-        return redirect(url_for("get_post", number=number))
+        post_saved.send(current_app._get_current_object(), post_id=number, created=False)
+        return redirect(url_for("blog.get_post", number=number))
     return render_template("new_post.html", form=edit_post_form,
                            message=message, bg=background_url,
                            state=state, number=number, copyRight=datetime.datetime.now().strftime("%Y"))
 
 
-@app.route('/delete-post/<int:number>', methods=["GET"])
+@blog.route('/delete-post/<int:number>', methods=["GET"])
 @fresh_login_required
 def delete_post(number):
     """Delete page"""
     post = db.session.get(BlogPost, number)
+    older_id, newer_id = get_neighbors(number)
     db.session.delete(post)
     db.session.commit()
-    return redirect(url_for("index"))
+    post_deleted.send(current_app._get_current_object(), post_id=number, older_id=older_id, newer_id=newer_id)
+    return redirect(url_for("blog.index"))
 
 
-@app.route('/delete-comment/<int:number>')
+@blog.route("/comment/<int:number>/like", methods=["POST", "DELETE"])
+@login_required
+def like_comment(number):
+    """Like (POST) or unlike (DELETE) a comment, answered with its new state"""
+    try:
+        validate_csrf(request.headers.get("X-CSRFToken"))
+    except ValidationError:
+        abort(400)
+    comment = db.session.get(Comment, number)
+    if comment is None:
+        abort(404)
+    wanted = request.method == "POST"
+    like_buffer.set(number, current_user.id, wanted)
+    count, liked = like_states(comment.post_id, [comment])[number]
+    return jsonify(comment_id=number, liked=liked, like_count=count)
+
+
+@blog.route('/delete-comment/<int:number>')
 @fresh_login_required
 def delete_comment(number):
     """For Deleting comment"""
     pass
 
 
-@app.route('/form-entry', methods=["POST", "GET"])
+@blog.route('/form-entry', methods=["POST", "GET"])
 @login_required
 def form_entry():
     """Form entry"""
-    session["url"] = f"/{request.endpoint}"
+    remember_url()
     background_url = r"static/assets/img/contact-bg.jpg"
     if request.method == "POST":
-        name = current_user.name
-        email = current_user.email
-        message = request.form["message"]
-        phone_number = request.form.get("phoneNumber")
-
-        body = f"""Name:{name}\nEmail:{email}\nPhone number:{phone_number}\nMessage:{message}."""
-        print(body)
+        job_queue.enqueue("deliver-contact", {
+            "name": current_user.full_name, "email": current_user.email,
+            "phone_number": request.form.get("phoneNumber"),
+            "message": request.form["message"]})
         response = "Your message is sent."
         return render_template("contact.html", message=response,
                                bg=background_url, copyRight=datetime.datetime.now().strftime("%Y"))
     return redirect("contact")
 
 
-@app.route("/logout")
+@blog.route("/logout")
 @login_required
 def logout():
     """Log out user"""
     logout_user()
-    return redirect(session["url"] or url_for("index"))
+    return redirect(session.get("url") or url_for("blog.index"))
+
+
+def search_results(per_page=PER_PAGE):
+    """Query string, page number and hits for the search routes"""
+    query = request.args.get("q", "").strip()[:200]
+    page = max(request.args.get("page", 1, type=int), 1)
+    hits = search.search(db.session, query, limit=per_page,
+                         offset=(page - 1) * per_page) if query else []
+    return query, page, hits
+
+
+@blog.route("/search")
+def search_page():
+    """Full-text search over the posts"""
+    query, page, hits = search_results()
+    return render_template("search.html", query=query, page=page, hits=hits,
+                           per_page=PER_PAGE, bg=r"/static/home-bg-copy.jpg",
+                           copyRight=datetime.datetime.now().strftime("%Y"))
 
 
-@app.route('/aboutme')
+@blog.route("/search.json")
+def search_json():
+    """Full-text search over the posts, as JSON"""
+    query, page, hits = search_results()
+    results = [{"id": hit.id, "title": str(hit.title), "subtitle": hit.subtitle,
+                "snippet": str(hit.snippet), "rank": hit.rank,
+                "url": url_for("blog.get_post", number=hit.id, _external=True)}
+               for hit in hits]
+    next_page = page + 1 if len(hits) == PER_PAGE else None
+    return jsonify(query=query, page=page, next_page=next_page, results=results)
+
+
+# Read-only JSON API ----------------------------------------------------------
+
+API_POST_FIELDS = ("id", "title", "subtitle", "article_author", "date", "edit_date",
+                   "excerpt", "word_count", "comment_count", "img_url", "source_url",
+                   "uploader", "body")
+# List calls leave the body out unless it is asked for with ?fields=.
+API_LIST_FIELDS = API_POST_FIELDS[:-1]
+API_MAX_LIMIT = 50
+
+
+def api_fields(default):
+    """Fields picked with ?fields=a,b,c, or the default set"""
+    requested = request.args.get("fields")
+    if not requested:
+        return default
+    fields = [field.strip() for field in requested.split(",") if field.strip()]
+    unknown = set(fields) - set(API_POST_FIELDS)
+    if unknown:
+        abort(400, f"Unknown fields: {', '.join(sorted(unknown))}")
+    return tuple(dict.fromkeys(["id", *fields]))
+
+
+def api_limit():
+    """Page size from ?limit=, capped at API_MAX_LIMIT"""
+    return min(max(request.args.get("limit", PER_PAGE, type=int), 1), API_MAX_LIMIT)
+
+
+def api_post_options(fields):
+    """Load only the columns the response needs, plus the dates behind the ETag"""
+    columns = [getattr(BlogPost, field) for field in fields
+               if field in BlogPost.__table__.columns]
+    options = [load_only(*columns, BlogPost.date, BlogPost.edit_date,
+                         BlogPost.comment_count)]
+    if "uploader" in fields:
+        options.append(joinedload(BlogPost.uploader)
+                       .load_only(User.first_name, User.last_name))
+    return options
+
+
+def api_value(value):
+    """JSON-friendly value, dates as ISO 8601"""
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    return value
+
+
+def api_post(post, fields):
+    """One post as a dict with just the selected fields"""
+    data = {name: api_value(value) for name, value in post.to_dict(fields).items()}
+    if "uploader" in fields:
+        data["uploader"] = post.uploader.full_name
+    return data
+
+
+def post_version(post):
+    """What a post's ETag is derived from"""
+    return post.id, post.edit_date or post.date, post.comment_count
+
+
+@blog.route("/api/v1/posts")
+def api_posts():
+    """Posts newest first, paginated with ?cursor=<id of the last post seen>"""
+    fields = api_fields(API_LIST_FIELDS)
+    data = fetch_page(db.session, BlogPost, before=request.args.get("cursor", type=int),
+                      per_page=api_limit(), options=api_post_options(fields))
+    next_cursor = data[-1].id if len(data) == api_limit() else None
+    return conditional(
+        lambda: jsonify(posts=[api_post(post, fields) for post in data],
+                        next_cursor=next_cursor),
+        etag=make_etag("posts", fields, [post_version(post) for post in data]),
+        last_modified=max((post.edit_date or post.date for post in data), default=None))
+
+
+@blog.route("/api/v1/posts/<int:number>")
+def api_post_detail(number):
+    """One post, with its body unless ?fields= leaves it out"""
+    fields = api_fields(API_POST_FIELDS)
+    version = db.session.execute(
+        select(BlogPost.id, BlogPost.edit_date, BlogPost.date, BlogPost.comment_count)
+        .where(BlogPost.id == number)).first()
+    if version is None:
+        abort(404)
+
+    def build():
+        post = db.session.get(BlogPost, number, options=api_post_options(fields))
+        return jsonify(post=api_post(post, fields))
+    return conditional(build, etag=make_etag("post", fields, tuple(version)),
+                       last_modified=version.edit_date or version.date)
+
+
+@blog.route("/api/v1/posts/<int:number>/comments")
+def api_post_comments(number):
+    """A post's comments newest first, paginated with ?cursor=<comment id>"""
+    if db.session.get(BlogPost, number) is None:
+        abort(404)
+    comments = fetch_page(db.session, Comment, before=request.args.get("cursor", type=int),
+                          per_page=api_limit(), options=QUERY_PROFILES["comments"],
+                          criteria=(Comment.post_id == number,))
+    next_cursor = comments[-1].id if len(comments) == api_limit() else None
+
+    def build():
+        return jsonify(comments=[{"id": comment.id, "text": comment.text,
+                                  "author": comment.comment_author.full_name,
+                                  "date_created": api_value(comment.date_created),
+                                  "date_edited": api_value(comment.date_edited),
+                                  "like_count": comment.like_count}
+                                 for comment in comments],
+                       next_cursor=next_cursor)
+    return conditional(build, etag=make_etag(
+        "comments", number, [(comment.id, comment.date_edited, comment.like_count)
+                             for comment in comments]))
+
+
+@blog.route("/api/v1/posts.ndjson")
+def api_export_posts():
+    """Every post as newline-delimited JSON, streamed from a server-side cursor"""
+    fields = api_fields(API_POST_FIELDS)
+    statement = (select(BlogPost).options(*api_post_options(fields))
+                 .order_by(BlogPost.id).execution_options(yield_per=500))
+
+    def generate():
+        for post in db.session.scalars(statement):
+            yield json.dumps(api_post(post, fields)) + "\n"
+    return current_app.response_class(stream_with_context(generate()),
+                              mimetype="application/x-ndjson")
+
+
+# Feed and sitemap ------------------------------------------------------------
+
+# Neither differs per visitor, so shared caches may keep them for a while.
+FEED_CACHE_CONTROL = "public, max-age=300"
+
+
+def feed_version(number=None):
+    """Validators for the feed and sitemaps, from the newest post, edit and id"""
+    newest, edited, highest = db.session.execute(
+        select(func.max(BlogPost.date), func.max(BlogPost.edit_date),
+               func.max(BlogPost.id))).one()
+    last_modified = max(filter(None, (newest, edited)), default=None)
+    # The host is in the ETag, and so in the page cache key, because these
+    # responses hold absolute URLs.
+    return (make_etag(request.host_url, request.path, newest, edited, highest, count_posts()),
+            last_modified)
+
+
+def xml_response(body, mimetype=feeds.XML_TYPE):
+    """Response for an XML document built by feeds"""
+    return current_app.response_class(body, mimetype=mimetype)
+
+
+def sitemap_urls(number):
+    """(url, last modified) of the pages listed in one sitemap file"""
+    urls = []
+    if number == 1:
+        urls += [(url_for("blog.index", _external=True), None),
+                 (url_for("blog.aboutme", _external=True), None)]
+    rows = db.session.execute(
+        select(BlogPost.id, BlogPost.date, BlogPost.edit_date)
+        .where(BlogPost.id > (number - 1) * feeds.POSTS_PER_SITEMAP,
+               BlogPost.id <= number * feeds.POSTS_PER_SITEMAP)
+        .order_by(BlogPost.id))
+    urls += [(url_for("blog.get_post", number=row.id, _external=True),
+              row.edit_date or row.date) for row in rows]
+    return urls
+
+
+@blog.route("/feed.xml")
+@validated(feed_version, FEED_CACHE_CONTROL)
+@page_cache.cached("feed", ttl=0)
+def feed():
+    """Atom feed of the newest posts"""
+    rows = db.session.execute(
+        select(BlogPost.id, BlogPost.title, BlogPost.excerpt, BlogPost.article_author,
+               BlogPost.date, BlogPost.edit_date)
+        .order_by(BlogPost.id.desc()).limit(feeds.FEED_SIZE))
+    entries = [(url_for("blog.get_post", number=row.id, _external=True), row.title,
+                row.excerpt, row.article_author, row.date, row.edit_date) for row in rows]
+    return xml_response(feeds.atom_feed("VNC | Agora", url_for("blog.feed", _external=True),
+                                        url_for("blog.index", _external=True), entries),
+                        feeds.ATOM_TYPE)
+
+
+@blog.route("/sitemap.xml")
+@validated(feed_version, FEED_CACHE_CONTROL)
+@page_cache.cached("sitemap", ttl=0)
+def sitemap():
+    """Sitemap of every post, or an index of numbered sitemaps past the URL limit"""
+    highest = db.session.scalar(select(func.max(BlogPost.id))) or 0
+    if highest <= feeds.POSTS_PER_SITEMAP:
+        return xml_response(feeds.sitemap(sitemap_urls(1)))
+    part = (BlogPost.id - 1) // feeds.POSTS_PER_SITEMAP + 1
+    rows = db.session.execute(
+        select(part, func.max(func.coalesce(BlogPost.edit_date, BlogPost.date)))
+        .group_by(part).order_by(part))
+    return xml_response(feeds.sitemap_index(
+        [(url_for("blog.sitemap_file", number=number, _external=True), modified)
+         for number, modified in rows]))
+
+
+@blog.route("/sitemap-<int:number>.xml")
+@validated(feed_version, FEED_CACHE_CONTROL)
+@page_cache.cached("sitemap:{number}", ttl=0)
+def sitemap_file(number):
+    """One of the numbered sitemaps listed by /sitemap.xml"""
+    urls = sitemap_urls(number) if number >= 1 else []
+    if len(urls) <= (2 if number == 1 else 0):
+        abort(404)
+    return xml_response(feeds.sitemap(urls))
+
+
+@blog.route('/aboutme')
+@validated(static_page_version, page_cache_control)
+@page_cache.cached("about")
 def aboutme():
     """About me page"""
-    session["url"] = f"/{request.endpoint}"
-    print(session["url"])
+    remember_url()
     background_url = r"static/assets/img/about-bg.jpg"
     return render_template("aboutme.html", bg=background_url, copyRight=datetime.datetime.now().strftime("%Y"))
 
 
-@app.route("/new-password", methods=["POST", "GET"])
+@blog.route("/new-password", methods=["POST", "GET"])
 @fresh_login_required
 def new_password():
     """Changing the password function"""
-    session["url"] = f"/{request.endpoint}"
+    remember_url()
     change_form = ChangePassword()
     if request.method == "POST" and change_form.validate_on_submit():
+        if throttled(current_user.email):
+            flash("Too many attempts, try again in a few minutes.")
+            return render_template("new_password.html", form=change_form,
+                                   copyRight=datetime.datetime.now().strftime("%Y")), 429
+        ip_throttle.hit(request.remote_addr)
         user = db.session.query(User).filter_by(id=current_user.id).first()
-        if user and bcrypt.check_password_hash(user.password, change_form.current_password.data):
-            user.password = bcrypt.generate_password_hash(
-                change_form.new_password.data.strip(), 10).decode("utf-8")
+        if user and passwords.check(user.password, change_form.current_password.data):
+            user.password = passwords.hash(change_form.new_password.data.strip())
             user.token = secrets.token_hex()
             user.date_updated = datetime.datetime.now()
             db.session.commit()
-            return redirect(url_for('index'))
+            user_cache.invalidate(user.id)
+            return redirect(url_for('blog.index'))
+        email_throttle.hit(current_user.email.lower())
         flash("Incorrect Current Password")
     if change_form.errors:
         for error, message in change_form.errors.items():
@@ -522,7 +1370,7 @@ def new_password():
                            copyRight=datetime.datetime.now().strftime("%Y"))
 
 
-@app.route("/new-username/<username>", methods=["POST", "GET"])
+@blog.route("/new-username/<username>", methods=["POST", "GET"])
 @fresh_login_required
 def change_username(username):
     """Route for changing username"""
@@ -531,33 +1379,38 @@ def change_username(username):
         user = db.session.query(User).filter_by(id=current_user.id).first()
         user.username = username
         db.session.commit()
+        user_cache.invalidate(user.id)
         # print(user.id)
         # print(current_user.id)
-    return redirect(url_for("index"))
+    return redirect(url_for("blog.index"))
 
 
-@app.route("/delete-account")
+@blog.route("/delete-account")
 @fresh_login_required
 def delete_account():
     """Delete the current user's account in the database"""
-    remove = db.session.get(User, current_user.id)
+    user_id = current_user.id
+    post_ids = db.session.scalars(
+        select(BlogPost.id).where(BlogPost.uploader_id == user_id)).all()
+    remove = db.session.get(User, user_id)
     db.session.delete(remove)
     db.session.commit()
-    return redirect(url_for("index"))
+    user_deleted.send(current_app._get_current_object(), user_id=user_id, post_ids=post_ids)
+    return redirect(url_for("blog.index"))
 
 
-@app.route('/contact')
+@blog.route('/contact')
 @login_required
 def contact():
     """Contact page"""
-    session["url"] = f"/{request.endpoint}"
+    remember_url()
     background_url = r"static/assets/img/contact-bg.jpg"
     message = "Contact Me"
     return render_template("contact.html", bg=background_url,
                            message=message, copyRight=datetime.datetime.now().strftime("%Y"))
 
 
-@app.route("/secrets")
+@blog.route("/secrets")
 @admin_only
 def secret():
     """Route for the admin to accesc the database"""
@@ -565,7 +1418,245 @@ def secret():
     return "Welcome to Secrets"
 
 
-@app.errorhandler(404)
+@blog.route("/secrets/cache-stats")
+@admin_only
+def cache_stats():
+    """Hit ratios and evictions of this worker's caches"""
+    return jsonify(pages=page_cache.stats(), users=user_cache.stats())
+
+
+@blog.route("/metrics")
+def metrics_endpoint():
+    """Prometheus metrics of every worker, for the admin or a scraper with the token"""
+    if not (metrics.authorized() or is_admin()):
+        return abort(403)
+    return current_app.response_class(metrics.exposition(),
+                              mimetype="text/plain; version=0.0.4")
+
+
+def resanitize_table(model, column, clean_rows, chunk_size, workers, everything):
+    """Re-sanitize one table in id order, chunks cleaned across a process pool"""
+    query = select(model.id, column).order_by(model.id).limit(chunk_size)
+    if not everything:
+        query = query.where(model.sanitized_version < POLICY_VERSION)
+    done = 0
+    last_id = 0
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        while True:
+            # Read a few chunks ahead so every worker process has one to clean.
+            chunks = []
+            for _ in range(workers):
+                rows = db.session.execute(query.where(model.id > last_id)).all()
+                if not rows:
+                    break
+                chunks.append([tuple(row) for row in rows])
+                last_id = rows[-1][0]
+            if not chunks:
+                break
+            for cleaned in pool.map(clean_rows, chunks):
+                db.session.execute(update(model), cleaned)
+                done += len(cleaned)
+            db.session.commit()
+    return done
+
+
+def init_db():
+    """Create missing tables and apply pending migrations"""
+    db.create_all()
+    return upgrade(db.engine)
+
+
+@blog.cli.command("init-db")
+def init_db_command():
+    """Set up or upgrade the schema, once per deploy rather than per worker"""
+    started = time.perf_counter()
+    version = init_db()
+    click.echo(f"Schema at version {version} in {time.perf_counter() - started:.1f}s")
+
+
+@blog.cli.command("resanitize")
+@click.option("--chunk-size", default=500, show_default=True)
+@click.option("--workers", default=os.cpu_count() or 1, show_default=True)
+@click.option("--all", "everything", is_flag=True,
+              help="Also re-clean rows already at the current policy version.")
+@click.option("--background", is_flag=True,
+              help="Queue the work as jobs, one chunk at a time, and return.")
+def resanitize(chunk_size, workers, everything, background):
+    """Re-clean stored posts and comments after the sanitizer policy changes"""
+    if background:
+        for kind in RESANITIZE_TABLES:
+            job_queue.enqueue("resanitize", {"kind": kind, "chunk_size": chunk_size,
+                                             "everything": everything})
+        click.echo(f"Queued re-sanitizing in {job_queue.path}")
+        return
+    started = time.perf_counter()
+    posts_done = resanitize_table(BlogPost, BlogPost.body, sanitize_post_rows,
+                                  chunk_size, workers, everything)
+    comments_done = resanitize_table(Comment, Comment.text, sanitize_comment_rows,
+                                     chunk_size, workers, everything)
+    page_cache.invalidate_all()
+    click.echo(f"Re-sanitized {posts_done} posts and {comments_done} comments "
+               f"in {time.perf_counter() - started:.1f}s")
+
+
+@blog.cli.command("prerender")
+@click.argument("out_dir", required=False)
+@click.option("--full", is_flag=True, help="Render every page, not only the changed ones.")
+def prerender_command(out_dir, full):
+    """Write static copies of the public pages for a web server to serve"""
+    out_dir = out_dir or current_app.config["PRERENDER_DIR"]
+    if not out_dir:
+        raise click.UsageError("Give OUT_DIR or set PRERENDER_DIR")
+    report = prerender_site(out_dir, full)
+    click.echo(f"Rendered {report['rendered']} of {report['pages']} pages, removed "
+               f"{report['removed']}, copied {report['files']} static files "
+               f"in {report['ms']:.1f}ms")
+
+
+@blog.cli.command("run-jobs")
+@click.option("--burst", is_flag=True, help="Exit once no job is due.")
+def run_jobs(burst):
+    """Run background jobs in this process, beside or instead of the web workers"""
+    if burst:
+        started = time.perf_counter()
+        count = job_queue.run_pending()
+        click.echo(f"Ran {count} jobs in {time.perf_counter() - started:.1f}s")
+        return
+    click.echo(f"Running jobs from {job_queue.path}")
+    job_queue.work()
+
+
+@blog.cli.command("retry-jobs")
+def retry_jobs():
+    """Show the job counts and dead jobs, and queue the dead ones again"""
+    counts = job_queue.stats()
+    click.echo(", ".join(f"{count} {status}" for status, count in counts.items()))
+    for job_id, name, attempts, error in job_queue.dead():
+        last_line = (error or "").strip().splitlines()[-1:] or [""]
+        click.echo(f"#{job_id} {name} after {attempts} attempts: {last_line[0]}")
+    click.echo(f"Queued {job_queue.retry_dead()} dead jobs again")
+
+
+@blog.cli.command("rebuild-search")
+def rebuild_search():
+    """Rebuild the full-text index from every post"""
+    started = time.perf_counter()
+    with db.engine.begin() as conn:
+        search.create_index(conn)
+        count = search.rebuild(conn)
+    click.echo(f"Indexed {count} posts in {time.perf_counter() - started:.1f}s")
+
+
+@blog.cli.command("backfill-avatars")
+@click.option("--chunk-size", default=1000, show_default=True)
+def backfill_avatars(chunk_size):
+    """Store the avatar hash for users that do not have one yet"""
+    started = time.perf_counter()
+    with db.engine.begin() as conn:
+        count = avatars.backfill(conn, User.__table__, chunk_size)
+    click.echo(f"Hashed {count} emails in {time.perf_counter() - started:.1f}s")
+
+
+TRANSFER_MODELS = {"users": User, "posts": BlogPost, "comments": Comment}
+
+
+@blog.cli.command("export-data")
+@click.argument("kind", type=click.Choice(list(TRANSFER_MODELS)))
+@click.argument("file", type=click.File("w", encoding="utf-8", lazy=True))
+@click.option("--format", "fmt", type=click.Choice(["jsonl", "csv"]),
+              help="Defaults to csv for .csv files and jsonl otherwise.")
+@click.option("--chunk-size", default=transfer.CHUNK_SIZE, show_default=True)
+def export_data(kind, file, fmt, chunk_size):
+    """Stream every user, post or comment to FILE ("-" for stdout)"""
+    started = time.perf_counter()
+    with db.engine.connect() as conn:
+        count = transfer.export_table(conn, TRANSFER_MODELS[kind].__table__, kind, file,
+                                      transfer.file_format(file.name, fmt), chunk_size)
+    elapsed = time.perf_counter() - started
+    click.echo(f"Exported {count} {kind} in {elapsed:.1f}s "
+               f"({count / max(elapsed, 1e-9):.0f} rows/s)", err=True)
+
+
+@blog.cli.command("import-data")
+@click.argument("kind", type=click.Choice(list(TRANSFER_MODELS)))
+@click.argument("file", type=click.File("r", encoding="utf-8"))
+@click.option("--format", "fmt", type=click.Choice(["jsonl", "csv"]),
+              help="Defaults to csv for .csv files and jsonl otherwise.")
+@click.option("--chunk-size", default=transfer.CHUNK_SIZE, show_default=True)
+@click.option("--workers", default=os.cpu_count() or 1, show_default=True,
+              help="Processes sanitizing chunks in parallel.")
+def import_data(kind, file, fmt, chunk_size, workers):
+    """Add users, posts or comments from an export, all or nothing.
+
+    Import users before their posts and posts before their comments; ids
+    are kept, so they must not clash with rows already in the database.
+    """
+    def progress(count, elapsed):
+        click.echo(f"\r{count} {kind}, {count / max(elapsed, 1e-9):.0f} rows/s",
+                   nl=False, err=True)
+
+    started = time.perf_counter()
+    rows = transfer.read_rows(file, transfer.file_format(file.name, fmt))
+    try:
+        with db.engine.begin() as conn:
+            count = transfer.import_rows(conn, TRANSFER_MODELS[kind].__table__, kind, rows,
+                                         chunk_size, workers, progress)
+            recount(conn)
+    except (ValueError, KeyError, IntegrityError) as error:
+        click.echo(err=True)
+        # Not str(error): an IntegrityError would print a whole chunk of parameters.
+        raise click.ClickException(f"Nothing imported: {getattr(error, 'orig', error)}") from error
+    post_count.invalidate()
+    page_cache.invalidate_all()
+    elapsed = time.perf_counter() - started
+    click.echo(f"\rImported {count} {kind} in {elapsed:.1f}s "
+               f"({count / max(elapsed, 1e-9):.0f} rows/s)", err=True)
+
+
+@blog.cli.command("check-concurrency")
+@click.option("--readers", default=4, show_default=True)
+@click.option("--writers", default=2, show_default=True)
+@click.option("--seconds", default=2.0, show_default=True)
+@click.option("--hold", default=0.5, show_default=True,
+              help="Seconds each write transaction stays open.")
+def check_concurrency(readers, writers, seconds, hold):
+    """Show that SQLite reads go on while write transactions are open"""
+    if db.engine.dialect.name != "sqlite":
+        click.echo("Postgres readers never wait for writers, nothing to check")
+        return
+    result = database.check_concurrency(db.engine, readers, writers, seconds, hold)
+    click.echo(f"{result['reads']} reads, {result['blocked_reads']} blocked, "
+               f"slowest {result['slowest_read_ms']}ms; "
+               f"{result['writes']} writes, {result['locked']} failed as locked")
+    if result["blocked_reads"] or result["locked"]:
+        raise SystemExit("Readers waited on writers or writes failed")
+
+
+@blog.cli.command("build-assets")
+@click.option("--widths", default=",".join(map(str, assets.WIDTHS)), show_default=True,
+              help="Comma-separated widths of the responsive image copies.")
+def build_assets(widths):
+    """Fingerprint, precompress and resize everything under static/"""
+    started = time.perf_counter()
+    manifest = assets.build(current_app.static_folder, static_assets.dist_dir,
+                            widths=[int(width) for width in widths.split(",")])
+    encoders = [encoder[0] for encoder in assets.image_encoders()]
+    click.echo(f"Built {len(manifest['files'])} files and "
+               f"{len(manifest['images'])} responsive images "
+               f"({', '.join(encoders) or 'no image encoders, install Pillow'}"
+               f"{'' if assets.brotli else '; no Brotli'}) "
+               f"in {time.perf_counter() - started:.1f}s")
+
+
+@blog.app_errorhandler(HasherBusy)
+def hasher_busy(error):
+    """Every bcrypt slot is taken, ask the client to come back shortly"""
+    bg = r"/static/home-bg-copy.jpg"
+    return render_template("error_page.html", error="Too many sign-ins right now, please try again in a moment.",
+                           bg=bg, copyRight=datetime.datetime.now().strftime("%Y")), 503, {"Retry-After": "5"}
+
+
+@blog.app_errorhandler(404)
 def page_not_found(error):
     """For displaying error page"""
     bg = r"/static/home-bg-copy.jpg"
@@ -573,5 +1664,97 @@ def page_not_found(error):
                            copyRight=datetime.datetime.now().strftime("%Y")), 404
 
 
+def create_app(config=None):
+    """Build the app from the environment, with config overriding it.
+
+    Nothing here touches the database; run `flask init-db` to create or
+    upgrade the schema. gunicorn --preload "server:create_app()" builds the
+    app once in the master and forks it into every worker.
+    """
+    app = Flask(__name__)
+    app.config["SECRET_KEY"] = os.environ.get("FLASK_KEY")
+    app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get(
+        "DB_URI", "sqlite:///posts.db")
+    # Shared by the web workers, the CLI and the job runners on this host, so an
+    # invalidation from any of them reaches them all.
+    app.config["PAGE_CACHE_BACKEND"] = os.environ.get("PAGE_CACHE", "sqlite")
+    # "http", or "local:<directory>" to serve post images from files during development.
+    app.config["IMAGE_FETCHER"] = os.environ.get("IMAGE_FETCHER", "http")
+    # Serve comment avatars from our own origin through the image cache.
+    app.config["AVATAR_LOCAL"] = os.environ.get("AVATAR_LOCAL", "") == "1"
+    # Cache-Control for pages served to anonymous visitors, which a proxy may share.
+    app.config["PUBLIC_CACHE_CONTROL"] = os.environ.get(
+        "PUBLIC_CACHE_CONTROL", "public, max-age=60")
+    # Target bcrypt cost. Older hashes are upgraded the next time their owner logs in.
+    app.config["BCRYPT_LOG_ROUNDS"] = int(os.environ.get("BCRYPT_ROUNDS", 12))
+    app.config["BCRYPT_THREADS"] = int(os.environ.get("BCRYPT_THREADS", 2))
+    app.config["BCRYPT_QUEUE_DEPTH"] = int(os.environ.get("BCRYPT_QUEUE_DEPTH", 8))
+    # Report each request's statement count in a header, for benchmark.py.
+    app.config["QUERY_COUNT_HEADER"] = os.environ.get("QUERY_COUNT_HEADER", "") == "1"
+    # Bearer token a Prometheus scraper sends to read /metrics without an admin login.
+    app.config["METRICS_TOKEN"] = os.environ.get("METRICS_TOKEN")
+    app.config["METRICS_SLOW_REQUEST_MS"] = int(os.environ.get("SLOW_REQUEST_MS", 500))
+    # Job threads per web worker; 0 when `flask run-jobs` runs beside gunicorn instead.
+    app.config["JOB_WORKERS"] = int(os.environ.get("JOB_WORKERS", 1))
+    # "log", or "maildir:<directory>" to keep contact messages for a mail client.
+    app.config["CONTACT_SINK"] = os.environ.get("CONTACT_SINK", "log")
+    app.config["CONTACT_RECIPIENT"] = os.environ.get("CONTACT_RECIPIENT", "admin@localhost")
+    # Public address of the site, for the absolute URLs in pages rendered off-request.
+    # Unset, the feed and sitemaps are not warmed and static copies use http://localhost.
+    app.config["SITE_URL"] = os.environ.get("SITE_URL")
+    # Where `flask prerender` writes the static copy; when set, content changes update it.
+    app.config["PRERENDER_DIR"] = os.environ.get("PRERENDER_DIR")
+    # Most statements a request to each endpoint may run before QueryBudget warns.
+    app.config["QUERY_BUDGETS"] = {
+        "blog.index": 4,
+        "blog.posts": 4,
+        "blog.get_post": 6,
+        "blog.post_comments": 4,
+        "blog.aboutme": 1,
+        "blog.feed": 3,
+    }
+    # Proxies in front of the app whose X-Forwarded-* headers are trusted: 1 behind
+    # the Heroku router or nginx, 2 behind varnish and nginx, 0 when clients connect
+    # directly. Without it every client has the proxy's address, and the per-IP
+    # sign-in throttle becomes one bucket shared by everyone.
+    app.config["PROXY_HOPS"] = int(os.environ.get("PROXY_HOPS", 0))
+    app.config.update(config or {})
+    if app.config["PROXY_HOPS"]:
+        hops = app.config["PROXY_HOPS"]
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=hops, x_proto=hops, x_host=hops)
+    # Pool sizes are per worker process; SQLite connections also get the WAL pragmas.
+    app.config.setdefault("SQLALCHEMY_ENGINE_OPTIONS", database.engine_options(
+        app.config["SQLALCHEMY_DATABASE_URI"],
+        pool_size=int(os.environ.get("DB_POOL_SIZE", 5)),
+        max_overflow=int(os.environ.get("DB_MAX_OVERFLOW", 10))))
+
+    db.init_app(app)
+    bt5.init_app(app)
+    bcrypt.init_app(app)
+    passwords.init_app(app, bcrypt)
+    ckeditor.init_app(app)
+    login_manager.init_app(app)
+    query_budget.init_app(app)
+    metrics.init_app(app)
+    page_cache.init_app(app)
+    user_cache.init_app(app, page_cache)
+    like_buffer.init_app(app, db)
+    static_assets.init_app(app)
+    image_proxy.init_app(app)
+    avatar_links.init_app(app, image_proxy)
+    job_queue.init_app(app)
+    app.register_blueprint(blog)
+
+    # Changes whenever a deploy ships different templates.
+    app.config.setdefault("TEMPLATE_VERSION", max(
+        entry.stat().st_mtime_ns
+        for entry in os.scandir(os.path.join(app.root_path, "templates"))))
+    # Pages link to fingerprinted assets, so a new asset build is a new page version.
+    app.config.setdefault("ASSET_VERSION", make_etag(static_assets.manifest))
+    with app.app_context():
+        database.dispose_after_fork(db.engine)
+    return app
+
+
 if __name__ == "__main__":
-    app.run(debug=False)
+    create_app().run(debug=False)
@@ -0,0 +1,15 @@
+"""Signals sent after blog content is written to the database"""
+from blinker import Namespace
+
+_signals = Namespace()
+
+# Sent with post_id and created=True/False after new_post or edit_post commits.
+post_saved = _signals.signal("post-saved")
+# Sent with post_id and the ids of its older/newer neighbours before deletion.
+post_deleted = _signals.signal("post-deleted")
+# Sent with post_id and comment_id after a comment is committed.
+comment_added = _signals.signal("comment-added")
+# Sent with the post_ids whose comments had likes written in a LikeBuffer flush.
+likes_flushed = _signals.signal("likes-flushed")
+# Sent with user_id after an account, and everything it owned, is deleted.
+user_deleted = _signals.signal("user-deleted")
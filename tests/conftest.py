@@ -0,0 +1,63 @@
+"""Shared fixtures: an app on a throwaway SQLite database, seeded with posts"""
+import datetime
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import server  # noqa: E402  pylint: disable=wrong-import-position
+from cache import SQLiteCache  # noqa: E402  pylint: disable=wrong-import-position
+
+
+@pytest.fixture
+def app(tmp_path):
+    """App with its schema set up, every file it writes kept under tmp_path"""
+    app = server.create_app({
+        "TESTING": True,
+        "SECRET_KEY": "test",
+        "SQLALCHEMY_DATABASE_URI": f"sqlite:///{tmp_path / 'blog.db'}",
+        "PAGE_CACHE_BACKEND": "null",
+        "PAGE_CACHE_DIR": str(tmp_path / "page-cache"),
+        "IMAGE_CACHE_DIR": str(tmp_path / "images"),
+        "METRICS_DIR": str(tmp_path / "metrics"),
+        "JOB_QUEUE_PATH": str(tmp_path / "jobs.sqlite3"),
+        "JOB_WORKERS": 0,
+        "BCRYPT_LOG_ROUNDS": 4,
+    })
+    with app.app_context():
+        server.init_db()
+    yield app
+    with app.app_context():
+        server.db.engine.dispose()
+
+
+@pytest.fixture
+def posts(app):
+    """Ids of 25 posts by one user, oldest first, the newest with comments"""
+    with app.app_context():
+        user = server.User(email="author@example.com", password="x", first_name="Ada",
+                           last_name="Lovelace", birth_date=datetime.date(1990, 1, 1))
+        server.db.session.add(user)
+        server.db.session.flush()
+        now = datetime.datetime.now()
+        posts = [server.BlogPost(uploader_id=user.id, title=f"Post {number}", subtitle="Sub",
+                                 article_author="Ada", date=now, body=f"<p>Body {number}</p>")
+                 for number in range(1, 26)]
+        server.db.session.add_all(posts)
+        server.db.session.flush()
+        server.db.session.add_all(
+            server.Comment(text=f"Comment {number}", author_id=user.id,
+                           post_id=posts[-1].id, date_created=now)
+            for number in range(5))
+        server.db.session.commit()
+        return [post.id for post in posts]
+
+
+@pytest.fixture
+def page_cache(app, tmp_path):
+    """The app's PageCache on a SQLite backend instead of the null one"""
+    cache = app.extensions["page_cache"]
+    cache.backend = SQLiteCache(str(tmp_path / "page-cache.sqlite3"))
+    return cache
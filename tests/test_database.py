@@ -0,0 +1,46 @@
+"""Concurrent writers on a WAL SQLite database wait for each other instead of failing"""
+import datetime
+import threading
+
+from sqlalchemy import func, select, text
+
+import database
+import server
+
+
+def test_sqlite_runs_in_wal_mode(app):
+    with app.app_context():
+        assert server.db.session.execute(text("PRAGMA journal_mode")).scalar() == "wal"
+
+
+def test_concurrent_writers_are_never_locked_out(app, posts):
+    errors = []
+
+    def write(worker):
+        with app.app_context():
+            try:
+                for number in range(20):
+                    server.db.session.add(server.BlogPost(
+                        uploader_id=1, title=f"Worker {worker} post {number}", subtitle="Sub",
+                        article_author="Ada", date=datetime.datetime.now(), body="<p>Body</p>"))
+                    server.db.session.commit()
+            except Exception as error:  # pylint: disable=broad-except
+                errors.append(error)
+
+    threads = [threading.Thread(target=write, args=(worker,)) for worker in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not errors
+    with app.app_context():
+        assert server.db.session.scalar(select(func.count(server.BlogPost.id))) == 25 + 8 * 20
+
+
+def test_readers_carry_on_while_writers_hold_the_lock(app):
+    with app.app_context():
+        result = database.check_concurrency(server.db.engine, readers=2, writers=3,
+                                            seconds=1.0, hold=0.2)
+    assert result["locked"] == 0
+    assert result["writes"] > 0
+    assert result["blocked_reads"] == 0
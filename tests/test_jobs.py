@@ -0,0 +1,19 @@
+"""Pages the app renders for itself never start job workers in that process"""
+import threading
+
+import server
+
+
+def worker_threads():
+    return [thread.name for thread in threading.enumerate()
+            if thread.name.startswith("job-worker-")]
+
+
+def test_prerender_and_warming_start_no_workers(app, posts, tmp_path):
+    queue = app.extensions["job_queue"]
+    queue.workers, queue._workers_pid = 1, None  # pylint: disable=protected-access
+    assert not worker_threads()
+    with app.app_context():
+        server.prerender_site(str(tmp_path / "site"))
+        server.warm_post(posts[-1])
+    assert not worker_threads()
@@ -0,0 +1,34 @@
+"""A signed-in user's likes show on the post page straight away"""
+import server
+
+
+def sign_in(app, client):
+    """Put the posts' author in the client's session, returns their id"""
+    with app.app_context():
+        user = server.db.session.scalars(server.select(server.User)).first()
+        user_id, token = user.id, user.get_id()
+    with client.session_transaction() as session:
+        session["_user_id"] = token
+        session["_fresh"] = True
+    return user_id
+
+
+def test_post_page_shows_pending_like(app, posts, page_cache):
+    client = app.test_client()
+    user_id = sign_in(app, client)
+    path = f"/post/{posts[-1]}"
+    client.get(path)  # Sets the session's CSRF secret, part of the cache key.
+    assert b'data-liked="true"' not in client.get(path).data
+    assert client.get(path).headers["X-Cache"] == "HIT"
+    with app.app_context():
+        comment_id = server.db.session.scalars(
+            server.select(server.Comment.id).where(server.Comment.post_id == posts[-1])).first()
+    server.like_buffer.set(comment_id, user_id, True)
+    try:
+        page = client.get(path)
+        assert page.headers["X-Cache"] == "MISS"
+        assert page.data.count(b'data-liked="true"') == 1
+        server.like_buffer.flush()
+        assert client.get(path).data.count(b'data-liked="true"') == 1
+    finally:
+        server.like_buffer.flush()
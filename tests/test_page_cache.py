@@ -0,0 +1,78 @@
+"""Cached pages are never served under a stale ETag"""
+import datetime
+
+from sqlalchemy import update
+
+import server
+
+
+def test_cached_page_follows_its_etag(app, posts, page_cache):
+    client = app.test_client()
+    path = f"/post/{posts[-1]}"
+    first = client.get(path)
+    assert first.headers["X-Cache"] == "MISS"
+    assert client.get(path).headers["X-Cache"] == "HIT"
+    # Changed behind the app's back, so no tag is invalidated.
+    with app.app_context():
+        server.db.session.execute(
+            update(server.BlogPost).where(server.BlogPost.id == posts[-1])
+            .values(title="Renamed", edit_date=datetime.datetime.now()))
+        server.db.session.commit()
+    second = client.get(path)
+    assert second.headers["X-Cache"] == "MISS"
+    assert second.headers["ETag"] != first.headers["ETag"]
+    assert b"Renamed" in second.data
+
+
+def test_not_modified_still_served_from_cache(app, posts, page_cache):
+    client = app.test_client()
+    first = client.get("/")
+    again = client.get("/", headers={"If-None-Match": first.headers["ETag"]})
+    assert again.status_code == 304
+    assert client.get("/").headers["X-Cache"] == "HIT"
+
+
+def test_warmed_pages_serve_every_host(app, posts, page_cache):
+    with app.app_context():
+        server.warm_post(posts[-1])
+    client = app.test_client()
+    for path in ("/", f"/post/{posts[-1]}"):
+        response = client.get(path, base_url="https://blog.example.org")
+        assert response.headers["X-Cache"] == "HIT"
+
+
+def test_feed_is_cached_per_host(app, posts, page_cache):
+    client = app.test_client()
+    first = client.get("/feed.xml", base_url="https://blog.example.org")
+    assert b"https://blog.example.org/post/" in first.data
+    other = client.get("/feed.xml", base_url="https://mirror.example.org")
+    assert other.headers["X-Cache"] == "MISS"
+    assert b"https://mirror.example.org/post/" in other.data
+
+
+def test_memory_backend_bounds_feeds_by_ttl(tmp_path, posts):
+    app = server.create_app({
+        "TESTING": True, "SECRET_KEY": "test",
+        "SQLALCHEMY_DATABASE_URI": f"sqlite:///{tmp_path / 'blog.db'}",
+        "PAGE_CACHE_BACKEND": "memory", "PAGE_CACHE_TTL": 60,
+        "IMAGE_CACHE_DIR": str(tmp_path / "images"), "METRICS_DIR": str(tmp_path / "metrics"),
+        "JOB_QUEUE_PATH": str(tmp_path / "jobs.sqlite3"), "JOB_WORKERS": 0,
+    })
+    cache = app.extensions["page_cache"]
+    client = app.test_client()
+    assert client.get("/feed.xml").headers["X-Cache"] == "MISS"
+    assert client.get("/feed.xml").headers["X-Cache"] == "HIT"
+    # pylint: disable=protected-access
+    pages = [expires for key, (expires, _) in cache.backend._data.items()
+             if key.startswith("page:")]
+    assert pages and all(expires is not None for expires in pages)
+
+
+def test_pages_with_flash_messages_bypass_the_cache(app, posts, page_cache):
+    flashed = app.test_client()
+    with flashed.session_transaction() as session:
+        session["_flashes"] = [("message", "Only for this visitor")]
+    response = flashed.get("/")
+    assert "X-Cache" not in response.headers
+    assert "ETag" not in response.headers
+    assert app.test_client().get("/").headers["X-Cache"] == "MISS"
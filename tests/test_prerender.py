@@ -0,0 +1,89 @@
+"""Static copies are rendered from the database and link only what they contain"""
+import datetime
+import os
+import re
+from html.parser import HTMLParser
+from urllib.parse import unquote, urlsplit
+
+from sqlalchemy import update
+
+import prerender
+import server
+
+# Pages that only the app can answer, for signed-in or form-submitting
+# visitors; a static copy is served beside the app, which keeps these.
+APP_ONLY = {"/login", "/signup", "/contact", "/new-post", "/search"}
+
+
+class LocalURLs(HTMLParser):
+    """Collects the same-origin URLs a page links, loads or fetches"""
+
+    def __init__(self):
+        super().__init__()
+        self.urls = set()
+
+    def handle_starttag(self, tag, attrs):
+        for name, value in attrs:
+            if not value:
+                continue
+            if name in ("href", "src", "action", "data-url"):
+                candidates = [value]
+            elif name == "srcset":
+                candidates = [part.split()[0] for part in value.split(",") if part.strip()]
+            elif name == "style":
+                candidates = re.findall(r"url\('?([^')]+)'?\)", value)
+            else:
+                continue
+            self.urls.update(url for url in candidates
+                             if url.startswith("/") and not url.startswith("//"))
+
+
+def test_prerender_bypasses_page_cache(app, posts, page_cache, tmp_path):
+    path = f"/post/{posts[-1]}"
+    client = app.test_client()
+    client.get(path)
+    assert client.get(path).headers["X-Cache"] == "HIT"
+    # A change that leaves the ETag alone, so the cached copy is still served.
+    with app.app_context():
+        server.db.session.execute(
+            update(server.BlogPost).where(server.BlogPost.id == posts[-1]).values(title="Renamed"))
+        server.db.session.commit()
+    assert client.get(path).headers["X-Cache"] == "HIT"
+    out_dir = tmp_path / "site"
+    with app.app_context():
+        server.prerender_site(str(out_dir), full=True)
+    assert b"Renamed" in (out_dir / "post" / str(posts[-1]) / "index.html").read_bytes()
+
+
+def test_exported_pages_link_only_exported_files(app, posts, tmp_path):
+    app.config["AVATAR_LOCAL"] = True
+    with app.app_context():
+        server.db.session.execute(
+            update(server.BlogPost).where(server.BlogPost.id == posts[-1])
+            .values(img_url="https://images.example.org/hero.jpg"))
+        # More comments than a page, so the post page would normally fetch the rest.
+        server.db.session.add_all(
+            server.Comment(text=f"Later comment {number}", author_id=1, post_id=posts[-1],
+                           date_created=datetime.datetime.now())
+            for number in range(server.COMMENTS_PER_PAGE))
+        server.db.session.commit()
+        out_dir = str(tmp_path / "site")
+        server.prerender_site(out_dir)
+    missing = set()
+    for root, _, names in os.walk(out_dir):
+        for name in names:
+            if not name.endswith(".html"):
+                continue
+            parser = LocalURLs()
+            with open(os.path.join(root, name), encoding="utf-8") as handle:
+                parser.feed(handle.read())
+            for url in parser.urls:
+                path = unquote(urlsplit(url).path)
+                if path in APP_ONLY or os.path.isfile(prerender.output_path(out_dir, path)) \
+                        or os.path.isfile(os.path.join(out_dir, path.lstrip("/"))):
+                    continue
+                missing.add(url)
+    assert not missing
+    page = prerender.output_path(out_dir, f"/post/{posts[-1]}")
+    with open(page, encoding="utf-8") as handle:
+        assert handle.read().count("like-button") == 5 + server.COMMENTS_PER_PAGE
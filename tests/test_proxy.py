@@ -0,0 +1,21 @@
+"""Behind PROXY_HOPS proxies, each client keeps its own address for the throttles"""
+import pytest
+from flask import request
+
+import server
+
+
+@pytest.mark.parametrize("hops, expected", [(0, "10.0.0.1"), (1, "203.0.113.7")])
+def test_remote_addr_follows_trusted_hops(tmp_path, hops, expected):
+    app = server.create_app({
+        "TESTING": True, "SECRET_KEY": "test", "PROXY_HOPS": hops,
+        "SQLALCHEMY_DATABASE_URI": f"sqlite:///{tmp_path / 'blog.db'}",
+        "PAGE_CACHE_BACKEND": "null",
+        "IMAGE_CACHE_DIR": str(tmp_path / "images"), "METRICS_DIR": str(tmp_path / "metrics"),
+        "JOB_QUEUE_PATH": str(tmp_path / "jobs.sqlite3"), "JOB_WORKERS": 0,
+    })
+    app.add_url_rule("/remote-addr", "remote_addr", lambda: request.remote_addr)
+    response = app.test_client().get(
+        "/remote-addr", environ_base={"REMOTE_ADDR": "10.0.0.1"},
+        headers={"X-Forwarded-For": "198.51.100.1, 203.0.113.7"})
+    assert response.get_data(as_text=True) == expected
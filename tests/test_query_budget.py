@@ -0,0 +1,24 @@
+"""Query budgets hold for the hot pages; strict mode raises if they do not"""
+import pytest
+
+from query_budget import QueryBudgetExceeded, QueryCounter
+
+
+@pytest.mark.parametrize("path, endpoint", [
+    ("/", "blog.index"),
+    ("/posts/1", "blog.posts"),
+    ("/post/{newest}", "blog.get_post"),
+    ("/post/{newest}/comments", "blog.post_comments"),
+])
+def test_pages_stay_within_budget(app, posts, path, endpoint):
+    client = app.test_client()
+    with QueryCounter() as counter:
+        response = client.get(path.format(newest=posts[-1]))
+    assert response.status_code == 200
+    assert counter.count <= app.config["QUERY_BUDGETS"][endpoint]
+
+
+def test_strict_mode_raises_over_budget(app, posts):
+    app.config["QUERY_BUDGETS"]["blog.index"] = 1
+    with pytest.raises(QueryBudgetExceeded):
+        app.test_client().get("/")
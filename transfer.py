@@ -0,0 +1,235 @@
+"""Streaming bulk export and import of users, posts and comments.
+
+Exports read the table through a server-side cursor and write one row at
+a time, as JSON lines or CSV. Imports read the file lazily in chunks of
+CHUNK_SIZE rows, sanitize the chunks on a process pool with only a few in
+flight, and insert each one with executemany (COPY on Postgres), all in one
+transaction. Memory use depends on the chunk size, not the file size.
+
+Derived columns (excerpts, word counts, counters, avatar hashes, the
+search index) are not exported; they are rebuilt on import.
+"""
+import csv
+import datetime
+import io
+import json
+import secrets
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from sqlalchemy import Date, DateTime, Integer, select, text
+from avatars import avatar_hash
+from sanitize import sanitize_comment, sanitize_post_text
+import search
+
+CHUNK_SIZE = 1000
+
+# Columns carried by an export, per kind of row.
+COLUMNS = {
+    "users": ("id", "email", "password", "token", "username", "first_name", "last_name",
+              "birth_date", "date_created", "date_updated"),
+    "posts": ("id", "uploader_id", "article_author", "title", "subtitle", "date",
+              "edit_date", "body", "img_url", "source_url"),
+    "comments": ("id", "post_id", "author_id", "text", "date_created", "date_edited"),
+}
+
+
+def file_format(name, fmt=None):
+    """"csv" or "jsonl", from --format or else the file name"""
+    if fmt:
+        return fmt
+    return "csv" if name.lower().endswith(".csv") else "jsonl"
+
+
+# Reading and writing rows ------------------------------------------------------
+
+def to_text(value):
+    """Exported form of a column value, dates as ISO 8601"""
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    return value
+
+
+def write_rows(file, fmt, columns, rows):
+    """Write rows (tuples in column order) to file, returns how many"""
+    count = 0
+    writer = None
+    if fmt == "csv":
+        writer = csv.writer(file)
+        writer.writerow(columns)
+    for row in rows:
+        values = [to_text(value) for value in row]
+        if writer is not None:
+            writer.writerow(["" if value is None else value for value in values])
+        else:
+            file.write(json.dumps(dict(zip(columns, values))) + "\n")
+        count += 1
+    return count
+
+
+def read_rows(file, fmt):
+    """Rows of a JSONL or CSV file as dicts, one at a time"""
+    if fmt == "csv":
+        yield from csv.DictReader(file)
+        return
+    for line in file:
+        if line.strip():
+            yield json.loads(line)
+
+
+def converters(table, columns):
+    """{column: function} turning exported values back into column values"""
+    def convert(column):
+        def parse(value):
+            # CSV cannot tell None from "", so "" is None where the column allows it.
+            if value is None or (value == "" and column.nullable):
+                return None
+            if isinstance(column.type, DateTime):
+                return datetime.datetime.fromisoformat(value)
+            if isinstance(column.type, Date):
+                return datetime.date.fromisoformat(value)
+            if isinstance(column.type, Integer):
+                return int(value)
+            return value
+        return parse
+    return {name: convert(table.c[name]) for name in columns}
+
+
+def chunked(rows, size):
+    """Lists of up to size rows"""
+    rows = iter(rows)
+    while True:
+        chunk = list(islice(rows, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+# Preparing rows, in worker processes -------------------------------------------
+
+def prepare_users(rows):
+    """Fill the avatar hash and any missing token or username"""
+    now = datetime.datetime.now()
+    for row in rows:
+        row["avatar_hash"] = avatar_hash(row["email"])
+        row["token"] = row.get("token") or secrets.token_hex()
+        row["username"] = row.get("username") or secrets.token_hex()
+        row["date_created"] = row.get("date_created") or now
+    return rows, []
+
+
+def prepare_posts(rows):
+    """Sanitize the bodies; also returns the search index rows"""
+    texts = []
+    for row in rows:
+        columns, content = sanitize_post_text(row.get("body") or "")
+        row.update(columns)
+        row["comment_count"] = 0
+        texts.append((row["id"], row["title"], row.get("subtitle"), content))
+    return rows, texts
+
+
+def prepare_comments(rows):
+    """Sanitize the comment text"""
+    for row in rows:
+        row.update(sanitize_comment(row.get("text") or ""))
+        row["like_count"] = 0
+    return rows, []
+
+
+PREPARE = {"users": prepare_users, "posts": prepare_posts, "comments": prepare_comments}
+
+
+def prepared_chunks(rows, prepare, chunk_size, workers):
+    """Chunks passed through prepare on a process pool, in file order.
+
+    At most two chunks per worker are queued, so a large file is never read
+    far ahead of what has been inserted.
+    """
+    if workers <= 1:
+        for chunk in chunked(rows, chunk_size):
+            yield prepare(chunk)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        for chunk in chunked(rows, chunk_size):
+            pending.append(pool.submit(prepare, chunk))
+            if len(pending) >= workers * 2:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+# Inserting -----------------------------------------------------------------------
+
+def copy_value(value):
+    """A value in Postgres COPY text format"""
+    if value is None:
+        return r"\N"
+    if isinstance(value, bool):
+        return "t" if value else "f"
+    value = to_text(value)
+    if not isinstance(value, str):
+        return str(value)
+    return (value.replace("\\", "\\\\").replace("\t", "\\t")
+            .replace("\n", "\\n").replace("\r", "\\r"))
+
+
+def insert_chunk(conn, table, rows):
+    """Insert prepared rows: COPY on Postgres, one executemany elsewhere"""
+    columns = list(rows[0])
+    if conn.dialect.name == "postgresql":
+        buffer = io.StringIO()
+        for row in rows:
+            buffer.write("\t".join(copy_value(row.get(name)) for name in columns) + "\n")
+        buffer.seek(0)
+        cursor = conn.connection.driver_connection.cursor()
+        try:
+            cursor.copy_expert(f"COPY {table.name} ({', '.join(columns)}) FROM STDIN", buffer)
+        finally:
+            cursor.close()
+    else:
+        conn.execute(table.insert(), rows)
+
+
+def reset_sequence(conn, table):
+    """Move a Postgres id sequence past the ids that were imported"""
+    if conn.dialect.name == "postgresql":
+        conn.execute(text(f"SELECT setval(pg_get_serial_sequence('{table.name}', 'id'), "
+                          f"coalesce(max(id), 1)) FROM {table.name}"))
+
+
+def export_table(conn, table, kind, file, fmt, chunk_size=CHUNK_SIZE):
+    """Stream a table to file in id order, returns how many rows were written"""
+    columns = COLUMNS[kind]
+    result = conn.execution_options(yield_per=chunk_size).execute(
+        select(*(table.c[name] for name in columns)).order_by(table.c.id))
+    return write_rows(file, fmt, columns, result)
+
+
+def import_rows(conn, table, kind, rows, chunk_size=CHUNK_SIZE, workers=1, progress=None):
+    """Insert rows of one kind in chunks, returns how many were inserted.
+
+    Unknown keys are ignored. The caller commits, so a failed import leaves
+    nothing behind. progress(count, seconds) is called after every chunk.
+    """
+    columns = [name for name in COLUMNS[kind] if name in table.c]
+    convert = converters(table, columns)
+
+    def parse(rows):
+        for number, row in enumerate(rows, start=1):
+            # Ids are kept, since posts and comments refer to them.
+            if row.get("id") in (None, ""):
+                raise ValueError(f"Row {number} has no id")
+            yield {name: convert[name](row.get(name)) for name in columns}
+    started = time.perf_counter()
+    count = 0
+    for chunk, texts in prepared_chunks(parse(rows), PREPARE[kind], chunk_size, workers):
+        insert_chunk(conn, table, chunk)
+        search.index_texts(conn, texts)
+        count += len(chunk)
+        if progress is not None:
+            progress(count, time.perf_counter() - started)
+    reset_sequence(conn, table)
+    return count
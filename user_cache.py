@@ -0,0 +1,89 @@
+"""Per-worker cache of the signed-in user for Flask-Login's user_loader"""
+import threading
+from flask_login import UserMixin
+from cache import MemoryCache
+
+
+class SessionUser(UserMixin):
+    """Detached, read-only copy of the User columns read on every request"""
+    __slots__ = ("id", "token", "email", "username", "first_name", "last_name")
+
+    def __init__(self, user):
+        for name in self.__slots__:
+            setattr(self, name, getattr(user, name))
+
+    @property
+    def full_name(self):
+        """Same as User.full_name"""
+        return f"{self.first_name} {self.last_name}"
+
+    def __repr__(self) -> str:
+        return f"<name: {self.full_name}>"
+
+
+class UserCache:
+    """TTL/LRU cache of SessionUser records keyed by session user id.
+
+    Each entry is stored with the user's version from the page cache's tag
+    store, and invalidating a user gives them a new one. With a shared page
+    cache backend the version is checked on every hit, so a password,
+    username or account change in one worker reaches all of them at once.
+    With a per-process backend only this worker's entry is dropped, and
+    USER_CACHE_TTL bounds how long a rotated session stays usable elsewhere.
+    """
+
+    def __init__(self, app=None, versions=None):
+        self.store = MemoryCache()
+        self.versions = None
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app, versions)
+
+    def init_app(self, app, versions=None):
+        """Size the cache from USER_CACHE_SIZE and USER_CACHE_TTL, versions is the PageCache"""
+        app.config.setdefault("USER_CACHE_SIZE", 1024)
+        app.config.setdefault("USER_CACHE_TTL", 30)
+        self.store = MemoryCache(app.config["USER_CACHE_SIZE"],
+                                 app.config["USER_CACHE_TTL"])
+        self.versions = versions
+        app.extensions["user_cache"] = self
+
+    def _version(self, key):
+        if self.versions is None or not self.versions.backend.shared:
+            return None
+        return self.versions.tag_version(f"session-user:{key}")
+
+    def get(self, user_id, load):
+        """Cached user for this id, calling load() to fetch it on a miss"""
+        key = str(user_id)
+        # Read before loading, so a change made meanwhile leaves the entry
+        # under a version that is already stale.
+        version = self._version(key)
+        item = self.store.get(key)
+        with self._lock:
+            if item is not None and item[0] == version:
+                self.hits += 1
+                return item[1]
+            self.misses += 1
+        loaded = load()
+        if loaded is None:
+            return None
+        user = SessionUser(loaded)
+        self.store.set(key, (version, user))
+        return user
+
+    def invalidate(self, user_id):
+        """Forget a user in every worker, after a password, username or account change"""
+        key = str(user_id)
+        self.store.delete(key)
+        if self.versions is not None and self.versions.backend.shared:
+            self.versions.invalidate(f"session-user:{key}")
+
+    def stats(self):
+        """Hit ratio, evictions and size for this worker"""
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses,
+                "hit_ratio": self.hits / total if total else 0.0,
+                "evictions": self.store.evictions, "size": len(self.store)}